@@ -0,0 +1,133 @@
+"""
+Index of processed activities.
+sqlite database of every activity processed, keyed by source and activity id, with
+content hash, output paths, processing version and timestamps. Used to decide whether
+an activity needs processing, rather than checking for files.
+Database is only created when first used. When created, rows from the existing metadata
+csv are imported so activities processed before the index existed aren't processed again.
+@author: lawrence
+"""
+
+import sqlite3
+import json
+import csv
+import os
+import time
+
+SOURCE_GARMIN = 'garmin'
+SOURCE_LOCAL = 'local'
+
+
+class ActivityIndex:
+    """Processed activities, looked up by source and id"""
+    def __init__(self, filename, metadata_csv_filename=None, metadata_csv_version=1):
+        """
+        :param metadata_csv_filename: existing metadata csv to import when index is created
+        :param metadata_csv_version: processing version to record for imported activities
+        """
+        self.filename = filename
+        self.metadata_csv_filename = metadata_csv_filename
+        self.metadata_csv_version = metadata_csv_version
+        self.connection = None
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'."""
+        self.close()
+
+    def _connect(self):
+        """Open database, creating table and importing metadata csv if it's new"""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            exists = self.connection.execute("SELECT name FROM sqlite_master "
+                                             "WHERE type = 'table' AND name = 'activities'").fetchone()
+            if exists is None:
+                self.connection.execute('CREATE TABLE activities ('
+                                        'source TEXT, activity_id TEXT, content_hash TEXT, output_paths TEXT, '
+                                        'processing_version INTEGER, first_processed REAL, last_processed REAL, '
+                                        'PRIMARY KEY (source, activity_id))')
+                self.connection.execute('CREATE INDEX activities_version ON activities (processing_version)')
+                if self.metadata_csv_filename is not None and os.path.isfile(self.metadata_csv_filename):
+                    self.import_metadata_csv(self.metadata_csv_filename, self.metadata_csv_version)
+                self.connection.commit()
+        return self.connection
+
+    def get(self, source, activity_id):
+        """Return row for activity as dict, None if never processed"""
+        row = self._connect().execute('SELECT content_hash, output_paths, processing_version, '
+                                      'first_processed, last_processed FROM activities '
+                                      'WHERE source = ? AND activity_id = ?',
+                                      (source, str(activity_id))).fetchone()
+        if row is None:
+            return None
+        return {'content_hash': row[0],
+                'output_paths': json.loads(row[1]),
+                'processing_version': row[2],
+                'first_processed': row[3],
+                'last_processed': row[4]}
+
+    def is_current(self, source, activity_id, version, content_hash=None):
+        """True if activity has been processed by this version (or later) of processing.
+        If content_hash given it must also match.
+        """
+        activity = self.get(source, activity_id)
+        if activity is None or activity['processing_version'] < version:
+            return False
+        return content_hash is None or activity['content_hash'] == content_hash
+
+    def get_outdated(self, source, version):
+        """Ids of activities processed by an older version"""
+        rows = self._connect().execute('SELECT activity_id FROM activities '
+                                       'WHERE source = ? AND processing_version < ?',
+                                       (source, version)).fetchall()
+        return [row[0] for row in rows]
+
+    def get_activities_by_output_path(self):
+        """(source, activity_id) of activity each output file was written for, keyed by absolute path"""
+        activities = {}
+        for source, activity_id, output_paths in self._connect().execute('SELECT source, activity_id, output_paths '
+                                                                         'FROM activities'):
+            for output_path in json.loads(output_paths):
+                activities[os.path.abspath(output_path)] = (source, activity_id)
+        return activities
+
+    def record(self, source, activity_id, content_hash, output_paths, version):
+        """Record activity as processed"""
+        connection = self._connect()
+        now = time.time()
+        connection.execute('INSERT INTO activities VALUES (?, ?, ?, ?, ?, ?, ?) '
+                           'ON CONFLICT (source, activity_id) DO UPDATE SET '
+                           'content_hash = excluded.content_hash, output_paths = excluded.output_paths, '
+                           'processing_version = excluded.processing_version, '
+                           'last_processed = excluded.last_processed',
+                           (source, str(activity_id), content_hash, json.dumps(output_paths), version, now, now))
+        connection.commit()
+
+    def import_metadata_csv(self, filename, version):
+        """Migrate activities from metadata csv.
+        Id column is activity_<id>, numeric ids are from Garmin and anything else a local file.
+        Id is found by its header, old csvs had date and time as two columns, exported ones a single start.
+        """
+        connection = self._connect()
+        now = time.time()
+        with open(filename, 'r', encoding='utf-8', newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader, [])
+            id_column = header.index('Garmin ID') if 'Garmin ID' in header else 3
+            for row in reader:
+                if len(row) <= id_column or not row[id_column].startswith('activity_'):
+                    continue
+                activity_id = row[id_column][len('activity_'):]
+                source = SOURCE_GARMIN if activity_id.isdigit() else SOURCE_LOCAL
+                connection.execute('INSERT OR IGNORE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (source, activity_id, None, json.dumps([]), version, now, now))
+        connection.commit()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
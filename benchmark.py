@@ -0,0 +1,309 @@
+"""
+Benchmark processing with synthetic gpx workloads.
+Times each stage of process_gpx (parse, distance, filter, splits, points, farthest, locality, write)
+and the whole thing, hill list compile and load, hilldb.analyse_track and the legacy
+gpxtocsv.py script, reporting throughput and peak memory. Locality lookups use a stub geocoder so no network is needed.
+Also times importing each entry point in a fresh interpreter (python -X importtime), as
+startup is most of the cost of short runs.
+Results are saved as json, and can be compared with a previous run.
+
+Usage: python benchmark.py [--sizes 1000 10000 ...] [--output results.json] [--compare old.json] [--imports-only]
+@author: lawrence
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy
+
+import config
+import syntheticgpx
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+# Legacy script now streams and calculates distances in one pass like process_gpx (about 11s for 1M points),
+# so it's run on every default size, --max-legacy-points limits it for larger ones
+DEFAULT_MAX_LEGACY_POINTS = max(DEFAULT_SIZES)
+# Name, then generate_track parameters
+WORKLOADS = [('cycle_1s', {'interval': 1, 'speed': 6.0}),
+             ('run_5s', {'interval': 5, 'speed': 3.0}),
+             ('hike_1s_stops', {'interval': 1, 'speed': 1.2, 'stationary_every': 900, 'stationary_length': 300})]
+# Modules run as scripts, import time measured for each - best of IMPORT_REPEATS
+ENTRY_POINTS = ['filtergpx', 'processlocal', 'hilldb', 'metadatastore']
+IMPORT_REPEATS = 5
+# Number of slowest imports to report for each entry point
+IMPORT_HEAVIEST = 5
+
+
+def stub_geocoder(coordinates):
+    """Stands in for Nominatim, roughly 10km places"""
+    return ['Place%d_%d' % (round(latitude * 10), round(longitude * 10)) for latitude, longitude in coordinates]
+
+
+def measure(function, memory):
+    """Run function, returning (result, seconds, peak bytes).
+    Peak memory is only measured when memory is True, as tracing slows things down.
+    """
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run_stages(stages, memory):
+    """Run list of (name, function) in order, each function gets a dict shared between stages.
+    Returns {name: (seconds, peak)}
+    """
+    context = {}
+    results = {}
+    for name, function in stages:
+        _, seconds, peak = measure(lambda: function(context), memory)
+        results[name] = (seconds, peak)
+    return results
+
+
+def get_pipeline_stages(filtergpx, gpx_filename, output_root):
+    """Stages of process_gpx, run separately"""
+    from track import Track
+    from trackdistance import calculate_incremental_distances
+
+    def parse(context):
+        context['track'] = Track.from_gpx(gpx_filename)
+
+    def distance(context):
+        track = context['track']
+        context['incremental'] = calculate_incremental_distances(track.latitudes, track.longitudes)
+        context['total'] = numpy.cumsum(context['incremental'])
+
+    def filter_points(context):
+        context['gpx'] = filtergpx.GPXData()
+        context['gpx'].process_track(context['track'], context['incremental'])
+
+    def splits(context):
+        context['splits'] = filtergpx.Splits()
+        context['splits'].process_track(context['track'], context['incremental'], context['total'])
+
+    def points(context):
+        context['points'] = filtergpx.GPXcsv()
+        context['points'].process_track(context['track'], context['incremental'], context['total'])
+
+    def farthest(context):
+        context['track_data'] = filtergpx.TrackData(context['track'], context['total'])
+
+    def locality(context):
+        context['track_data'].get_locality_string()
+
+    def write(context):
+        output_filename = output_root + 'benchmark'
+        context['gpx'].write(output_filename)
+        context['splits'].write(output_filename + '_split')
+        context['points'].write(output_filename + '_points')
+
+    def process_gpx(context):
+        filtergpx.process_gpx('benchmark', gpx_filename, filtergpx.MetadataRecords())
+
+    return [('parse', parse), ('distance', distance), ('filter', filter_points), ('splits', splits),
+            ('points', points), ('farthest', farthest), ('locality', locality), ('write', write), ('process_gpx', process_gpx)]
+
+
+def run_legacy(gpx_filename):
+    """Run gpxtocsv.py as a separate process, returns (seconds, peak bytes), or None if it failed.
+    Peak memory is only available where os.wait4 is (not Windows).
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gpxtocsv.py')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, script, gpx_filename], stdout=subprocess.DEVNULL)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is KB on Linux, bytes on macOS
+        peak = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    else:
+        process.wait()
+        peak = None
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        return None
+    return seconds, peak
+
+
+def measure_import(module, local_path):
+    """Import module in a fresh interpreter with -X importtime.
+    config is imported first, pointed at local_path, and isn't counted.
+    Returns (seconds, [(name, seconds) of slowest imports made directly by module]), or None if import failed.
+    """
+    code = 'import config; config.local_path = %r; import %s' % (local_path, module)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    if process.returncode != 0:
+        return None
+    # Lines are 'import time: self | cumulative | name', name indented 2 spaces per level,
+    # and each module's line comes after those of the modules it imports
+    children = []
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        level = (len(name) - len(name.lstrip())) // 2
+        if level == 0:
+            if name.strip() == module:
+                children.sort(key=lambda child: child[1], reverse=True)
+                return int(fields[1]) / 1e6, children[:IMPORT_HEAVIEST]
+            children = []
+        elif level == 1:
+            children.append((name.strip(), int(fields[1]) / 1e6))
+    return None
+
+
+def run_imports(local_path):
+    """Import time of each entry point, returns list of result dicts"""
+    results = []
+    for module in ENTRY_POINTS:
+        measurements = [measure_import(module, local_path) for _ in range(IMPORT_REPEATS)]
+        if None in measurements:
+            print('%-24s %-14s failed' % (module, 'import'))
+            continue
+        seconds, heaviest = min(measurements)
+        results.append({'workload': module, 'points': 0, 'stage': 'import', 'seconds': seconds,
+                        'points_per_second': None, 'peak_bytes': None, 'heaviest': heaviest})
+        print('%-24s %-14s %10.3fs  %s' % (module, 'import', seconds,
+                                            ', '.join('%s %.0fms' % (name, child_seconds * 1000)
+                                                      for name, child_seconds in heaviest)))
+    return results
+
+
+def run_benchmark(sizes, max_legacy_points, work_dir, imports_only=False):
+    """Generate workloads and run everything, returns list of result dicts"""
+    root = work_dir + os.sep
+    # Point everything at the work folder - hilldb reads its hill list on import
+    config.local_path = root
+    config.locality_source = 'nominatim'
+    os.makedirs(root + 'Import', exist_ok=True)
+
+    print('Generating workloads')
+    workloads = []
+    for size in ([] if imports_only else sizes):
+        for name, parameters in WORKLOADS:
+            gpx_filename = '%s%s_%d.gpx' % (root, name, size)
+            syntheticgpx.write_gpx(gpx_filename, size, **parameters)
+            workloads.append(('%s_%d' % (name, size), size, gpx_filename))
+    hill_db_file = root + "HillList\\DoBIH_v17_3.csv"
+    os.makedirs(os.path.dirname(hill_db_file), exist_ok=True)
+    syntheticgpx.write_hill_list(hill_db_file, [workload[2] for workload in workloads])
+
+    print('Import times')
+    import_results = run_imports(root)
+    if imports_only:
+        return import_results
+
+    import filtergpx
+    from localitycache import LocalityCache
+
+    # Outputs to work folder, stub geocoder behind a fresh cache
+    def get_output_path(activity='', year=''):
+        if activity == '':
+            return root
+        path = '%sActivities%s%s%s%s%s' % (root, os.sep, activity, os.sep, year, os.sep)
+        os.makedirs(path, exist_ok=True)
+        return path
+    filtergpx.get_output_path = get_output_path
+    filtergpx.lookup_localities = stub_geocoder
+    filtergpx.locality_cache = LocalityCache(root + 'LocalityCache.sqlite')
+
+    results = import_results
+
+    def add_result(workload, points, stage, seconds, peak):
+        results.append({'workload': workload, 'points': points, 'stage': stage, 'seconds': seconds,
+                        'points_per_second': points / seconds if seconds > 0 else None, 'peak_bytes': peak})
+        print('%-24s %-14s %10.3fs %14.0f pts/s %10s' % (workload, stage, seconds,
+                                                          points / seconds if seconds > 0 else 0,
+                                                          '-' if peak is None else '%.1fMB' % (peak / 1e6)))
+
+    # Hill list compile, then load of compiled list (on import), timed then traced
+    import hillfile
+    _, seconds, _ = measure(lambda: hillfile.compile_hill_list(hill_db_file), False)
+    _, _, peak = measure(lambda: hillfile.compile_hill_list(hill_db_file), True)
+    _, load_seconds, _ = measure(lambda: importlib.import_module('hilldb'), False)
+    hilldb = sys.modules['hilldb']
+    _, _, load_peak = measure(lambda: importlib.reload(hilldb), True)
+    add_result('hill_list', len(hilldb.hill_index.hills), 'hill_compile', seconds, peak)
+    add_result('hill_list', len(hilldb.hill_index.hills), 'hill_load', load_seconds, load_peak)
+
+    for workload, points, gpx_filename in workloads:
+        output_root = root + workload + '_'
+        stages = get_pipeline_stages(filtergpx, gpx_filename, output_root)
+        timings = run_stages(stages, False)
+        peaks = run_stages(stages, True)
+        for stage, _ in stages:
+            add_result(workload, points, stage, timings[stage][0], peaks[stage][1])
+
+        def analyse():
+            hilldb.analyse_track(gpx_filename, hilldb.SummitRows(), hilldb.Stats())
+        _, seconds, _ = measure(analyse, False)
+        _, _, peak = measure(analyse, True)
+        add_result(workload, points, 'analyse_track', seconds, peak)
+
+        if points <= max_legacy_points:
+            legacy = run_legacy(gpx_filename)
+            if legacy is None:
+                # Not recorded, a failed run isn't comparable
+                print('%-24s %-14s failed' % (workload, 'gpxtocsv'))
+            else:
+                add_result(workload, points, 'gpxtocsv', legacy[0], legacy[1])
+
+    return results
+
+
+def compare(results, previous_filename):
+    """Print speed of this run relative to a previous one"""
+    with open(previous_filename, 'r') as file:
+        previous = {(result['workload'], result['stage']): result for result in json.load(file)['results']}
+    print('\nCompared with %s (>1 is faster now)' % previous_filename)
+    for result in results:
+        old = previous.get((result['workload'], result['stage']))
+        if old is None or result['seconds'] == 0:
+            continue
+        print('%-24s %-14s %6.2fx' % (result['workload'], result['stage'], old['seconds'] / result['seconds']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark gpx processing with synthetic workloads.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Track sizes (points)')
+    parser.add_argument('--max-legacy-points', type=int, default=DEFAULT_MAX_LEGACY_POINTS,
+                        help='Largest track to run gpxtocsv.py on')
+    parser.add_argument('--output', default='benchmark_%s.json' % time.strftime('%Y%m%d_%H%M%S'),
+                        help='Results file')
+    parser.add_argument('--compare', help='Previous results file to compare with')
+    parser.add_argument('--imports-only', action='store_true', help='Only measure import times')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        benchmark_results = run_benchmark(args.sizes, args.max_legacy_points, work_dir, args.imports_only)
+
+    with open(args.output, 'w') as output_file:
+        json.dump({'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': sys.version,
+                   'platform': platform.platform(),
+                   'sizes': args.sizes,
+                   'results': benchmark_results},
+                  output_file, indent=1)
+    print('Results written to %s' % args.output)
+
+    if args.compare:
+        compare(benchmark_results, args.compare)
@@ -0,0 +1,187 @@
+"""
+Columnar (Parquet or Arrow IPC) output of point, split and metadata data.
+Typed columns - timestamps and floats - so analysis doesn't have to re-parse csvs.
+Metadata is written as a dataset partitioned by activity type and year
+(Metadata/activity=<type>/year=<year>/), so it can be read selectively. Each partition
+is a single file, rewritten as batches of activities are added.
+Needs pyarrow, which is optional unless columnar output is configured. It is slow to
+import, so is only loaded when first needed.
+@author: lawrence
+"""
+
+import glob
+import os
+import time
+import numpy
+from common import atomic_write
+
+PARQUET = 'parquet'
+ARROW = 'arrow'
+# File in each metadata partition, extension added
+METADATA_NAME = 'activities'
+
+# Loaded by check_format
+pyarrow = None
+
+
+def check_format(file_format):
+    """Load pyarrow if not already loaded, and check format is one we know"""
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.compute
+            import pyarrow.parquet
+            import pyarrow.ipc
+        except ImportError:
+            pyarrow = None
+            raise ImportError('pyarrow is needed for %s output' % file_format)
+    if file_format not in (PARQUET, ARROW):
+        raise ValueError('Unknown columnar format: %s' % file_format)
+
+
+def get_extension(file_format):
+    return '.parquet' if file_format == PARQUET else '.arrow'
+
+
+def write_table(columns, filename, file_format):
+    """Write dict of columns, or table, to filename (extension added), via temp file so it appears complete"""
+    check_format(file_format)
+    table = columns if isinstance(columns, pyarrow.Table) else pyarrow.table(columns)
+    filename += get_extension(file_format)
+    # Temp file is hidden, so never picked up as part of a dataset
+    with atomic_write(filename) as temp_filename:
+        if file_format == PARQUET:
+            pyarrow.parquet.write_table(table, temp_filename)
+        else:
+            with pyarrow.ipc.new_file(temp_filename, table.schema) as writer:
+                writer.write_table(table)
+    return filename
+
+
+def read_table(filename, file_format):
+    """Read whole file written by write_table (extension included)"""
+    check_format(file_format)
+    if file_format == PARQUET:
+        return pyarrow.parquet.read_table(filename)
+    with pyarrow.ipc.open_file(filename) as reader:
+        return reader.read_all()
+
+
+def write_points(filename, track, incremental_distances, total_distances, file_format):
+    """Same data as points csv
+    :type track: Track
+    """
+    check_format(file_format)
+    incremental_times = numpy.diff(track.times)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        speeds = numpy.append(0.0, incremental_distances[1:] / incremental_times)
+    # Points with the same time keep the previous speed, as in points csv
+    previous = numpy.arange(len(speeds))
+    previous[1:][incremental_times == 0] = 0
+    speeds = speeds[numpy.maximum.accumulate(previous)][1:]
+    # Microseconds, so fractions of a second are kept, null where point has no time
+    missing_times = numpy.isnan(track.times[1:])
+    microseconds = numpy.round(numpy.where(missing_times, 0, track.times[1:]) * 1e6).astype(numpy.int64)
+    return write_table({'Time': pyarrow.array(microseconds, type=pyarrow.timestamp('us', tz='UTC'),
+                                              mask=missing_times),
+                        'Incr Time': incremental_times,
+                        'Incr Distance': incremental_distances[1:],
+                        'Total Distance': total_distances[1:],
+                        'Speed(m/s)': speeds},
+                       filename, file_format)
+
+
+def write_splits(filename, columns, file_format):
+    """Same data as split csv
+    :param columns: dict of lists or arrays - Time (epoch seconds), Split Time and Total Time (seconds),
+    Split Distance, Total Distance and Pace
+    """
+    check_format(file_format)
+    columns = dict(columns)
+    # Whole seconds, null where there's no time
+    times = numpy.asarray(columns['Time'], dtype=numpy.float64)
+    missing_times = numpy.isnan(times)
+    columns['Time'] = pyarrow.array(numpy.round(numpy.where(missing_times, 0, times)).astype(numpy.int64),
+                                    type=pyarrow.timestamp('s', tz='UTC'), mask=missing_times)
+    return write_table(columns, filename, file_format)
+
+
+def get_metadata_path(root_path, activity_type, year):
+    """Partition folder for activity type and year"""
+    return '%sMetadata%sactivity=%s%syear=%s%s' % (root_path, os.sep, activity_type, os.sep, year, os.sep)
+
+
+def get_metadata_table(records):
+    """Table of records, all in the same partition
+    :type records: list of MetadataRecord
+    """
+    return pyarrow.table({'Start Time': pyarrow.array([int(record.start_time) for record in records],
+                                                      type=pyarrow.timestamp('s', tz='UTC')),
+                          'Activity ID': pyarrow.array([str(record.activity_id) for record in records],
+                                                       type=pyarrow.string()),
+                          'Distance': pyarrow.array([record.distance for record in records], type=pyarrow.float64()),
+                          'Duration': pyarrow.array([record.duration.total_seconds() for record in records],
+                                                    type=pyarrow.float64()),
+                          'Location': pyarrow.array([record.locality for record in records], type=pyarrow.string())})
+
+
+def write_metadata(root_path, records, file_format):
+    """Add batch of activities to metadata dataset, replacing any already there with the same id.
+    Every partition holding one of the ids is rewritten without it, as reprocessing can change an
+    activity's type, then the new records are added to their partitions.
+    Returns filenames written.
+    :type records: list of MetadataRecord
+    """
+    check_format(file_format)
+    # Only the last record for an id counts
+    records = list({str(record.activity_id): record for record in records}.values())
+    if len(records) == 0:
+        return []
+    activity_ids = pyarrow.array([str(record.activity_id) for record in records], type=pyarrow.string())
+    # Year as used for output folders
+    records_by_path = {}
+    for record in records:
+        path = get_metadata_path(root_path, record.activity_type, time.strftime('%Y', time.gmtime(record.start_time)))
+        records_by_path.setdefault(path, []).append(record)
+    existing_paths = [path + os.sep for path in glob.glob(get_metadata_path(root_path, '*', '*')[:-1])]
+    # Parquet reads second timestamps back as milliseconds
+    schema = get_metadata_table([]).schema
+
+    filenames = []
+    for path in sorted(set(records_by_path) | set(existing_paths)):
+        filename = path + METADATA_NAME + get_extension(file_format)
+        tables = []
+        if os.path.isfile(filename):
+            existing = read_table(filename, file_format)
+            replaced = pyarrow.compute.is_in(existing['Activity ID'], value_set=activity_ids)
+            if path not in records_by_path and not pyarrow.compute.any(replaced).as_py():
+                continue
+            tables.append(existing.filter(pyarrow.compute.invert(replaced)).cast(schema))
+        if path in records_by_path:
+            tables.append(get_metadata_table(records_by_path[path]))
+        table = pyarrow.concat_tables(tables)
+        if table.num_rows == 0:
+            os.remove(filename)
+            continue
+        os.makedirs(path, exist_ok=True)
+        filenames.append(write_table(table, path + METADATA_NAME, file_format))
+    return filenames
+
+
+def read_metadata(root_path, file_format, activity_type=None, year=None):
+    """Read metadata dataset as a pyarrow table, only reading the partitions needed"""
+    global pyarrow
+    check_format(file_format)
+    # Only needed here, and slower to import than the rest of pyarrow
+    import pyarrow.dataset
+    dataset = pyarrow.dataset.dataset(root_path + 'Metadata',
+                                      format='parquet' if file_format == PARQUET else 'ipc',
+                                      partitioning='hive')
+    condition = None
+    if activity_type is not None:
+        condition = pyarrow.dataset.field('activity') == activity_type
+    if year is not None:
+        year_condition = pyarrow.dataset.field('year') == int(year)
+        condition = year_condition if condition is None else condition & year_condition
+    return dataset.to_table(filter=condition)
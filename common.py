@@ -0,0 +1,46 @@
+"""
+Constants and helpers shared by the processing modules.
+@author: lawrence
+"""
+
+from contextlib import contextmanager
+import hashlib
+import os
+
+# Meters in a mile
+MILE = 1609
+# Meters per degree of latitude, close enough for bounding boxes and nearby searches
+METERS_PER_DEGREE = 111320
+
+
+def get_pace(seconds, distance):
+    """Pace in minutes per mile, works on arrays"""
+    return seconds / 60 * MILE / distance
+
+
+def get_file_hash(filename):
+    """sha256 of file contents"""
+    file_hash = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+@contextmanager
+def atomic_write(filename):
+    """Gives a temp filename to write to, renamed to filename when the block completes, replacing any
+    existing file, so a partial file is never seen. Removed if the block fails.
+    Temp file is hidden, in the same folder, and named for this process so concurrent writers don't clash.
+    Usage:
+        with atomic_write(filename) as temp_filename, open(temp_filename, 'w') as file:
+            ...
+    """
+    temp_filename = os.path.join(os.path.dirname(filename), '.%s.%d.tmp' % (os.path.basename(filename), os.getpid()))
+    try:
+        yield temp_filename
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+    os.replace(temp_filename, filename)
@@ -1,2 +1,58 @@
 max_activities = 9
 local_path = '/Users/lawre/Library/CloudStorage/OneDrive-Personal/Documents/GPSData'
+# Reverse geocode cache - cell size in degrees (0.001 approx 100m)
+locality_cache_cell_size = 0.001
+locality_cache_ttl_days = 90
+locality_cache_max_entries = 10000
+# Where to get locality from - 'nominatim' (online) or 'gazetteer' (offline, from gazetteer_file)
+locality_source = 'nominatim'
+gazetteer_file = local_path + 'Gazetteer.csv'
+# Online lookups - Nominatim compatible reverse geocode url (can be a local server for testing),
+# request rate limit (shared by all processes), timeouts (seconds) and retries.
+# If a lookup fails, locality_fallback 'gazetteer' uses gazetteer_file if there is one, '' for none
+geocoder_url = 'https://nominatim.openstreetmap.org/reverse'
+geocoder_user_agent = 'filtergpx'
+geocoder_requests_per_second = 1.0
+geocoder_connect_timeout = 5
+geocoder_read_timeout = 10
+geocoder_retries = 2
+locality_fallback = 'gazetteer'
+# Number of processes for processlocal, 1 to process files one at a time
+import_workers = 1
+# processlocal --watch - seconds a file must be unchanged before it's processed (inotify processes
+# a file when it's closed, so this is only for files there at the start), the same when inotify
+# isn't available (eg Windows) - short so files are processed within a second, but a copy that
+# stalls for longer may be processed part written - between scans when polling, and between
+# queue depth / rate reports
+watch_settle_seconds = 3.0
+watch_poll_settle_seconds = 0.3
+watch_poll_seconds = 0.5
+watch_report_seconds = 60
+# Garmin Connect downloads - concurrent downloads, processes converting/processing,
+# request rate limit and backoff when told there are too many requests
+garmin_download_workers = 4
+garmin_process_workers = 2
+garmin_requests_per_second = 1.0
+garmin_retries = 5
+garmin_backoff_seconds = 5
+# Number of processes for hilldb analysis
+hill_workers = 4
+# Columnar output of points, splits and metadata - '' for none, 'parquet' or 'arrow'
+# columnar_only writes it instead of the points and split csvs
+columnar_format = ''
+columnar_only = False
+# Timers and counters for each stage, logged per activity and summarised per run
+instrumentation = True
+# Simplification of gpx output - 'separation' keeps a point every 5m travelled,
+# 'douglas_peucker' drops points until any more would be over gpx_max_error meters from the line,
+# or stops at gpx_target_points (0 for no target)
+gpx_simplification = 'separation'
+gpx_max_error = 2.0
+gpx_target_points = 0
+# Write gpx output gzipped (.gpx.gz)
+gpx_compress = False
+# Split distances (meters) for split csvs - first is written as _split, others as _split_<distance>m
+split_distances = [250]
+# Coverage heatmap of all activities (see heatmap), stored at this Web Mercator zoom
+heatmap = True
+heatmap_zoom = 15
@@ -0,0 +1,51 @@
+"""
+Streaming output to a temporary file, renamed into place when complete.
+Used for csv outputs that are generated before the final filename is known.
+Only the write buffer is held in memory, however much is written.
+@author: lawrence
+"""
+
+import io
+import os
+import tempfile
+
+# Write buffer size (bytes)
+BUFFER_SIZE = 64 * 1024
+
+
+class CSVSink:
+    """Text written through a bounded buffer to a temp file.
+    Call commit() to rename it to its real name, or discard() if it's not needed.
+    """
+    def __init__(self, temp_dir, header=''):
+        """Temp file is created in temp_dir, which must be on the same drive as the final file"""
+        handle, self.temp_filename = tempfile.mkstemp(suffix='.tmp', prefix='.csvsink_', dir=temp_dir)
+        self.file = io.open(handle, 'w', buffering=BUFFER_SIZE)
+        self.lines_written = 0
+        if header != '':
+            self.file.write(header)
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'. Anything not committed is thrown away."""
+        self.discard()
+
+    def write(self, line):
+        self.file.write(line)
+        self.lines_written += 1
+
+    def commit(self, filename):
+        """Close and atomically rename to filename, replacing any existing file"""
+        self.file.close()
+        os.replace(self.temp_filename, filename)
+        self.temp_filename = None
+
+    def discard(self):
+        """Close and delete temp file, if not already committed"""
+        if self.temp_filename is not None:
+            self.file.close()
+            os.remove(self.temp_filename)
+            self.temp_filename = None
@@ -4,50 +4,62 @@ Parses gpx file and creates new file. Any points less than 5m from previous poin
 Temperature data also excluded.
 New gpx named meaningfully, by activity type, date, tine and distance,
 Creates much smaller gpx that can be uploaded to outddorsgb
-Output splits data and activity metadata to csvs
+Output splits data to csvs, activity metadata to sqlite (see metadatastore)
+Adds each filtered track to the coverage heatmap (see heatmap)
+Garmin Connect, network and pyarrow dependencies, and the metadata store, caches and index,
+are only loaded when first used, so importing this to process local files is quick.
 @author: lawrence
 """
 
 
-import gpxpy
-import gpxpy.gpx
-from geopy.distance import distance
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
+import math
 import os
-import subprocess
 import json
-import requests
 import re
 import io
-import garmincredential
 import config
-from garminconnect import (
-    Garmin,
-    GarminConnectConnectionError,
-    GarminConnectTooManyRequestsError,
-    GarminConnectAuthenticationError,
-)
-from fit2gpx import Converter
 import zipfile
+import random
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import numpy
+from trackdistance import calculate_incremental_distances, find_farthest_point
+from track import Track
+from csvsink import CSVSink
+import columnar
+from localitycache import LocalityCache
+from ratelimit import TokenBucket
+from activityindex import ActivityIndex, SOURCE_GARMIN, SOURCE_LOCAL
+from metadatastore import MetadataStore, BATCH_SIZE
+import heatmap
+import hashlib
+import instrumentation
+import simplify
+import gpxwriter
+import splits
+from common import MILE, get_pace
 
 
 # Constants and definitions
-# Meters in a mile
-MILE = 1609
-SPLIT = 250
 # Only write points farther apart than this (meters)
 MINPOINTSEPARATION = 5
-# For splits data output
-split_csv_header = 'Date,Time,Split Time,Split Distance,Total Time,Total Distance,Pace,Pace(m:s)\n'
-split_csv_format_string = '%s,%s,%.0f,%s,%.0f,%.2f,%02d:%02d\n'
-
+# Increase when processing changes, so activities processed by an older version are processed again
+PROCESSING_VERSION = 1
 gpx_csv_header = 'Date,Time,Incr Time,Incr Distance,Total Distance,Speed(m/s)\n'
 gpx_csv_format_string = '%s,%f,%f,%f,%f\n'
 
 metadata_csv_name_format_string = '%sImport%sProcessGPX.csv'
-metadata_csv_header = 'Date,Time,Activity,Garmin ID,Distance,Duration,Location\n'
+metadata_store_name_format_string = '%sImport%sProcessGPX.sqlite'
 logfile_name_format_string = '%sImport%sProcessGPX.log'
+metrics_log_name_format_string = '%sImport%sProcessGPX.jsonl'
+# Log write buffer size (bytes)
+LOG_BUFFER_SIZE = 64 * 1024
+locality_cache_name_format_string = '%sImport%sLocalityCache.sqlite'
+geocoder_rate_limit_name_format_string = '%sImport%sGeocoderRateLimit.sqlite'
+activity_index_name_format_string = '%sImport%sActivityIndex.sqlite'
+heatmap_folder_name = 'Heatmap'
 
 
 def get_output_path(activity='', year=''):
@@ -62,22 +74,31 @@ def get_output_path(activity='', year=''):
         path = "/Users/lawre/OneDrive/Documents/GPSData/"
 
     if activity != '':
-        # Just create these if they don't exist
-        if not os.path.isdir(path + 'Activities' + os.sep + activity):
-            os.mkdir(path + 'Activities' + os.sep + activity)
-
+        # Just create these if they don't exist - parallel workers may be creating them too
         path += 'Activities' + os.sep + activity + os.sep + year + os.sep
-        if not os.path.isdir(path):
-            os.mkdir(path)
+        os.makedirs(path, exist_ok=True)
 
     return path
 
 
 class State:
-
+    """Status, written to log file, and structured records (eg metrics) written as json lines.
+    Log files are opened on first write and kept open, buffered, until closed.
+    """
     def __init__(self):
         self.status = 'Not started'
         self.logfile_name = logfile_name_format_string % (get_output_path(), os.sep)
+        self.metrics_log_name = metrics_log_name_format_string % (get_output_path(), os.sep)
+        self.logfile = None
+        self.metrics_log = None
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'."""
+        self.Close()
 
     def Update(self, status):
         self.status = status
@@ -87,80 +108,149 @@ class State:
         if status != '':
             self.status = status
         print(self.status)
-        with open(self.logfile_name, 'a') as logfile:
-            logfile.write('%s\t%s\n' % (datetime.now().strftime("%d-%m-%Y %H:%M:%S"), self.status))
-
-
-class MetadataCSV:
-    """Manages metadata csv.
-    File is only created if there is something to write.
+        if self.logfile is None:
+            self.logfile = open(self.logfile_name, 'a', buffering=LOG_BUFFER_SIZE)
+        self.logfile.write('%s\t%s\n' % (datetime.now().strftime("%d-%m-%Y %H:%M:%S"), self.status))
+
+    def Record(self, event, data):
+        """Write json line with time, event and everything in data"""
+        if self.metrics_log is None:
+            self.metrics_log = open(self.metrics_log_name, 'a', buffering=LOG_BUFFER_SIZE)
+        entry = {'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'event': event}
+        entry.update(data)
+        self.metrics_log.write(json.dumps(entry) + '\n')
+
+    def Close(self):
+        """Flush and close log files, and save any metadata not yet saved"""
+        if activity_metadata is not None:
+            activity_metadata.flush()
+        if self.logfile is not None:
+            self.logfile.close()
+            self.logfile = None
+        if self.metrics_log is not None:
+            self.metrics_log.close()
+            self.metrics_log = None
+
+
+# Everything needed for a row of metadata, can be passed between processes
+# bounds are (min latitude, max latitude, min longitude, max longitude)
+MetadataRecord = namedtuple('MetadataRecord', ['start_time', 'activity_type', 'activity_id', 'distance',
+                                               'duration', 'locality', 'bounds'],
+                            defaults=[None])
+
+
+def get_metadata_record(activity_id, activity_type, track):
+    """Metadata for activity
+    :type activity_id: str
+    :type activity_type: str
+    :type track: TrackData
+    """
+    return MetadataRecord(track.start_point.time.timestamp(),
+                          activity_type,
+                          activity_id,
+                          track.track_distance,
+                          track.last_point.time - track.start_point.time,
+                          track.get_locality_string(),
+                          track.bounds)
+
+
+class ActivityMetadata:
+    """Manages activity metadata, stored in sqlite - see metadatastore.
+    Metadata csv is no longer written, it is imported when the store is created
+    and can be exported with 'python metadatastore.py export'.
     """
     def __init__(self):
-        """Primarily initialises output filename"""
-        self.lines_written = 0
-        self.file = None
-        self.metadata_csv_filename = metadata_csv_name_format_string % (get_output_path(),
-                                                                        os.sep)
+        """Primarily initialises filenames"""
+        self.metadata_csv_filename = metadata_csv_name_format_string % (get_output_path(), os.sep)
+        self.store = MetadataStore(metadata_store_name_format_string % (get_output_path(), os.sep),
+                                   self.metadata_csv_filename)
+        # Records not yet added to columnar dataset, added in batches like the store
+        self.columnar_pending = []
 
     def __enter__(self):
         """To allow use of 'with'."""
         return self
 
     def write(self, activity_id, activity_type, track):
-        """Writes line to file.
-        If nothing written yet create the file and write header
+        """Add activity.
         :type activity_id: str
         :type activity_type: str
         :type track: TrackData
         """
+        self.write_record(get_metadata_record(activity_id, activity_type, track))
 
-        if not os.path.isfile(self.metadata_csv_filename):
-            self.file = io.open(self.metadata_csv_filename, 'a', encoding='utf-8')
-            self.file.write(metadata_csv_header)
-        elif self.lines_written == 0:
-            self.file = io.open(self.metadata_csv_filename, 'a', encoding='utf-8')
-
-        s = ('%s,%s,activity_%s,%d,%s,%s\n' % (time.strftime('%Y-%m-%d, %H:%M', time.localtime(track.start_point.time.timestamp())),
-                                                             activity_type,
-                                                             activity_id,
-                                                             track.track_distance,
-                                                             track.last_point.time - track.start_point.time,
-                                                             track.get_locality_string()))
-        self.file.write(s)
-        self.lines_written += 1
+    def write_record(self, record):
+        """Add activity. Saved in batches, call flush to make sure it's saved.
+        :type record: MetadataRecord
+        """
+        self.store.write_record(record)
+
+        # Also add to columnar dataset if configured
+        if config.columnar_format != '':
+            self.columnar_pending.append(record)
+            if len(self.columnar_pending) >= BATCH_SIZE:
+                self.flush_columnar()
+
+    def flush_columnar(self):
+        """Add pending records to columnar dataset"""
+        if len(self.columnar_pending) > 0:
+            columnar.write_metadata(get_output_path(), self.columnar_pending, config.columnar_format)
+            self.columnar_pending = []
+
+    def write_heatmap(self, activity_id, activity_type, pixels, gpx_path):
+        """Add activity to heatmap. Only used when processing local files directly, so that's the source.
+        :param pixels: pixel ids from heatmap.get_pixels
+        :param gpx_path: filtered gpx written for activity
+        """
+        get_heatmap().add(SOURCE_LOCAL, activity_id, activity_type, pixels, gpx_path)
 
-        return
+    def flush(self):
+        """Make sure everything written so far is saved"""
+        self.store.flush()
+        self.flush_columnar()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """"To allow use of 'with'."""
-        pass
+        self.flush_columnar()
+        self.store.close()
 
-    def __del__(self):
-        """File will only need closing if lines have been written."""
-        if self.lines_written > 0:
-            self.file.close()
 
+# Result of processing an activity in a worker, returned to the main process
+ProcessResult = namedtuple('ProcessResult', ['records', 'output_paths', 'content_hash', 'cache_hits', 'cache_misses',
+                                             'metrics', 'heatmap_updates'])
+
+
+class MetadataRecords:
+    """Collects metadata records instead of writing them.
+    Used by worker processes, records are returned to be written by a single writer.
+    """
+    def __init__(self):
+        self.records = []
+        # (activity_id, activity_type, pixels, gpx_path) to add to heatmap, by the writer, with the source
+        self.heatmap_updates = []
+
+    def write(self, activity_id, activity_type, track):
+        """Same as ActivityMetadata.write"""
+        self.records.append(get_metadata_record(activity_id, activity_type, track))
 
-def get_pace(time, distance):
-    """Calculate pace in minutes per mile"""
-    return time / 60 * MILE / distance
+    def write_heatmap(self, activity_id, activity_type, pixels, gpx_path):
+        """Same as ActivityMetadata.write_heatmap"""
+        self.heatmap_updates.append((activity_id, activity_type, pixels, gpx_path))
 
 
 class GPXData:
-    """"""
+    """Filtered gpx output.
+    Points to keep are worked out from the track arrays, gpx is only built when written.
+    Simplification depends on config.gpx_simplification.
+    """
     def __init__(self):
-        """Set up GPX"""
-        self.separation = 0
+        """Nothing kept yet"""
+        self.track = None
+        self.indices = numpy.zeros(0, dtype=numpy.int64)
         self.points_written = 0
-        self.stopped_seconds = 0
-
-        self.gpx = gpxpy.gpx.GPX()
-        # Create track
-        track = gpxpy.gpx.GPXTrack()
-        self.gpx.tracks.append(track)
-        # Create segment
-        segment = gpxpy.gpx.GPXTrackSegment()
-        track.segments.append(segment)
+        # Farthest any point is from the simplified track (meters), and size of file written
+        self.max_deviation = 0.0
+        self.bytes_written = 0
 
         return
 
@@ -168,133 +258,148 @@ class GPXData:
         """Nothing required."""
         pass
 
-    def process_point(self, point, distance):
-        """Increment distance, if complete split, write csv data and reset for next split"""
-        self.separation += distance
-        if self.separation >= MINPOINTSEPARATION:
-            # Create new point and add it
-            new_point = gpxpy.gpx.GPXTrackPoint()
-            new_point.latitude = point.latitude
-            new_point.longitude = point.longitude
-            new_point.time = point.time
-            new_point.elevation = point.elevation
-            # Only ever single track and segment
-            self.gpx.tracks[0].segments[0].points.append(new_point)
-            self.points_written += 1
-            # Reset distance
-            self.separation = 0
-
-            return
+    def process_track(self, track, incremental_distances):
+        """Work out which points to keep
+        :type track: Track
+        """
+        x, y = simplify.project(track.latitudes, track.longitudes)
+        if config.gpx_simplification == 'separation':
+            self.indices = self.get_separated_points(incremental_distances)
+            self.max_deviation = simplify.get_max_deviation(x, y, self.indices)
+        elif config.gpx_simplification == 'douglas_peucker':
+            self.indices, self.max_deviation = simplify.simplify(x, y, config.gpx_max_error, config.gpx_target_points)
+        else:
+            raise ValueError('Unknown gpx simplification: %s' % config.gpx_simplification)
+
+        self.track = track
+        self.points_written = len(self.indices)
+
+    @staticmethod
+    def get_separated_points(incremental_distances):
+        """Keep a point whenever MINPOINTSEPARATION has accumulated since the last one kept"""
+        indices = []
+        separation = 0
+        for i, distance in enumerate(incremental_distances.tolist()):
+            if i == 0:
+                continue
+            separation += distance
+            if separation >= MINPOINTSEPARATION:
+                indices.append(i)
+                # Reset distance
+                separation = 0
+
+        return numpy.array(indices, dtype=numpy.int64)
 
     def write(self, filename):
-        """Write to file"""
-        with open(filename + '.gpx', 'w') as gpx_file:
-            gpx_file.write(self.gpx.to_xml())
+        """Stream kept points to gpx file (gzipped if config.gpx_compress), returns filename written"""
+        filename = gpxwriter.write_gpx(filename, self.track, self.indices, config.gpx_compress)
+        self.bytes_written = os.path.getsize(filename)
+        return filename
 
 
 class Splits:
-    """Manages calculation and saving of split data
-    Initialised with first point, called for each point and adds csv data for splits.
+    """Manages calculation and saving of split data, for each distance in config.split_distances.
+    See splits for how they are calculated.
     """
-    def __init__(self, point):
+    def __init__(self, split_distances=None):
         """"""
-        self.start_point = point
-        self.split_distance = 0
-        self.csv_data = split_csv_header
-        self.track_start_time = point.time
-
-    def __del__(self):
-        """Nothing required."""
-        pass
+        self.split_distances = config.split_distances if split_distances is None else split_distances
+        self.tables = []
 
-    def process_point(self, point, distance, total_distance):
-        """Increment distance, if complete split, write csv data and reset for next split"""
-        self.split_distance += distance
-        if self.split_distance >= SPLIT:
-            split_time = point.time - self.start_point.time
-            pace = get_pace(split_time.seconds, self.split_distance)
-            # Pace output as decimal minutes and MM:SS
-            self.csv_data += split_csv_format_string % (time.strftime('%Y-%m-%d, %H:%M:%S', time.localtime(point.time.timestamp())),
-                                                        split_time,
-                                                        self.split_distance,
-                                                        point.time - self.track_start_time,
-                                                        total_distance,
-                                                        pace,
-                                                        int(pace),
-                                                        (pace % 1 * 60))
-            # Reset for next split - don't set distance to 0 to avoid cumulative errors
-            self.split_distance -= SPLIT
-            self.start_point = point
+    def process_track(self, track, incremental_distances, total_distances):
+        """Calculate splits for every distance, distances are precomputed for the whole track
+        :type track: Track
+        """
+        self.tables = splits.calculate_splits(track.times, total_distances, self.split_distances)
 
-        return
+    def get_filenames(self, filename):
+        """Output name for each split distance, without extension. First is just filename."""
+        return [filename if i == 0 else '%s_%dm' % (filename, split_distance)
+                for i, split_distance in enumerate(self.split_distances)]
 
     def write(self, filename):
-        """Write to file"""
-        with open(filename + '.csv', 'w') as file:
-            file.write(self.csv_data)
+        """Write csv for each split distance, returns filenames written"""
+        filenames = []
+        for split_filename, table in zip(self.get_filenames(filename), self.tables):
+            splits.write_csv(split_filename + '.csv', table)
+            filenames.append(split_filename + '.csv')
+        return filenames
+
+    def write_columnar(self, filename, file_format):
+        """Write columnar file for each split distance, returns filenames written"""
+        filenames = []
+        for split_filename, table in zip(self.get_filenames(filename), self.tables):
+            filenames.append(columnar.write_splits(split_filename, table, file_format))
+        return filenames
 
 
 class GPXcsv:
     """Manages csv output of gpx data
-    Initialised with first point, called for each point outputs csv data.
+    Streams csv data for every point in track to a temp file, renamed when written.
     """
-    def __init__(self, point):
+    def __init__(self):
         """"""
-        self.prev_point = point
-        self.total_distance = 0
-        self.csv_data = gpx_csv_header
+        self.csv_sink = CSVSink(get_output_path(), gpx_csv_header)
 
     def __del__(self):
-        """Nothing required."""
-        pass
+        """Temp file removed if not written."""
+        self.csv_sink.discard()
 
-    def process_point(self, point, incremental_distance):
-        """Increment distance, if complete split, write csv data and reset for next split"""
-        self.total_distance += incremental_distance
-        incremental_time = point.time - self.prev_point.time
-        # Pace output as decimal minutes and MM:SS
-        self.csv_data += gpx_csv_format_string % (time.strftime('%Y-%m-%d, %H:%M:%S', time.localtime(point.time.timestamp())),
-                                                    incremental_time.seconds,
-                                                    incremental_distance,
-                                                    self.total_distance,
-                                                    incremental_distance / incremental_time.seconds)
-        self.prev_point = point
+    def process_track(self, track, incremental_distances, total_distances):
+        """Add csv data for each point, distances are precomputed for the whole track
+        :type track: Track
+        """
+        times = track.times.tolist()
+        speed = 0.0
+        for i in range(1, len(times)):
+            incremental_time = times[i] - times[i - 1]
+            # Point with no time is written with an empty date and time
+            time_string = ', ' if math.isnan(times[i]) else \
+                time.strftime('%Y-%m-%d, %H:%M:%S', time.localtime(times[i]))
+            # Points with the same time keep the previous speed
+            if incremental_time != 0:
+                speed = incremental_distances[i] / incremental_time
+            self.csv_sink.write(gpx_csv_format_string % (time_string,
+                                                           incremental_time,
+                                                           incremental_distances[i],
+                                                           total_distances[i],
+                                                           speed))
 
         return
 
     def write(self, filename):
-        """Write to file"""
-        with open(filename + '.csv', 'w') as file:
-            file.write(self.csv_data)
+        """Rename temp file to filename"""
+        self.csv_sink.commit(filename + '.csv')
 
 class TrackData:
-    def __init__(self, point):
-        self.start_point = point
+    def __init__(self, track, total_distances):
+        """Summary of track, distances are precomputed for the whole track
+        :type track: Track
+        """
+        self.start_point = track.get_point(0)
+        self.last_point = track.get_point(len(track) - 1)
         # Farthest straight line distance from start
-        self.max_distance = 0
+        farthest_index, self.max_distance = find_farthest_point(track.latitudes, track.longitudes)
+        self.farthest_point = track.get_point(farthest_index)
         # Total distance covered
-        self.track_distance = 0
+        self.track_distance = total_distances[-1]
+        # Bounding box (min latitude, max latitude, min longitude, max longitude)
+        self.bounds = (float(track.latitudes.min()), float(track.latitudes.max()),
+                       float(track.longitudes.min()), float(track.longitudes.max()))
         # Private - always get via call
         self._locality_string = ''
 
-    def process_point(self, point, incremental_distance):
-        self.track_distance += incremental_distance
-        self.last_point = point
-        distance_from_start = calculate_distance(self.start_point, point)
-        if distance_from_start > self.max_distance:
-            self.max_distance = distance_from_start
-            self.farthest_point = point
-
-
     def get_locality_string(self):
         """Returns human readable location info
         If we already have it just return it.
         """
         if self._locality_string == '':
-            # Get info for start/end/farthest - remove any spaces, don't want them in filename
-            start_locality = get_locality(self.start_point.latitude, self.start_point.longitude).replace(' ', '')
-            end_locality = get_locality(self.last_point.latitude, self.last_point.longitude).replace(' ', '')
-            farthest_locality = get_locality(self.farthest_point.latitude, self.farthest_point.longitude).replace(' ', '')
+            # Get info for start/end/farthest together - remove any spaces, don't want them in filename
+            start_locality, end_locality, farthest_locality = [
+                locality.replace(' ', '') for locality in get_localities([(point.latitude, point.longitude)
+                                                                          for point in (self.start_point,
+                                                                                        self.last_point,
+                                                                                        self.farthest_point)])]
             # print('Start: %s, End: %s, Farthest: %s' % (start_town, end_town, farthest_town))
 
             # Might have been circular, in which case use farthest. Avoid repetition if all the same.
@@ -330,33 +435,77 @@ def get_activity_type(track):
     return activity
 
 
-def calculate_distance(point1, point2):
-    """Wrapper for distance calculation
-    Pass in gps points, return separation
+def get_localities(coordinates):
+    """Get locations for list of (latitude, longitude).
+    Offline gazetteer if configured, otherwise uses cached results where we have them for nearby
+    co-ordinates, and looks the rest up together. If a lookup fails falls back to the gazetteer,
+    if configured and there is one, otherwise ''.
     """
-    coord1 = (point1.latitude, point1.longitude)
-    coord2 = (point2.latitude, point2.longitude)
-
-    return distance(coord1, coord2).meters
+    with instrumentation.timer('geocode'):
+        if config.locality_source == 'gazetteer':
+            return [lookup_offline_locality(latitude, longitude) for latitude, longitude in coordinates]
+        localities = get_locality_cache().get_many(coordinates, lookup_localities)
+        for i, locality in enumerate(localities):
+            if locality is None:
+                instrumentation.count('geocode_failures')
+                if config.locality_fallback == 'gazetteer' and os.path.isfile(config.gazetteer_file):
+                    localities[i] = lookup_offline_locality(*coordinates[i])
+                else:
+                    localities[i] = ''
+        return localities
+
+
+def get_geocoder():
+    """Geocoder for this process, created on first use. Rate limit is shared with other processes."""
+    global geocoder
+    if geocoder is None:
+        from geocoder import Geocoder
+        geocoder = Geocoder(config.geocoder_url,
+                            config.geocoder_user_agent,
+                            config.geocoder_requests_per_second,
+                            (config.geocoder_connect_timeout, config.geocoder_read_timeout),
+                            config.geocoder_retries,
+                            rate_limit_filename=geocoder_rate_limit_name_format_string % (get_output_path(), os.sep))
+    return geocoder
+
+
+def lookup_localities(coordinates):
+    """Get locations for list of (latitude, longitude) from Open Street Map, concurrently.
+    Using street level (zoom = 16) and picking second item, gives more accurate result.
+    None where lookup failed.
+    """
+    instrumentation.count('geocode_requests', len(coordinates))
+    return [None if display_name is None else locality_from_display_name(display_name)
+            for display_name in get_geocoder().lookup_many(coordinates)]
 
 
-def get_locality(latitude, longitude):
-    """Get location from co-ordinates. Use Open Street Map.
-    Using street level (zoom = 16) and picking second item, gives more accurate result
+def lookup_offline_locality(latitude, longitude):
+    """Get location from co-ordinates using nearest place in local gazetteer.
+    Gazetteer is only loaded on first use.
     """
-    osm_request = "https://nominatim.openstreetmap.org/reverse?lat=%f&lon=%f&zoom=16&format=json"
-    result = subprocess.check_output(['curl', '-s', osm_request % (latitude, longitude)], creationflags=subprocess.CREATE_NO_WINDOW).decode("utf-8")
-    result_json = json.loads(result)
+    global gazetteer
+    if gazetteer is None:
+        from gazetteer import Gazetteer
+        gazetteer = Gazetteer(config.gazetteer_file)
+    place = gazetteer.nearest(latitude, longitude)
+    if place is None:
+        return ""
+    if place.display_name != '':
+        # Same as we'd get from Open Street Map
+        return locality_from_display_name(place.display_name)
+    return place.name
+
+
+def locality_from_display_name(display_name):
+    """Locality is second item of display name"""
     try:
-        location = re.split(',', result_json['display_name'])[1]
+        location = re.split(',', display_name)[1]
     except IndexError:
         location = ""
-    except KeyError:
-        location = ""
     return location
 
 
-def process_gpx(activity_id, gpx_xml):
+def process_gpx(activity_id, gpx_xml, metadata=None):
     """Process gpx data as follows:
     Filter gpx to only include points with >=5m separation and basic data only (lat, long, time, elev)
     Generate split data and (for run and cycle activities) write to csv
@@ -368,40 +517,52 @@ def process_gpx(activity_id, gpx_xml):
 
     :param activity_id: id of activity (eg garmin id or other identifier)
     :type activity_id: str
-    :param gpx_xml: gpx data
+    :param gpx_xml: gpx data - xml, open file or filename, it is streamed rather than parsed in one go
     :type gpx_xml: xml
+    :param metadata: where to write metadata, get_activity_metadata() if not specified
+    :type metadata: ActivityMetadata or MetadataRecords
+    :return: list of output files written, empty if nothing written
     """
-    # Variables
-    point_count = 0
-    total_distance = 0
-    output_gpx = GPXData()
-
-    # Parse to gpx and iterate through
-    input_gpx = gpxpy.parse(gpx_xml)
-    for track in input_gpx.tracks:
-        for segment in track.segments:
-            for point in segment.points:
-                point_count += 1
-                if point_count > 1:
-                    # Distance from last point
-                    incremental_distance = calculate_distance(previous_point, point)
-                    # print(str(incremental_distance) + ", " + time.strftime('%H:%M:%S', time.localtime(point.time.timestamp())))
-                    total_distance += incremental_distance
-                    # Manage split
-                    split_tracker.process_point(point, incremental_distance, total_distance)
-                    # Manage gpx
-                    output_gpx.process_point(point, incremental_distance)
-                    # Manage data
-                    track_data.process_point(point, incremental_distance)
-                    # csv output
-                    gpx_csv_data.process_point(point, incremental_distance)
-                else:
-                    # First time, set things up
-                    split_tracker = Splits(point)
-                    track_data = TrackData(point)
-                    gpx_csv_data = GPXcsv(point)
+    with instrumentation.timer('parse'):
+        track = Track.from_gpx(gpx_xml)
+    return process_track(activity_id, track, metadata)
 
-                previous_point = point
+
+def process_track(activity_id, track, metadata=None):
+    """Process track, as process_gpx
+    :type activity_id: str
+    :type track: Track
+    :type metadata: ActivityMetadata or MetadataRecords
+    :return: list of output files written, empty if nothing written
+    """
+    # Variables
+    output_paths = []
+    point_count = len(track)
+    if point_count == 0:
+        return output_paths
+
+    instrumentation.count('points', point_count)
+
+    # All distances calculated in one pass - see trackdistance for tolerance
+    with instrumentation.timer('distance'):
+        incremental_distances = calculate_incremental_distances(track.latitudes, track.longitudes)
+        total_distances = numpy.cumsum(incremental_distances)
+
+    # Manage split
+    with instrumentation.timer('splits'):
+        split_tracker = Splits()
+        split_tracker.process_track(track, incremental_distances, total_distances)
+    # Manage gpx
+    with instrumentation.timer('filter'):
+        output_gpx = GPXData()
+        output_gpx.process_track(track, incremental_distances)
+    # Manage data
+    with instrumentation.timer('farthest'):
+        track_data = TrackData(track, total_distances)
+    # csv output
+    with instrumentation.timer('points'):
+        gpx_csv_data = GPXcsv()
+        gpx_csv_data.process_track(track, incremental_distances, total_distances)
 
     # Save everything, but only if we actually have some data
     if output_gpx.points_written != 0:
@@ -412,27 +573,241 @@ def process_gpx(activity_id, gpx_xml):
                                                  (track_data.track_distance / MILE),
                                                  track_data.get_locality_string())
 
-        if activity_type == 'Run':
-            split_tracker.write(output_filename + '_split')
-        elif activity_type == 'Cycle':
-            gpx_csv_data.write(output_filename + '_points')
-        output_gpx.write(output_filename)
-        # Write metadata to csv
-        metadata_csv.write(activity_id, activity_type, track_data)
+        with instrumentation.timer('write'):
+            if activity_type == 'Run':
+                if not config.columnar_only:
+                    output_paths.extend(split_tracker.write(output_filename + '_split'))
+                if config.columnar_format != '':
+                    output_paths.extend(split_tracker.write_columnar(output_filename + '_split',
+                                                                     config.columnar_format))
+            elif activity_type == 'Cycle':
+                if not config.columnar_only:
+                    gpx_csv_data.write(output_filename + '_points')
+                    output_paths.append(output_filename + '_points.csv')
+                if config.columnar_format != '':
+                    output_paths.append(columnar.write_points(output_filename + '_points', track,
+                                                              incremental_distances, total_distances,
+                                                              config.columnar_format))
+            gpx_path = output_gpx.write(output_filename)
+            output_paths.append(gpx_path)
+        # Write metadata
+        if metadata is None:
+            metadata = get_activity_metadata()
+        metadata.write(activity_id, activity_type, track_data)
+        # Heatmap from points kept in filtered gpx, as written under Activities/<type>/<year>
+        if config.heatmap:
+            with instrumentation.timer('heatmap'):
+                metadata.write_heatmap(activity_id, activity_type,
+                                       heatmap.get_pixels(track.latitudes[output_gpx.indices],
+                                                          track.longitudes[output_gpx.indices],
+                                                          config.heatmap_zoom),
+                                       gpx_path)
 
         print('%s trackpoints written to %s' % (point_count, output_filename))
+        print('gpx: %d points, max deviation %.1fm, %.1fKB' % (output_gpx.points_written,
+                                                               output_gpx.max_deviation,
+                                                               output_gpx.bytes_written / 1024))
+        print('Track data %.1fKB' % (track.nbytes / 1024))
 
-    return
+    return output_paths
+
+
+def download_activity(client, activity_id, limiter, metrics):
+    """Download original (zipped FIT) data for activity.
+    Waits for rate limiter before each request, backs off and retries if Garmin says too many requests.
+    :type client: Garmin
+    :type limiter: TokenBucket
+    :type metrics: instrumentation.Metrics
+    """
+    from garminconnect import GarminConnectTooManyRequestsError
+    attempt = 0
+    while True:
+        with metrics.timer('rate_limit_wait'):
+            limiter.acquire()
+        try:
+            with metrics.timer('download'):
+                return client.download_activity(activity_id, dl_fmt=client.ActivityDownloadFormat.ORIGINAL)
+        except GarminConnectTooManyRequestsError:
+            metrics.count('download_retries')
+            if attempt >= config.garmin_retries:
+                raise
+            # Exponential backoff with a bit of jitter, applies to all downloads not just this one
+            delay = config.garmin_backoff_seconds * 2 ** attempt
+            limiter.pause(delay + random.uniform(0, config.garmin_backoff_seconds))
+            attempt += 1
+
+
+def convert_and_process(activity_id, fit_data, sub_path):
+    """Extract FIT from downloaded zip in memory, decode it to a track and process it.
+    Can run in a worker process. FIT file is archived in sub_path, nothing else is written there.
+    :rtype: ProcessResult
+    """
+    fit_name = '%d_ACTIVITY.fit' % activity_id
+    records = MetadataRecords()
+    cache = get_locality_cache()
+    hits = cache.hits
+    misses = cache.misses
+    # Only this activity's metrics are returned
+    instrumentation.take()
+    with zipfile.ZipFile(io.BytesIO(fit_data), 'r') as zip_ref:
+        fit_bytes = zip_ref.read(fit_name)
+    # Keep raw data
+    with instrumentation.timer('fit_archive'), open(sub_path + fit_name, 'wb') as fit_file:
+        fit_file.write(fit_bytes)
+    with instrumentation.timer('fit_decode'):
+        track = Track.from_fit(fit_bytes)
+    output_paths = process_track('%d' % activity_id, track, records)
+
+    return ProcessResult(records.records, output_paths, hashlib.sha256(fit_data).hexdigest(),
+                         cache.hits - hits, cache.misses - misses,
+                         instrumentation.take().to_dict(), records.heatmap_updates)
+
+
+def record_activity_metrics(status, source, activity_id, metrics, run_metrics):
+    """Log metrics for activity as json line, and add them to run totals
+    :type status: State
+    :type metrics: instrumentation.Metrics
+    :type run_metrics: instrumentation.Metrics
+    """
+    if instrumentation.enabled:
+        data = {'source': source, 'activity_id': str(activity_id)}
+        data.update(metrics.to_dict())
+        status.Record('activity', data)
+        run_metrics.add(metrics)
 
 
-metadata_csv = MetadataCSV()
+def get_activity_ids(activities):
+    """Ids of activities to download and process - recent activities not processed by this version
+    (or before the index existed), and any older activities processed by an earlier version.
+    :param activities: recent activities, as returned by client.get_activities
+    """
+    index = get_activity_index()
+    activity_ids = [activity["activityId"] for activity in activities
+                    if not index.is_current(SOURCE_GARMIN, activity["activityId"], PROCESSING_VERSION)]
+    # Reprocessed even if they're no longer among the most recent
+    listed = set(activity_ids)
+    for activity_id in index.get_outdated(SOURCE_GARMIN, PROCESSING_VERSION):
+        if int(activity_id) not in listed:
+            activity_ids.append(int(activity_id))
+    return activity_ids
+
+
+def download_and_process_activities(client, activity_ids, sub_path, status, run_metrics):
+    """Pipeline of concurrent downloads feeding a pool of processes that convert and process.
+    Downloads are rate limited. Metadata is written here, in activity_ids order.
+    Returns number of activities saved
+    :type client: Garmin
+    :type status: State
+    :type run_metrics: instrumentation.Metrics
+    """
+    activities_saved = 0
+    cache_hits = 0
+    cache_misses = 0
+    limiter = TokenBucket(config.garmin_requests_per_second)
+    # Downloads run in threads, each records into its own activity's metrics
+    activity_metrics = {activity_id: instrumentation.Metrics() for activity_id in activity_ids}
+    with ThreadPoolExecutor(max_workers=config.garmin_download_workers) as downloads, \
+            ProcessPoolExecutor(max_workers=config.garmin_process_workers) as processing:
+        download_futures = {downloads.submit(download_activity, client, activity_id, limiter,
+                                             activity_metrics[activity_id]): activity_id
+                            for activity_id in activity_ids}
+        # Start processing each activity as soon as it is downloaded
+        process_futures = {}
+        for future in as_completed(download_futures):
+            activity_id = download_futures[future]
+            try:
+                fit_data = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                status.Write('Download of activity %d failed: %s' % (activity_id, err))
+                record_activity_metrics(status, SOURCE_GARMIN, activity_id, activity_metrics[activity_id], run_metrics)
+                continue
+            process_futures[activity_id] = processing.submit(convert_and_process, activity_id, fit_data, sub_path)
+
+        for activity_id in activity_ids:
+            if activity_id not in process_futures:
+                continue
+            try:
+                result = process_futures[activity_id].result()
+            except Exception as err:  # pylint: disable=broad-except
+                status.Write('Processing of activity %d failed: %s' % (activity_id, err))
+                record_activity_metrics(status, SOURCE_GARMIN, activity_id, activity_metrics[activity_id], run_metrics)
+                continue
+            # Metadata is saved a batch at a time, and the rest below
+            for record in result.records:
+                get_activity_metadata().write_record(record)
+            for update in result.heatmap_updates:
+                get_heatmap().add(SOURCE_GARMIN, *update)
+            get_activity_index().record(SOURCE_GARMIN, activity_id, result.content_hash, result.output_paths,
+                                  PROCESSING_VERSION)
+            cache_hits += result.cache_hits
+            cache_misses += result.cache_misses
+            activities_saved += 1
+            activity_metrics[activity_id].add(result.metrics)
+            record_activity_metrics(status, SOURCE_GARMIN, activity_id, activity_metrics[activity_id], run_metrics)
+
+    get_activity_metadata().flush()
+    status.Write('Locality cache: %d hits, %d misses' % (cache_hits, cache_misses))
+    return activities_saved
+
+
+def get_activity_metadata():
+    """Metadata store for this process, created on first use"""
+    global activity_metadata
+    if activity_metadata is None:
+        activity_metadata = ActivityMetadata()
+    return activity_metadata
+
+
+def get_locality_cache():
+    """Locality cache for this process, created on first use"""
+    global locality_cache
+    if locality_cache is None:
+        locality_cache = LocalityCache(locality_cache_name_format_string % (get_output_path(), os.sep),
+                                       config.locality_cache_cell_size,
+                                       config.locality_cache_ttl_days * 24 * 60 * 60,
+                                       config.locality_cache_max_entries)
+    return locality_cache
+
+
+def get_activity_index():
+    """Activity index for this process, created on first use"""
+    global activity_index
+    if activity_index is None:
+        activity_index = ActivityIndex(activity_index_name_format_string % (get_output_path(), os.sep),
+                                       metadata_csv_name_format_string % (get_output_path(), os.sep))
+    return activity_index
+
+
+def get_heatmap():
+    """Heatmap for this process, created on first use"""
+    global heatmap_store
+    if heatmap_store is None:
+        heatmap_store = heatmap.Heatmap(get_output_path() + heatmap_folder_name, config.heatmap_zoom)
+    return heatmap_store
+
+
+# Created on first use, see functions above
+activity_metadata = None
+locality_cache = None
+activity_index = None
+heatmap_store = None
+gazetteer = None
+geocoder = None
 
 if __name__ == "__main__":
+    import garmincredential
+    from garminconnect import (
+        Garmin,
+        GarminConnectConnectionError,
+        GarminConnectTooManyRequestsError,
+        GarminConnectAuthenticationError,
+    )
+
     # Don't necessarily want to download everything
     max_activities = config.max_activities
-    activities_saved = 0
     status = State()
-    conv = Converter()
+    start_time = time.time()
+    run_metrics = instrumentation.Metrics()
 
     print("Download activities from Garmin Connect.")
     try:
@@ -445,34 +820,21 @@ if __name__ == "__main__":
             GarminConnectTooManyRequestsError
     ) as err:
         status.Write("Error occurred during Garmin Connect Client init: %s" % err)
+        status.Close()
         quit()
     except Exception:  # pylint: disable=broad-except
         status.Write("Unknown error occurred during Garmin Connect Client init")
+        status.Close()
         quit()
 
-    for activity in activities:
-        activity_id = activity["activityId"]
-        sub_path = config.local_path + 'Import' + os.sep + "Raw" + os.sep  
-        output_zip = '%sactivity.zip' % sub_path
-        output_fit = '%s%d_ACTIVITY.fit' % (sub_path, activity_id)
-        output_gpx = '%sactivity.gpx' % sub_path
-        # Only save and process if file not already saved from previous download
-        if not os.path.isfile(output_fit):
-            # Download the Garmin FIT file
-            fit_data = client.download_activity(activity_id, dl_fmt=client.ActivityDownloadFormat.ORIGINAL)
-            # Save it
-            with open(output_zip, 'wb') as zip_file:
-                zip_file.write(fit_data)
-            # Extract fit data
-            with zipfile.ZipFile(output_zip, 'r') as zip_ref:
-                zip_ref.extract('%d_ACTIVITY.fit' % activity_id, sub_path)
-            # Convert to gpx
-            conv.fit_to_gpx(f_in=output_fit, f_out=output_gpx)
-            with open(output_gpx, 'r') as gpx_file:
-                process_gpx('%d' % activity_id, gpx_file)
-            activities_saved += 1
-            # Clean up
-            os.remove(output_zip)
-            os.remove(output_gpx)
+    sub_path = config.local_path + 'Import' + os.sep + "Raw" + os.sep
+    activity_ids = get_activity_ids(activities)
+    activities_saved = download_and_process_activities(client, activity_ids, sub_path, status, run_metrics)
 
     status.Write('Activities saved: %d' % activities_saved)
+    if instrumentation.enabled:
+        elapsed = time.time() - start_time
+        status.Record('run', {'elapsed': elapsed, 'activities': activities_saved, **run_metrics.to_dict()})
+        print(run_metrics.get_summary(elapsed))
+    get_activity_metadata().store.close()
+    status.Close()
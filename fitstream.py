@@ -0,0 +1,50 @@
+"""
+Decode FIT activity data straight to track arrays, without converting to gpx first.
+Gives the same points as fit2gpx: record messages that have a position, with
+enhanced_altitude used for elevation only if no record has a plain altitude.
+@author: lawrence
+"""
+
+import io
+import numpy
+import fitdecode
+
+# FIT positions are in semicircles
+SEMICIRCLES_PER_DEGREE = 2 ** 32 / 360
+
+
+def read_fit(source):
+    """Decode track points from FIT data.
+    Source can be a filename, an open binary file or the data itself (bytes).
+    Returns (latitudes, longitudes, elevations, times) - float64 arrays, times in
+    epoch seconds, with nan for missing elevation or time, as gpxstream.iter_chunks.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    latitudes = []
+    longitudes = []
+    altitudes = []
+    enhanced_altitudes = []
+    times = []
+    with fitdecode.FitReader(source) as fit_file:
+        for frame in fit_file:
+            if not isinstance(frame, fitdecode.FitDataMessage) or frame.name != 'record':
+                continue
+            latitude = frame.get_value('position_lat', fallback=None)
+            longitude = frame.get_value('position_long', fallback=None)
+            if latitude is None or longitude is None:
+                # No position (eg indoors or before GPS fix)
+                continue
+            latitudes.append(latitude / SEMICIRCLES_PER_DEGREE)
+            longitudes.append(longitude / SEMICIRCLES_PER_DEGREE)
+            altitudes.append(frame.get_value('altitude', fallback=None))
+            enhanced_altitudes.append(frame.get_value('enhanced_altitude', fallback=None))
+            timestamp = frame.get_value('timestamp', fallback=None)
+            times.append(numpy.nan if timestamp is None else timestamp.timestamp())
+
+    if all(altitude is None for altitude in altitudes):
+        altitudes = enhanced_altitudes
+    return (numpy.array(latitudes, dtype=numpy.float64),
+            numpy.array(longitudes, dtype=numpy.float64),
+            numpy.array([numpy.nan if altitude is None else altitude for altitude in altitudes], dtype=numpy.float64),
+            numpy.array(times, dtype=numpy.float64))
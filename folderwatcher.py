@@ -0,0 +1,171 @@
+"""
+Watches a folder for new files, so they can be processed as soon as they arrive.
+Uses inotify (via inotify_simple) where available, otherwise polls the folder.
+With inotify a file is ready as soon as it's closed after writing, or moved into the folder.
+Files already there when watching starts are only ready once their size and modification time
+have stayed the same for settle seconds, so files still being written or copied aren't picked up
+part written.
+When polling there's nothing to say a file has been closed, so every file waits for the much
+shorter poll_settle instead, to keep a file's latency under a second. Its size and modification
+time are checked again before it's returned, but a copy that stalls for longer than poll_settle
+can still be picked up part written.
+Hidden files (eg '.' temp files) are ignored.
+inotify_simple is optional, without it the folder is polled.
+@author: lawrence
+"""
+
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+# Defaults (seconds) - time a file must be unchanged, with inotify and when polling, and time between scans
+SETTLE = 3.0
+POLL_SETTLE = 0.3
+POLL_INTERVAL = 0.5
+
+
+class FolderWatcher:
+    """Files ending with extension in path, returned by wait() when ready.
+    Each version of a file is only returned once - a file left in the folder (eg it failed)
+    isn't returned again unless it changes.
+    """
+    def __init__(self, path, extension, settle=SETTLE, poll_interval=POLL_INTERVAL, use_inotify=True,
+                 poll_settle=POLL_SETTLE):
+        self.path = path
+        self.extension = extension
+        self.settle = settle
+        self.poll_interval = poll_interval
+        # path: ((size, mtime), time first seen like that) for files not yet ready
+        self.pending = {}
+        # path: (size, mtime) of files returned
+        self.returned = {}
+        self.inotify = None
+        if use_inotify and inotify_simple is not None:
+            flags = inotify_simple.flags
+            self.inotify = inotify_simple.INotify()
+            self.inotify.add_watch(path, flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM)
+        else:
+            self.settle = poll_settle
+        # Anything already there
+        self.scan()
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'."""
+        self.close()
+
+    def is_candidate(self, name):
+        return name.endswith(self.extension) and not name.startswith('.')
+
+    def scan(self):
+        """Check every file in folder"""
+        names = [entry.name for entry in os.scandir(self.path) if entry.is_file()]
+        for name in names:
+            self.check(os.path.join(self.path, name))
+        # Forget files that have gone (eg moved once processed)
+        present = set(os.path.join(self.path, name) for name in names)
+        for path in [path for path in list(self.returned) + list(self.pending) if path not in present]:
+            self.forget(path)
+
+    def check(self, path, written=False):
+        """Note size and modification time of file, restarting its settle time if they've changed.
+        :param written: file has been closed after writing (or moved in), so is ready now
+        """
+        if not self.is_candidate(os.path.basename(path)):
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.forget(path)
+            return
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if self.returned.get(path) == signature:
+            return
+        if written:
+            self.pending[path] = (signature, time.monotonic() - self.settle)
+        elif path not in self.pending or self.pending[path][0] != signature:
+            self.pending[path] = (signature, time.monotonic())
+
+    def forget(self, path):
+        """File has gone (eg moved once processed)"""
+        self.pending.pop(path, None)
+        self.returned.pop(path, None)
+
+    def handle_events(self, events):
+        """Check files inotify says are written, forget those removed"""
+        flags = inotify_simple.flags
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                # Events lost
+                self.scan()
+            elif not event.name:
+                continue
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                self.forget(os.path.join(self.path, event.name))
+            else:
+                self.check(os.path.join(self.path, event.name), written=True)
+
+    def get_queue_depth(self):
+        """Files seen but not yet returned"""
+        return len(self.pending)
+
+    def get_ready(self):
+        """Files unchanged for settle seconds, in name order. They won't be returned again unless changed."""
+        now = time.monotonic()
+        ready = []
+        for path, (signature, since) in list(self.pending.items()):
+            if now - since < self.settle:
+                continue
+            # Check again, it may have changed without us being told
+            self.check(path)
+            if path in self.pending and self.pending[path][1] == since:
+                ready.append(path)
+                self.returned[path] = signature
+                del self.pending[path]
+        return sorted(ready)
+
+    def get_timeout(self):
+        """Seconds until a pending file could be ready, or to next poll"""
+        if self.inotify is None:
+            timeout = self.poll_interval
+        else:
+            timeout = None
+        now = time.monotonic()
+        for _, since in self.pending.values():
+            remaining = max(since + self.settle - now, 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def wait(self, timeout=None):
+        """Wait until files are ready or timeout (seconds, None for no limit) expires.
+        Returns list of paths ready, may be empty.
+        """
+        end_time = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ready = self.get_ready()
+            if len(ready) > 0:
+                return ready
+            wait_time = self.get_timeout()
+            if end_time is not None:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    return ready
+                wait_time = remaining if wait_time is None else min(wait_time, remaining)
+            if self.inotify is None:
+                time.sleep(wait_time)
+                self.scan()
+            else:
+                self.handle_events(self.inotify.read(timeout=None if wait_time is None
+                                                     else int(wait_time * 1000) + 1))
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
@@ -0,0 +1,92 @@
+"""
+Offline reverse geocoding from a local gazetteer file.
+Gazetteer is a csv with Name, Latitude and Longitude columns, and optionally
+DisplayName in the same comma separated form as Open Street Map's display_name.
+Places are held in a grid of cell_size degree buckets so nearest place lookups
+only need to check a handful of nearby buckets.
+@author: lawrence
+"""
+
+import csv
+import math
+from collections import namedtuple
+from common import METERS_PER_DEGREE
+
+# Grid bucket size in degrees
+CELL_SIZE = 0.1
+
+Place = namedtuple('Place', ['name', 'latitude', 'longitude', 'display_name'])
+
+
+class Gazetteer:
+    """Places loaded from file into a grid index"""
+    def __init__(self, filename, cell_size=CELL_SIZE):
+        """Load gazetteer file and build index"""
+        self.cell_size = cell_size
+        self.places = []
+        self.grid = {}
+        # Extent of grid, in cells
+        self.min_cell = None
+        self.max_cell = None
+        with open(filename, 'r', encoding='utf-8', newline='') as file:
+            for row in csv.DictReader(file):
+                self.add(Place(row['Name'],
+                               float(row['Latitude']),
+                               float(row['Longitude']),
+                               row.get('DisplayName', '')))
+
+    def add(self, place):
+        """Add place to list and grid"""
+        cell = self.get_cell(place.latitude, place.longitude)
+        self.places.append(place)
+        self.grid.setdefault(cell, []).append(place)
+        if self.min_cell is None:
+            self.min_cell = cell
+            self.max_cell = cell
+        else:
+            self.min_cell = (min(self.min_cell[0], cell[0]), min(self.min_cell[1], cell[1]))
+            self.max_cell = (max(self.max_cell[0], cell[0]), max(self.max_cell[1], cell[1]))
+
+    def get_cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size)
+
+    def nearest(self, latitude, longitude):
+        """Return nearest Place, or None if gazetteer is empty.
+        Searches rings of cells outwards until no closer place is possible.
+        """
+        if len(self.grid) == 0:
+            return None
+
+        lat_cell, lon_cell = self.get_cell(latitude, longitude)
+        cos_lat = math.cos(math.radians(latitude))
+        # Rings needed to cover every cell in the grid
+        max_ring = max(lat_cell - self.min_cell[0], self.max_cell[0] - lat_cell,
+                       lon_cell - self.min_cell[1], self.max_cell[1] - lon_cell)
+        best_place = None
+        best_distance = math.inf
+        for ring in range(max_ring + 1):
+            # Closest any point in this ring can be
+            if (ring - 1) * self.cell_size * METERS_PER_DEGREE * cos_lat > best_distance:
+                break
+            for cell in ring_cells(lat_cell, lon_cell, ring):
+                for place in self.grid.get(cell, ()):
+                    place_distance = math.hypot((place.latitude - latitude) * METERS_PER_DEGREE,
+                                                (place.longitude - longitude) * METERS_PER_DEGREE * cos_lat)
+                    if place_distance < best_distance:
+                        best_distance = place_distance
+                        best_place = place
+
+        return best_place
+
+
+def ring_cells(lat_cell, lon_cell, ring):
+    """Cells on the perimeter of the square ring cells out from centre"""
+    if ring == 0:
+        yield lat_cell, lon_cell
+        return
+    for j in range(lon_cell - ring, lon_cell + ring + 1):
+        yield lat_cell - ring, j
+        yield lat_cell + ring, j
+    for i in range(lat_cell - ring + 1, lat_cell + ring):
+        yield i, lon_cell - ring
+        yield i, lon_cell + ring
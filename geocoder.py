@@ -0,0 +1,112 @@
+"""
+Reverse geocoding client for Nominatim (Open Street Map), or anything serving the same API.
+Requests go through a pooled keep-alive session, so connections (and TLS) are reused
+between lookups, and several lookups can run at once. Every request, including retries,
+waits for the rate limiter, which is shared by all processes if given a rate_limit_filename,
+so the service's rate limit is kept however many are running. Failed lookups return None,
+leaving the caller to fall back to something else.
+base_url can point at a local server for testing.
+@author: lawrence
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from ratelimit import SharedRateLimiter, TokenBucket
+
+# Defaults - Nominatim allows 1 request per second, and needs a user agent that identifies the application
+BASE_URL = 'https://nominatim.openstreetmap.org/reverse'
+USER_AGENT = 'filtergpx'
+REQUESTS_PER_SECOND = 1.0
+# Connect and read timeouts (seconds)
+TIMEOUT = (5, 10)
+RETRIES = 2
+MAX_WORKERS = 3
+# Responses that say try again later
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Backoff before first retry (seconds), doubled each time, if the response doesn't give a Retry-After
+BACKOFF_SECONDS = 1
+
+
+def get_backoff(response, attempt):
+    """Seconds to wait before retrying, from Retry-After (seconds form) if there is one"""
+    retry_after = None if response is None else response.headers.get('Retry-After', '')
+    if retry_after is not None and retry_after.strip().isdigit():
+        return int(retry_after)
+    return BACKOFF_SECONDS * 2 ** attempt
+
+
+class Geocoder:
+    """Looks up display names for co-ordinates.
+    Street level (zoom = 16), where second item of display name is the locality.
+    """
+    def __init__(self, base_url=BASE_URL, user_agent=USER_AGENT, requests_per_second=REQUESTS_PER_SECOND,
+                 timeout=TIMEOUT, retries=RETRIES, max_workers=MAX_WORKERS, rate_limit_filename=None):
+        """
+        :param rate_limit_filename: database shared by processes for the rate limit, None for this geocoder only
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.max_workers = max_workers
+        if rate_limit_filename is None:
+            self.limiter = TokenBucket(requests_per_second)
+        else:
+            self.limiter = SharedRateLimiter(rate_limit_filename, requests_per_second)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent
+        # Retries are done in lookup, not by urllib3, so each one waits for the rate limiter
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = None
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'."""
+        self.close()
+
+    def lookup(self, latitude, longitude):
+        """Display name for co-ordinates, '' if there isn't one, None if lookup failed.
+        Connection errors and responses that say try again later are retried, after pausing
+        every request for the backoff.
+        """
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                response = self.session.get(self.base_url,
+                                            params={'lat': '%f' % latitude, 'lon': '%f' % longitude,
+                                                    'zoom': 16, 'format': 'json'},
+                                            timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                response = None
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                try:
+                    response.raise_for_status()
+                    return response.json().get('display_name', '')
+                except (requests.RequestException, ValueError):
+                    return None
+            if attempt < self.retries:
+                self.limiter.pause(get_backoff(response, attempt))
+        return None
+
+    def lookup_many(self, coordinates):
+        """Display names for list of (latitude, longitude), looked up concurrently.
+        Results are in the same order, None where lookup failed.
+        """
+        if len(coordinates) <= 1:
+            return [self.lookup(latitude, longitude) for latitude, longitude in coordinates]
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return list(self.executor.map(lambda coordinate: self.lookup(*coordinate), coordinates))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.session.close()
+        if isinstance(self.limiter, SharedRateLimiter):
+            self.limiter.close()
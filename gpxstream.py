@@ -0,0 +1,111 @@
+"""
+Streaming gpx reader.
+Parses gpx incrementally and yields track points as they are read, so the full
+document and a gpxpy object for every point are never held in memory.
+Points are (latitude, longitude, elevation, time) tuples, with attribute names
+matching gpxpy track points so they can be used in place of them.
+Files ending .gz are read through gzip.
+@author: lawrence
+"""
+
+from collections import namedtuple
+import gzip
+from datetime import datetime
+from itertools import islice
+import xml.etree.ElementTree as ElementTree
+import numpy
+
+# Amount read from file per parser feed
+READ_SIZE = 64 * 1024
+# Points per chunk for iter_chunks
+CHUNK_SIZE = 10000
+
+GPXPoint = namedtuple('GPXPoint', ['latitude', 'longitude', 'elevation', 'time'])
+
+
+def _local_name(tag):
+    """Strip namespace from tag"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _parse_time(text):
+    """gpx times are ISO 8601, usually UTC with a 'Z' suffix"""
+    if text is None:
+        return None
+    return datetime.fromisoformat(text.strip())
+
+
+def _read_blocks(source):
+    """Yield blocks of data from a filename (gzip compressed if it ends .gz), file object, or gpx xml string"""
+    if hasattr(source, 'read'):
+        while True:
+            block = source.read(READ_SIZE)
+            if not block:
+                break
+            yield block
+    elif isinstance(source, (str, bytes)) and source.lstrip()[:1] in ('<', b'<'):
+        # Already xml
+        yield source
+    else:
+        with (gzip.open if str(source).endswith('.gz') else open)(source, 'rb') as file:
+            while True:
+                block = file.read(READ_SIZE)
+                if not block:
+                    break
+                yield block
+
+
+def iter_points(source):
+    """Yield a GPXPoint for every track point in source.
+    Source can be a filename, an open file or gpx xml.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    segment = None
+    for block in _read_blocks(source):
+        parser.feed(block)
+        for event, element in parser.read_events():
+            tag = _local_name(element.tag)
+            if event == 'start':
+                if tag == 'trkseg':
+                    segment = element
+                continue
+            if tag == 'trkpt':
+                elevation = None
+                point_time = None
+                for child in element:
+                    child_tag = _local_name(child.tag)
+                    if child_tag == 'ele' and child.text:
+                        elevation = float(child.text)
+                    elif child_tag == 'time':
+                        point_time = _parse_time(child.text)
+                yield GPXPoint(float(element.get('lat')), float(element.get('lon')), elevation, point_time)
+                # Discard point so memory use stays flat
+                if segment is not None:
+                    segment.remove(element)
+            elif tag == 'trkseg':
+                segment = None
+    parser.close()
+
+
+def iter_point_chunks(source, size=CHUNK_SIZE):
+    """Yield track points in lists of up to size GPXPoints"""
+    points = iter_points(source)
+    while True:
+        chunk = list(islice(points, size))
+        if len(chunk) == 0:
+            break
+        yield chunk
+
+
+def iter_chunks(source, size=CHUNK_SIZE):
+    """Yield track points in chunks of arrays.
+    Each chunk is (latitudes, longitudes, elevations, times) - float64 arrays,
+    times in epoch seconds, with nan for missing elevation or time.
+    """
+    for chunk in iter_point_chunks(source, size):
+        yield (numpy.array([point.latitude for point in chunk], dtype=numpy.float64),
+               numpy.array([point.longitude for point in chunk], dtype=numpy.float64),
+               numpy.array([numpy.nan if point.elevation is None else point.elevation for point in chunk],
+                           dtype=numpy.float64),
+               numpy.array([numpy.nan if point.time is None else point.time.timestamp() for point in chunk],
+                           dtype=numpy.float64))
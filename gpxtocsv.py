@@ -1,99 +1,48 @@
 '''
 Created on 9 Jan 2021
-
+Usage: python gpxtocsv.py [file.gpx] [split distance (m) ...]
+A csv is written for each split distance, see splits for how they are calculated.
 @author: lawrence
 '''
-import gpxpy
-import gpxpy.gpx
-import geopy
-from geopy.distance import distance
-import datetime
+from track import Track
+from trackdistance import calculate_incremental_distances
+import splits
+from common import MILE, get_pace
+import numpy
 import os
+import sys
 
 # Constants to decide frequency of data output
-MILE = 1609
 HALF_MILE = MILE / 2
 QUARTER_MILE = MILE / 4
-# A record will be output every SPLIT distance (meters) 
-SPLIT = 250 
+# A record will be output every SPLIT distance (meters), unless distances given on command line
+SPLIT = 250
 
-# Input / output files
+# Input / output files - input file can be given on command line, output goes in same folder
 Path = '/Users/lawrence/Downloads/'
 InputFile = Path + 'activity_6121180269.gpx'
-# Temporary output File - don't know real name yet
-TempFileName = Path + 'gpxtocsv-temp.csv'
-# CSV header
-Header = 'Date,Time,Split Time,Split Distance,Total Time,Total Distance,Pace,Pace(m:s)\n'
-# Formatting for csv data output
-FormatString = '%s,%s,%s,%.0f,%s,%.0f,%.2f,%02d:%02d\n' 
-
-# Other variables
-PointCount = 0
-PreviousCoord = (0.0,0.0)
-IncrementalDistance = 0
-TotalDistance = 0
-PreviousTime = 0
-TotalTime = 0
-StartTime = datetime.time(0, 0, 0)
-SplitDistance = 0
-LinesWritten = 0
-
-# Open Source File
-GPXFile = open(InputFile, 'r')
-gpx = gpxpy.parse(GPXFile)
-
-# Open temp output file and write header
-OutputFile = open(TempFileName, 'w')
-OutputFile.write(Header) 
-
-# Parse file to extract data
-for track in gpx.tracks:
-    for segment in track.segments:
-        for point in segment.points:
-            PointCount += 1
-            if PointCount > 1:
-                # Position and distance
-                CurrentCoord = (point.latitude, point.longitude)
-                IncrementalDistance = distance (CurrentCoord, PreviousCoord).m
-                SplitDistance += IncrementalDistance
-                TotalDistance += IncrementalDistance
-                # Time
-                SplitTime += point.time - PreviousTime
-                TotalTime = point.time - StartTime
-
-            else:
-                # First time just set things up
-                StartTime = point.time
-                SplitDistance = 0
-                SplitTime = datetime.timedelta(0, 0, 0)
-                
-            PreviousCoord = (point.latitude, point.longitude)
-            PreviousTime = point.time
-            
-            if SplitDistance >= SPLIT:
-                # Calculate minutes per mile
-                Pace = SplitTime.seconds / 60 * MILE / SPLIT
-                # Write to csv. Pace output as decimal minutes and MM:SS 
-                s = FormatString % (point.time.strftime('%Y-%m-%d'),
-                                    point.time.strftime('%H:%M:%S'), 
-                                    SplitTime, 
-                                    SplitDistance, 
-                                    TotalTime, 
-                                    TotalDistance, 
-                                    Pace, 
-                                    int(Pace), (Pace % 1 * 60))
-#                print(s)
-                OutputFile.write(s)
-                LinesWritten += 1
-                # Reset for next split
-                SplitDistance -= SPLIT
-                SplitTime = datetime.timedelta(0, 0, 0)
-#            print('Point: ', PointCount, ' ', DateTime.strftime('%Y-%m-%d'), ', ', IncrementalTime, ', ', TotalTime, ', ' "%.1f" % IncrementalDistance, 'm, ', "%.0f" % TotalDistance, 'm' )
-
-OutputFile.close()
+if len(sys.argv) > 1:
+    InputFile = sys.argv[1]
+    Path = os.path.dirname(os.path.abspath(InputFile)) + os.sep
+SplitDistances = [SPLIT]
+if len(sys.argv) > 2:
+    SplitDistances = [float(SplitDistance) for SplitDistance in sys.argv[2:]]
+# Formatting for csv Date,Time (UTC)
+TimeFormat = '%Y-%m-%d,%H:%M:%S'
+
+# Read whole track and calculate distances in one go
+InputTrack = Track.from_gpx(InputFile)
+IncrementalDistances = calculate_incremental_distances(InputTrack.latitudes, InputTrack.longitudes)
+TotalDistances = numpy.cumsum(IncrementalDistances)
+TotalDistance = TotalDistances[-1]
+TotalTime = int(InputTrack.times[-1] - InputTrack.times[0])
+StartTime = InputTrack.get_time(0)
+
+# Splits for every distance together
+SplitTables = splits.calculate_splits(InputTrack.times, TotalDistances, SplitDistances)
 
 # Now work out what we are calling output file
-AveragePace = TotalTime.seconds / 60 * MILE / TotalDistance
+AveragePace = get_pace(TotalTime, TotalDistance)
 if AveragePace > 12:
     Activity = 'Hike'
 elif AveragePace > 7:
@@ -103,13 +52,11 @@ elif AveragePace > 2.5:
 else:
     Activity = 'Unknown'
 
-OutputFileName = '%s%s_%s_%dMile.csv' % (Path, Activity, StartTime.strftime('%Y-%m-%d_%H%M'), (TotalDistance / MILE))
-# If output file already exists delete it
-if os.path.isfile(OutputFileName):
-    os.remove(OutputFileName)
-# Rename temporary file
-os.rename(TempFileName, OutputFileName)
-
-print('%d lines written to %s' % (LinesWritten, OutputFileName))
+OutputFileName = '%s%s_%s_%dMile' % (Path, Activity, StartTime.strftime('%Y-%m-%d_%H%M'), (TotalDistance / MILE))
+for i, (SplitDistance, SplitTable) in enumerate(zip(SplitDistances, SplitTables)):
+    # First distance has the same name as always, others have distance added
+    FileName = OutputFileName + ('.csv' if i == 0 else '_%dm.csv' % SplitDistance)
+    # Written to temporary file and renamed, replacing any existing file
+    LinesWritten = splits.write_csv(FileName, SplitTable, TimeFormat, utc=True)
+    print('%d lines written to %s' % (LinesWritten, FileName))
 # print('Distance: %.2fkm, Time %s' % ((TotalDistance/1000), TotalTime))
-
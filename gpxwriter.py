@@ -0,0 +1,92 @@
+"""
+Streaming GPX 1.1 writer for track arrays.
+Writes a minimal document - one track, one segment, lat, lon, ele and time for each point -
+straight to the file a chunk of points at a time, rather than building gpxpy objects
+and rendering the whole document as one string. Numbers and times are formatted the same
+as gpxpy, so the output is the same apart from the creator.
+Optionally gzip compressed.
+@author: lawrence
+"""
+
+import gzip
+import numpy
+from common import atomic_write
+
+# Points formatted and written at a time
+CHUNK_SIZE = 10000
+
+gpx_header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<gpx xmlns="http://www.topografix.com/GPX/1/1" '
+              'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+              'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" '
+              'version="1.1" creator="filtergpx">\n'
+              '  <trk>\n'
+              '    <trkseg>\n')
+gpx_footer = ('    </trkseg>\n'
+              '  </trk>\n'
+              '</gpx>')
+trkpt_start_format_string = '      <trkpt lat="%s" lon="%s">\n'
+ele_format_string = '        <ele>%s</ele>\n'
+time_format_string = '        <time>%sZ</time>\n'
+trkpt_end = '      </trkpt>\n'
+
+
+def format_float(value):
+    """As gpxpy - shortest repr, but never scientific notation, which isn't valid in gpx"""
+    result = repr(value)
+    if 'e' not in result:
+        return result
+    return format(value, '.10f').rstrip('0').rstrip('.')
+
+
+def format_times(times):
+    """ISO 8601 strings for epoch seconds, None where nan.
+    As gpxpy, microseconds are only included if there is a fraction of a second.
+    """
+    times = numpy.asarray(times, dtype=numpy.float64)
+    missing = numpy.isnan(times)
+    microseconds = numpy.round(numpy.where(missing, 0, times) * 1e6).astype(numpy.int64)
+    time_strings = numpy.datetime_as_string(microseconds.astype('datetime64[us]'), unit='us').tolist()
+    whole_seconds = (microseconds % 1000000 == 0).tolist()
+    return [None if is_missing else time_string[:19] if whole else time_string
+            for time_string, whole, is_missing in zip(time_strings, whole_seconds, missing.tolist())]
+
+
+def format_points(latitudes, longitudes, elevations, times):
+    """trkpt elements for arrays of points, as a string. Elevation and time are left out where nan."""
+    missing_elevations = numpy.isnan(elevations).tolist()
+    parts = []
+    for latitude, longitude, elevation, missing_elevation, time_string in zip(latitudes.tolist(),
+                                                                              longitudes.tolist(),
+                                                                              elevations.tolist(),
+                                                                              missing_elevations,
+                                                                              format_times(times)):
+        parts.append(trkpt_start_format_string % (format_float(latitude), format_float(longitude)))
+        if not missing_elevation:
+            parts.append(ele_format_string % format_float(elevation))
+        if time_string is not None:
+            parts.append(time_format_string % time_string)
+        parts.append(trkpt_end)
+    return ''.join(parts)
+
+
+def write_gpx(filename, track, indices=None, compress=False):
+    """Write points of track (only those at indices, if given) to filename, adding .gpx or .gpx.gz.
+    Written to a hidden temp file and renamed, so a partial file is never left.
+    Returns filename written.
+    :type track: Track
+    """
+    filename += '.gpx.gz' if compress else '.gpx'
+    if indices is None:
+        indices = numpy.arange(len(track))
+    with atomic_write(filename) as temp_filename, \
+            (gzip.open if compress else open)(temp_filename, 'wt', encoding='utf-8') as gpx_file:
+        gpx_file.write(gpx_header)
+        for start in range(0, len(indices), CHUNK_SIZE):
+            chunk = indices[start:start + CHUNK_SIZE]
+            gpx_file.write(format_points(track.latitudes[chunk],
+                                         track.longitudes[chunk],
+                                         track.elevations[chunk],
+                                         track.times[chunk]))
+        gpx_file.write(gpx_footer)
+    return filename
@@ -0,0 +1,398 @@
+"""
+Coverage heatmap - how many activities have visited each pixel, by activity type.
+Each activity's track is rasterised, consecutive points joined, at a fixed Web Mercator zoom.
+Counts are kept in 256x256 tiles, one .npy file per tile (uint16, so memory mappable), only
+for tiles that have been visited. Adding an activity reads and rewrites just the tiles it
+touches, each written atomically, while holding the database's write lock, so processes
+adding at the same time take turns. Activities added are recorded, keyed by source and id, with the pixels they visited,
+so each is only counted once, and one added again (eg reprocessed) replaces its old visits.
+Filtered gpx not in the activity index are keyed by their path, source 'file'.
+Any box can be exported at the same or a lower zoom, as PNG or GeoJSON.
+
+Usage:
+python heatmap.py add-existing - add gpx files already under Activities/<type>/<year>
+python heatmap.py export min_lat min_lon max_lat max_lon zoom file.png|file.geojson [--types Run Cycle]
+@author: lawrence
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import sqlite3
+import struct
+import time
+import zlib
+import numpy
+from common import atomic_write
+
+TILE_SIZE = 256
+# Zoom tiles are stored at, approx 4.8m pixels at the equator, 2.6m in Scotland
+ZOOM = 15
+# Consecutive points further apart than this (pixels) aren't joined, eg gps dropouts
+MAX_JOIN_PIXELS = 64
+# Largest export, in pixels each way
+MAX_EXPORT_SIZE = 8192
+# Web Mercator limit
+MAX_LATITUDE = 85.05112878
+COUNT_MAX = numpy.iinfo(numpy.uint16).max
+# Source for gpx added by add_existing that aren't in the activity index, activity id is the path
+SOURCE_FILE = 'file'
+
+
+def get_pixel_coordinates(latitudes, longitudes, zoom):
+    """Web Mercator pixel x, y (floats) at zoom"""
+    size = TILE_SIZE * 2 ** zoom
+    latitudes = numpy.radians(numpy.clip(numpy.asarray(latitudes, dtype=numpy.float64), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (numpy.asarray(longitudes, dtype=numpy.float64) + 180.0) / 360.0 * size
+    y = (1.0 - numpy.arcsinh(numpy.tan(latitudes)) / math.pi) / 2.0 * size
+    return numpy.clip(x, 0, size - 1), numpy.clip(y, 0, size - 1)
+
+
+def get_coordinates(x, y, zoom):
+    """Latitude, longitude of pixel x, y (can be fractional) at zoom"""
+    size = TILE_SIZE * 2 ** zoom
+    longitude = x / size * 360.0 - 180.0
+    latitude = math.degrees(math.atan(math.sinh(math.pi * (1.0 - 2.0 * y / size))))
+    return latitude, longitude
+
+
+def get_pixels(latitudes, longitudes, zoom=ZOOM):
+    """Sorted unique pixel ids (y * size + x) visited by track at zoom.
+    Consecutive points are joined by a line one pixel wide, as if drawn.
+    """
+    if len(latitudes) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    x, y = get_pixel_coordinates(latitudes, longitudes, zoom)
+    dx = numpy.diff(x)
+    dy = numpy.diff(y)
+    steps = numpy.ceil(numpy.maximum(numpy.abs(dx), numpy.abs(dy))).astype(numpy.int64)
+    steps[steps > MAX_JOIN_PIXELS] = 0
+    # Sample k of segment i is at k / steps[i] of the way along it, ends are the points themselves
+    total = int(steps.sum())
+    segments = numpy.repeat(numpy.arange(len(steps)), steps)
+    samples = numpy.arange(total) - numpy.repeat(numpy.cumsum(steps) - steps, steps)
+    fractions = samples / numpy.repeat(numpy.maximum(steps, 1), steps)
+    all_x = numpy.concatenate([x[segments] + fractions * dx[segments], x])
+    all_y = numpy.concatenate([y[segments] + fractions * dy[segments], y])
+    size = TILE_SIZE * 2 ** zoom
+    return numpy.unique(numpy.floor(all_y).astype(numpy.int64) * size + numpy.floor(all_x).astype(numpy.int64))
+
+
+def encode_pixels(pixels):
+    """Sorted pixel ids as compact bytes - differences between them, compressed"""
+    return zlib.compress(numpy.diff(pixels, prepend=0).astype('<i8').tobytes())
+
+
+def decode_pixels(data):
+    return numpy.cumsum(numpy.frombuffer(zlib.decompress(data), dtype='<i8')).astype(numpy.int64)
+
+
+class Heatmap:
+    """Tiles of visit counts for each activity type, under path.
+    Database of activities added is only created when first used.
+    """
+    def __init__(self, path, zoom=ZOOM):
+        self.path = path
+        self.zoom = zoom
+        self.size = TILE_SIZE * 2 ** zoom
+        self.connection = None
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'."""
+        self.close()
+
+    def _connect(self):
+        """Open database, creating folder and table if required"""
+        if self.connection is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(self.path, 'Heatmap.sqlite'), timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS activity_pixels ('
+                                    'source TEXT, activity_id TEXT, zoom INTEGER, activity_type TEXT, gpx_path TEXT, '
+                                    'pixel_count INTEGER, pixels BLOB, added REAL, '
+                                    'PRIMARY KEY (source, activity_id, zoom))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS activity_pixels_gpx_path '
+                                    'ON activity_pixels (gpx_path, zoom)')
+            self.connection.commit()
+        return self.connection
+
+    def get_tile_filename(self, activity_type, tile_x, tile_y):
+        return os.path.join(self.path, 'z%d' % self.zoom, activity_type, str(tile_x), '%d.npy' % tile_y)
+
+    def read_tile(self, activity_type, tile_x, tile_y):
+        """Tile counts, memory mapped, None if tile hasn't been visited"""
+        filename = self.get_tile_filename(activity_type, tile_x, tile_y)
+        if not os.path.isfile(filename):
+            return None
+        return numpy.load(filename, mmap_mode='r')
+
+    def write_tile(self, activity_type, tile_x, tile_y, counts):
+        """Written atomically, so readers never see part of a tile"""
+        filename = self.get_tile_filename(activity_type, tile_x, tile_y)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with atomic_write(filename) as temp_filename, open(temp_filename, 'wb') as file:
+            numpy.save(file, counts)
+
+    def contains(self, source, activity_id):
+        return self._connect().execute('SELECT 1 FROM activity_pixels '
+                                       'WHERE source = ? AND activity_id = ? AND zoom = ?',
+                                       (source, str(activity_id), self.zoom)).fetchone() is not None
+
+    def contains_gpx(self, gpx_path):
+        """True if an activity has been added from, or recorded as written to, filtered gpx"""
+        return self._connect().execute('SELECT 1 FROM activity_pixels WHERE gpx_path = ? AND zoom = ?',
+                                       (os.path.abspath(gpx_path), self.zoom)).fetchone() is not None
+
+    def add(self, source, activity_id, activity_type, pixels, gpx_path=None):
+        """Add one visit to each of pixels (from get_pixels at this zoom) for activity_type.
+        Only tiles touched are read and written. If the activity has been added before its old
+        visits are taken off first, nothing is done if it's unchanged.
+        gpx_path is the filtered gpx written for the activity, anything else added for that file
+        (by add_existing) is replaced too.
+        Returns number of tiles updated.
+        """
+        pixels = numpy.asarray(pixels, dtype=numpy.int64)
+        if gpx_path is not None:
+            gpx_path = os.path.abspath(gpx_path)
+        connection = self._connect()
+        with connection:
+            # Write lock held while tiles are read and rewritten, until the activity is recorded, so
+            # other processes adding activities don't lose each other's visits
+            connection.execute('BEGIN IMMEDIATE')
+            previous = connection.execute('SELECT activity_type, pixels FROM activity_pixels '
+                                          'WHERE source = ? AND activity_id = ? AND zoom = ?',
+                                          (source, str(activity_id), self.zoom)).fetchone()
+            replaced = []
+            if gpx_path is not None:
+                replaced = connection.execute('SELECT source, activity_id, activity_type, pixels '
+                                              'FROM activity_pixels WHERE gpx_path = ? AND zoom = ? '
+                                              'AND NOT (source = ? AND activity_id = ?)',
+                                              (gpx_path, self.zoom, source, str(activity_id))).fetchall()
+            if previous is not None and len(replaced) == 0 and previous[0] == activity_type and \
+                    numpy.array_equal(decode_pixels(previous[1]), pixels):
+                return 0
+            tiles = 0
+            if previous is not None:
+                tiles += self.update_tiles(previous[0], decode_pixels(previous[1]), -1)
+            for _, _, replaced_type, replaced_pixels in replaced:
+                tiles += self.update_tiles(replaced_type, decode_pixels(replaced_pixels), -1)
+            tiles += self.update_tiles(activity_type, pixels, 1)
+            for replaced_source, replaced_id, _, _ in replaced:
+                connection.execute('DELETE FROM activity_pixels WHERE source = ? AND activity_id = ? AND zoom = ?',
+                                   (replaced_source, replaced_id, self.zoom))
+            connection.execute('INSERT OR REPLACE INTO activity_pixels VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (source, str(activity_id), self.zoom, activity_type, gpx_path, len(pixels),
+                                encode_pixels(pixels), time.time()))
+        return tiles
+
+    def update_tiles(self, activity_type, pixels, change):
+        """Add (change 1) or take off (change -1) one visit to each of pixels, returns number of tiles updated"""
+        x = pixels % self.size
+        y = pixels // self.size
+        tile_keys = (y // TILE_SIZE) * (self.size // TILE_SIZE) + x // TILE_SIZE
+        order = numpy.argsort(tile_keys, kind='stable')
+        tile_keys = tile_keys[order]
+        x = x[order]
+        y = y[order]
+        starts = numpy.flatnonzero(numpy.diff(tile_keys, prepend=-1))
+        ends = numpy.append(starts[1:], len(tile_keys))
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            tile_x = int(x[start]) // TILE_SIZE
+            tile_y = int(y[start]) // TILE_SIZE
+            tile = self.read_tile(activity_type, tile_x, tile_y)
+            counts = numpy.zeros((TILE_SIZE, TILE_SIZE), dtype=numpy.uint16) if tile is None else numpy.array(tile)
+            rows = y[start:end] % TILE_SIZE
+            columns = x[start:end] % TILE_SIZE
+            # Saturate rather than wrap
+            if change > 0:
+                counts[rows, columns] += counts[rows, columns] < COUNT_MAX
+            else:
+                counts[rows, columns] -= counts[rows, columns] > 0
+            del tile
+            self.write_tile(activity_type, tile_x, tile_y, counts)
+        return len(starts)
+
+    def get_tiles(self, activity_type, min_x, min_y, max_x, max_y):
+        """(tile_x, tile_y) of tiles stored for activity_type within tile range, only lists folders that exist"""
+        path = os.path.dirname(os.path.dirname(self.get_tile_filename(activity_type, 0, 0)))
+        if not os.path.isdir(path):
+            return []
+        tiles = []
+        for x_entry in os.scandir(path):
+            if not x_entry.is_dir() or not x_entry.name.isdigit() or not min_x <= int(x_entry.name) <= max_x:
+                continue
+            for y_entry in os.scandir(x_entry.path):
+                name = y_entry.name
+                if name.endswith('.npy') and name[:-4].isdigit() and min_y <= int(name[:-4]) <= max_y:
+                    tiles.append((int(x_entry.name), int(name[:-4])))
+        return sorted(tiles)
+
+    def get_activity_types(self):
+        """Types with any tiles"""
+        path = os.path.join(self.path, 'z%d' % self.zoom)
+        if not os.path.isdir(path):
+            return []
+        return sorted(entry.name for entry in os.scandir(path) if entry.is_dir())
+
+    def render(self, min_lat, min_lon, max_lat, max_lon, zoom, activity_types=None):
+        """Visit counts for box at zoom (no more than the stored zoom), all types given added together.
+        Lower zooms take the most visits of the pixels each covers.
+        Returns (counts, x, y) - 2D uint32 array, and pixel co-ordinates of its top left at zoom.
+        """
+        if zoom > self.zoom:
+            raise ValueError('Heatmap is stored at zoom %d, can not export zoom %d' % (self.zoom, zoom))
+        if activity_types is None:
+            activity_types = self.get_activity_types()
+        scale = 2 ** (self.zoom - zoom)
+        # Box in pixels at stored zoom, rounded out to whole export pixels
+        x, y = get_pixel_coordinates([max_lat, min_lat], [min_lon, max_lon], self.zoom)
+        left = int(x[0]) // scale * scale
+        top = int(y[0]) // scale * scale
+        right = (int(x[1]) // scale + 1) * scale
+        bottom = (int(y[1]) // scale + 1) * scale
+        width = (right - left) // scale
+        height = (bottom - top) // scale
+        if width > MAX_EXPORT_SIZE or height > MAX_EXPORT_SIZE:
+            raise ValueError('Export would be %dx%d pixels, use a lower zoom or smaller box' % (width, height))
+
+        counts = numpy.zeros((height, width), dtype=numpy.uint32)
+        # Pixels of a tile that go into each export pixel - a whole tile if it's smaller than one
+        block = min(scale, TILE_SIZE)
+        for activity_type in activity_types:
+            type_counts = numpy.zeros((height, width), dtype=numpy.uint32)
+            for tile_x, tile_y in self.get_tiles(activity_type, left // TILE_SIZE, top // TILE_SIZE,
+                                                 (right - 1) // TILE_SIZE, (bottom - 1) // TILE_SIZE):
+                tile = self.read_tile(activity_type, tile_x, tile_y)
+                # Part of tile inside box, always whole blocks as box is rounded to export pixels
+                tile_left = tile_x * TILE_SIZE
+                tile_top = tile_y * TILE_SIZE
+                x0 = max(left, tile_left)
+                y0 = max(top, tile_top)
+                x1 = min(right, tile_left + TILE_SIZE)
+                y1 = min(bottom, tile_top + TILE_SIZE)
+                rows = (y1 - y0) // block
+                columns = (x1 - x0) // block
+                pooled = tile[y0 - tile_top:y1 - tile_top, x0 - tile_left:x1 - tile_left] \
+                    .reshape(rows, block, columns, block).max(axis=(1, 3))
+                row = (y0 - top) // scale
+                column = (x0 - left) // scale
+                target = type_counts[row:row + rows, column:column + columns]
+                numpy.maximum(target, pooled, out=target)
+            counts += type_counts
+        return counts, left // scale, top // scale
+
+    def export_png(self, filename, min_lat, min_lon, max_lat, max_lon, zoom, activity_types=None):
+        """Write box as PNG - transparent where never visited, yellow to red by log of visits.
+        Returns (width, height).
+        """
+        counts = self.render(min_lat, min_lon, max_lat, max_lon, zoom, activity_types)[0]
+        height, width = counts.shape
+        levels = numpy.log1p(counts.astype(numpy.float64))
+        if levels.max() > 0:
+            levels /= levels.max()
+        image = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+        visited = counts > 0
+        image[..., 0] = 255
+        image[..., 1] = numpy.round(255 * (1.0 - levels) * visited).astype(numpy.uint8)
+        image[..., 3] = numpy.where(visited, 160 + numpy.round(95 * levels), 0).astype(numpy.uint8)
+        write_png(filename, image)
+        return width, height
+
+    def export_geojson(self, filename, min_lat, min_lon, max_lat, max_lon, zoom, activity_types=None):
+        """Write box as GeoJSON - a square polygon, with visits property, for each pixel visited.
+        Returns number of features.
+        """
+        counts, left, top = self.render(min_lat, min_lon, max_lat, max_lon, zoom, activity_types)
+        rows, columns = numpy.nonzero(counts)
+        features = []
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            north, west = get_coordinates(left + column, top + row, zoom)
+            south, east = get_coordinates(left + column + 1, top + row + 1, zoom)
+            features.append({'type': 'Feature',
+                             'geometry': {'type': 'Polygon',
+                                          'coordinates': [[[west, north], [east, north], [east, south],
+                                                           [west, south], [west, north]]]},
+                             'properties': {'visits': int(counts[row, column])}})
+        with atomic_write(filename) as temp_filename, open(temp_filename, 'w', encoding='utf-8') as file:
+            json.dump({'type': 'FeatureCollection', 'features': features}, file)
+        return len(features)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def write_png(filename, image):
+    """Write RGBA uint8 array (height, width, 4) as PNG"""
+    height, width = image.shape[:2]
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    # Each row starts with filter type 0 (none)
+    rows = numpy.zeros((height, width * 4 + 1), dtype=numpy.uint8)
+    rows[:, 1:] = image.reshape(height, width * 4)
+    with atomic_write(filename) as temp_filename, open(temp_filename, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        file.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        file.write(chunk(b'IEND', b''))
+
+
+def add_existing(heatmap, activities_path, index=None):
+    """Add filtered gpx already written under activities_path/<type>/<year>, skipping those already added.
+    Each is keyed by the activity the index records it as output for, the same key as when processed,
+    or by its path if it isn't in the index.
+    Returns number added.
+    :type index: activityindex.ActivityIndex
+    """
+    from track import Track
+    activities = {} if index is None else index.get_activities_by_output_path()
+    added = 0
+    for filename in sorted(glob.glob(os.path.join(activities_path, '*', '*', '*.gpx')) +
+                           glob.glob(os.path.join(activities_path, '*', '*', '*.gpx.gz'))):
+        if heatmap.contains_gpx(filename):
+            continue
+        activity_type = os.path.basename(os.path.dirname(os.path.dirname(filename)))
+        path = os.path.abspath(filename)
+        source, activity_id = activities.get(path, (SOURCE_FILE, path))
+        track = Track.from_gpx(filename)
+        heatmap.add(source, activity_id, activity_type, get_pixels(track.latitudes, track.longitudes, heatmap.zoom),
+                    filename)
+        added += 1
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Coverage heatmap of all activities.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('add-existing', help='Add gpx files already under Activities')
+    export_parser = subparsers.add_parser('export', help='Export box to PNG or GeoJSON')
+    for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon'):
+        export_parser.add_argument(name, type=float)
+    export_parser.add_argument('zoom', type=int)
+    export_parser.add_argument('filename', help='.png or .geojson')
+    export_parser.add_argument('--types', nargs='+', help='Activity types (default all)')
+    args = parser.parse_args()
+
+    import filtergpx
+    with filtergpx.get_heatmap() as main_heatmap:
+        if args.command == 'add-existing':
+            print('%d activities added' % add_existing(main_heatmap, filtergpx.get_output_path() + 'Activities',
+                                                       filtergpx.get_activity_index()))
+        elif args.filename.endswith('.png'):
+            print('%dx%d PNG written to %s' % (main_heatmap.export_png(args.filename, args.min_lat, args.min_lon,
+                                                                       args.max_lat, args.max_lon, args.zoom,
+                                                                       args.types) + (args.filename,)))
+        else:
+            print('%d pixels written to %s' % (main_heatmap.export_geojson(args.filename, args.min_lat, args.min_lon,
+                                                                           args.max_lat, args.max_lon, args.zoom,
+                                                                           args.types), args.filename))
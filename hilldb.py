@@ -1,9 +1,16 @@
 import csv
-import pandas
-import gpxpy
-from geopy.distance import distance
+import os
+import time
+import json
+import argparse
+from track import Track
+from trackdistance import geodesic_distance
 import glob
 import config
+import instrumentation
+import hillfile
+from common import atomic_write, get_file_hash
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 # hill_db_file = "/Users/lawrence/Downloads/DoBIH_v17_3.csv"
@@ -13,11 +20,46 @@ gpxcsv_filename = "/Users/lawrence/Documents/GPSData/Activities/Hike/Test/gpx.cs
 margin = 0.0003
 
 hill_db_file = config.local_path + "HillList\\DoBIH_v17_3.csv"
-path = config.local_path + "Activities\\Hike\\" + subdir
-csv_filename = config.local_path + "Activities\\Hike\\" + subdir + "\\Munros_" + subdir + ".csv"
+hike_path = config.local_path + "Activities\\Hike\\"
+path_format_string = hike_path + "%s"
+csv_filename_format_string = hike_path + "%s\\Munros_%s.csv"
+# Record of files already analysed, and their results
+manifest_filename = hike_path + "HillManifest.json"
+# Manifest is saved after this many files are analysed, so little is lost if a scan is interrupted
+MANIFEST_SAVE_INTERVAL = 50
+fieldnames = ['Type', 'Name', 'Height', 'Grid Ref', 'Region', 'Datetime', 'GPXFile']
+
+class HillIndex:
+    """Hill lookups on compiled hill list, which is bucketed by grid cell so lookups only check nearby hills"""
+    def __init__(self, hills):
+        """
+        :type hills: hillfile.HillFile
+        """
+        self.hills = hills
+
+    def query(self, min_lat, max_lat, min_long, max_long):
+        """Return indexes of hills within box"""
+        return self.hills.query(min_lat, max_lat, min_long, max_long)
+
+    def nearest(self, latitude, longitude):
+        """Return nearest hill within margin of point, and its distance.
+        None if there isn't one.
+        """
+        nearest_hill = None
+        nearest_distance = 0
+        for index in self.query(latitude - margin, latitude + margin, longitude - margin, longitude + margin):
+            hill = self.hills.get_hill(index)
+            hill_distance = calculate_distance(latitude, longitude, hill['Latitude'], hill['Longitude'])
+            if nearest_hill is None or hill_distance < nearest_distance:
+                nearest_hill = hill
+                nearest_distance = hill_distance
+        return nearest_hill, nearest_distance
+
+
+# Compiled (if csv has changed) and memory mapped, so shared by worker processes
+with instrumentation.timer('hill_load'):
+    hill_index = HillIndex(hillfile.load(hill_db_file))
 
-df = pandas.read_csv(hill_db_file)
-headers = df.columns
 
 class Stats:
     def __init__(self):
@@ -27,6 +69,16 @@ class Stats:
         self.dups = 0
         self.files = 0
 
+    def add(self, counts):
+        """Add counts from a previously analysed file"""
+        self.munros += counts['munros']
+        self.tops += counts['tops']
+        self.others += counts['others']
+        self.dups += counts['dups']
+
+    def get_counts(self):
+        return {'munros': self.munros, 'tops': self.tops, 'others': self.others, 'dups': self.dups}
+
     def output_total(self):
         print("%d files analysed, %d Munros, %d Munro Tops, %d Other Tops, %d Duplicates" % (self.files,
                                                                                              self.munros,
@@ -39,133 +91,244 @@ def calculate_distance(lat1, long1, lat2, long2):
     """Wrapper for distance calculation
     Pass in gps points, return separation
     """
-    coord1 = (lat1, long1)
-    coord2 = (lat2, long2)
+    return float(geodesic_distance(lat1, long1, lat2, long2))
 
-    return distance(coord1, coord2).meters
+
+class SummitRows:
+    """Stands in for csv writer, collects rows so they can be returned from a worker and saved"""
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        # Everything as strings, same as csv output
+        self.rows.append({key: str(value) for key, value in row.items()})
 
 
 def analyse_track(gpx_file, csv_writer, stat_counter):
 
-    with open(gpx_file, 'r') as file:
-        gpx_data = file.read()
-        input_gpx = gpxpy.parse(gpx_data)
-
-        hill_number = 0
-        min_summit_distance = 1000
-        near_summit = False
-
-        # Check if any summits in areas of track
-        min_lat = 90.0
-        max_lat = -90.0
-        min_long = 180.0
-        max_long = -180.0
-
-        for track in input_gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    if point.latitude < min_lat:
-                        min_lat = point.latitude
-                    if point.latitude > max_lat:
-                        max_lat = point.latitude
-                    if point.longitude < min_long:
-                        min_long = point.longitude
-                    if point.longitude > max_long:
-                        max_long = point.longitude
-        filtered_list = df[(df['Latitude'] >= min_lat - margin) &
-                           (df['Latitude'] <= max_lat + margin) &
-                           (df['Longitude'] >= min_long - margin) &
-                           (df['Longitude'] <= max_long + margin)]
-        if len(filtered_list.index) == 0:
-            # No summits
-            return
-
-        summits = []
-
-        for track in input_gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    if not near_summit:
-                        # Filter hill data
-                        filtered_list = df[(df['Latitude'] > point.latitude - margin) &
-                                           (df['Latitude'] < point.latitude + margin) &
-                                           (df['Longitude'] > point.longitude - margin) &
-                                           (df['Longitude'] < point.longitude + margin)]
-
-                    # Should be at most one match
-                    if len(filtered_list.index) == 1:
-                        hill_number = filtered_list['Name'].item()
-                        near_summit = True
-                        summit_distance = calculate_distance(point.latitude,
-                                                             point.longitude,
-                                                             filtered_list['Latitude'].item(),
-                                                             filtered_list['Longitude'].item())
-                        if summit_distance < min_summit_distance:
-                            min_summit_distance = summit_distance
-                            nearest_point = point
-                        elif summit_distance > 50:
-                            # We have moved away from summit, so need to record
-                            # First check we haven't already been to this summit on this track
-                            dup = False
-                            for i in summits:
-                                if i == hill_number:
-                                    dup = True
-                                    print("Duplicate: %s. Height: %s Dist: %d" % (filtered_list['Name'].item(),
-                                                                                    filtered_list['Metres'].item(),
-                                                                                    min_summit_distance))
-                                    stat_counter.dups += 1
-                                    break
-                            if not dup:
-                                # It's a new summit so save details
-                                is_munro = False
-                                if filtered_list['M'].item() == 1:
-                                    is_munro = True
-                                    summit_type = "Munro"
-                                    stat_counter.munros += 1
-                                elif filtered_list['MT'].item() == 1:
-                                    is_munro = True
-                                    summit_type = "Munro Top"
-                                    stat_counter.tops += 1
-                                else:
-                                    summit_type = "Other Top"
-                                    stat_counter.others += 1
-
-                                print("%s: %s. Height: %d Dist: %d" % (summit_type,
-                                                                       filtered_list['Name'].item(),
-                                                                       filtered_list['Metres'].item(),
-                                                                       min_summit_distance))
-                                csv_writer.writerow({'Type': summit_type,
-                                                     'Name': filtered_list['Name'].item(),
-                                                     'Height': filtered_list['Metres'].item(),
-                                                     'Grid Ref': filtered_list['GridrefXY'].item(),
-                                                     'Region': filtered_list['Region'].item(),
-                                                     'Datetime': nearest_point.time,
-                                                     'GPXFile': gpx_file})
-
-                            # Reset to find the next summit
-                            summits.append(hill_number)
-                            min_summit_distance = 1000
-                            near_summit = False
-
-                    elif len(filtered_list.index) > 1:
-                        # Should not get here
-                        print("More than one match - should not be possible!")
+    hill_number = 0
+    min_summit_distance = 1000
+    near_summit = False
+
+    # Parsed once into arrays, then searched for summits
+    track = Track.from_gpx(gpx_file)
+    instrumentation.count('points', len(track))
+    if len(track) == 0:
+        return
+
+    # Check if any summits in areas of track
+    latitudes = track.latitudes
+    longitudes = track.longitudes
+    min_lat = latitudes.min()
+    max_lat = latitudes.max()
+    min_long = longitudes.min()
+    max_long = longitudes.max()
+    # Any hills near the track at all
+    if len(hill_index.query(min_lat - margin, max_lat + margin, min_long - margin, max_long + margin)) == 0:
+        # No summits
+        return
+
+    summits = []
+    hill = None
+
+    for index in range(len(track)):
+        latitude = float(latitudes[index])
+        longitude = float(longitudes[index])
+        if not near_summit:
+            # Nearest hill, if more than one close enough
+            hill, summit_distance = hill_index.nearest(latitude, longitude)
+        elif hill is not None:
+            summit_distance = calculate_distance(latitude,
+                                                 longitude,
+                                                 hill['Latitude'],
+                                                 hill['Longitude'])
+
+        if hill is not None:
+            hill_number = hill['Name']
+            near_summit = True
+            if summit_distance < min_summit_distance:
+                min_summit_distance = summit_distance
+                nearest_index = index
+            elif summit_distance > 50:
+                # We have moved away from summit, so need to record
+                # First check we haven't already been to this summit on this track
+                dup = False
+                for i in summits:
+                    if i == hill_number:
+                        dup = True
+                        print("Duplicate: %s. Height: %s Dist: %d" % (hill['Name'],
+                                                                        hill['Metres'],
+                                                                        min_summit_distance))
+                        stat_counter.dups += 1
+                        break
+                if not dup:
+                    # It's a new summit so save details
+                    is_munro = False
+                    if hill['M'] == 1:
+                        is_munro = True
+                        summit_type = "Munro"
+                        stat_counter.munros += 1
+                    elif hill['MT'] == 1:
+                        is_munro = True
+                        summit_type = "Munro Top"
+                        stat_counter.tops += 1
+                    else:
+                        summit_type = "Other Top"
+                        stat_counter.others += 1
+
+                    print("%s: %s. Height: %d Dist: %d" % (summit_type,
+                                                           hill['Name'],
+                                                           hill['Metres'],
+                                                           min_summit_distance))
+                    csv_writer.writerow({'Type': summit_type,
+                                         'Name': hill['Name'],
+                                         'Height': hill['Metres'],
+                                         'Grid Ref': hill['GridrefXY'],
+                                         'Region': hill['Region'],
+                                         'Datetime': track.get_time(nearest_index),
+                                         'GPXFile': gpx_file})
+
+                # Reset to find the next summit
+                summits.append(hill_number)
+                min_summit_distance = 1000
+                near_summit = False
 
     return
 
 
-output_csv = open(csv_filename, 'w', newline='')
-fieldnames = ['Type', 'Name', 'Height', 'Grid Ref', 'Region', 'Datetime', 'GPXFile']
-writer = csv.DictWriter(output_csv, fieldnames=fieldnames)
-writer.writeheader()
+def analyse_file(gpx_file):
+    """Analyse a single file, can run in a worker process.
+    Returns summit rows, counts and metrics
+    """
+    rows = SummitRows()
+    stat_counter = Stats()
+    # Only this file's metrics are returned
+    instrumentation.take()
+    with instrumentation.timer('analyse'):
+        analyse_track(gpx_file, rows, stat_counter)
+    return rows.rows, stat_counter.get_counts(), instrumentation.take().to_dict()
+
+
+def load_manifest():
+    """Manifest is keyed by path, each entry has mtime, size, hash, rows and counts"""
+    if not os.path.isfile(manifest_filename):
+        return {}
+    with open(manifest_filename, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest):
+    """Written atomically, so manifest is never left half written"""
+    with atomic_write(manifest_filename) as temp_filename, open(temp_filename, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=1)
+
+
+def needs_analysis(manifest, filename):
+    """Check file against manifest. Only hash it if mtime or size have changed."""
+    entry = manifest.get(filename)
+    file_stat = os.stat(filename)
+    if entry is None:
+        return True
+    if entry['mtime'] == file_stat.st_mtime and entry['size'] == file_stat.st_size:
+        return False
+    if entry['hash'] == get_file_hash(filename):
+        # Touched but not changed
+        entry['mtime'] = file_stat.st_mtime
+        entry['size'] = file_stat.st_size
+        return False
+    return True
+
+
+def get_all_years():
+    """Every year folder in the hike archive"""
+    return sorted(entry.name for entry in os.scandir(hike_path) if entry.is_dir() and entry.name.isdigit())
+
+
+def scan_years(years, workers):
+    """Analyse new or changed files for years, in parallel, then write each year's csv from the manifest.
+    Returns metrics for the run
+    """
+    # Includes hill list load
+    run_metrics = instrumentation.take()
+    with instrumentation.timer('manifest'):
+        manifest = load_manifest()
+    counter = Stats()
+
+    files_by_year = {}
+    for year in years:
+        files_by_year[year] = sorted(glob.glob(path_format_string % year + '**/*.gpx', recursive=True) +
+                                     glob.glob(path_format_string % year + '**/*.gpx.gz', recursive=True))
+    all_files = [filename for year in years for filename in files_by_year[year]]
+    with instrumentation.timer('scan'):
+        new_files = [filename for filename in all_files if needs_analysis(manifest, filename)]
+    print("%d files, %d new or changed" % (len(all_files), len(new_files)))
+    instrumentation.count('files', len(all_files))
+    instrumentation.count('files_analysed', len(new_files))
+
+    # Manifest is saved as files are analysed, and whatever happens, so completed work isn't lost
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(analyse_file, filename): filename for filename in new_files}
+            analysed = 0
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    rows, counts, metrics = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    # Not added to manifest, so it's tried again next time
+                    print('Error analysing %s: %s' % (filename, err))
+                    instrumentation.count('files_failed')
+                    continue
+                print(filename)
+                run_metrics.add(metrics)
+                file_stat = os.stat(filename)
+                with instrumentation.timer('hash'):
+                    file_hash = get_file_hash(filename)
+                manifest[filename] = {'mtime': file_stat.st_mtime,
+                                      'size': file_stat.st_size,
+                                      'hash': file_hash,
+                                      'rows': rows,
+                                      'counts': counts}
+                analysed += 1
+                if analysed % MANIFEST_SAVE_INTERVAL == 0:
+                    with instrumentation.timer('manifest'):
+                        save_manifest(manifest)
+    finally:
+        # Drop files that no longer exist in the years scanned
+        for filename in list(manifest):
+            if not os.path.isfile(filename):
+                del manifest[filename]
+        with instrumentation.timer('manifest'):
+            save_manifest(manifest)
+
+    # Merge results into csv for each year
+    for year in years:
+        with instrumentation.timer('csv_write'), \
+                open(csv_filename_format_string % (year, year), 'w', newline='') as output_csv:
+            writer = csv.DictWriter(output_csv, fieldnames=fieldnames)
+            writer.writeheader()
+            for filename in files_by_year[year]:
+                if filename not in manifest:
+                    # Failed to analyse
+                    continue
+                counter.files += 1
+                counter.add(manifest[filename]['counts'])
+                for row in manifest[filename]['rows']:
+                    writer.writerow(row)
 
-counter = Stats()
+    counter.output_total()
+    run_metrics.add(instrumentation.take())
+    return run_metrics
 
-for filename in glob.iglob(path + '**/*.gpx', recursive=True):
-    print(filename)
-    counter.files += 1
-    analyse_track(filename, writer, counter)
 
-output_csv.close()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find summits visited by hikes in the archive.')
+    parser.add_argument('years', nargs='*', default=[subdir], help='Year folders to scan (default %s)' % subdir)
+    parser.add_argument('--all', action='store_true', help='Scan every year in the archive')
+    parser.add_argument('--workers', type=int, default=config.hill_workers, help='Number of worker processes')
+    args = parser.parse_args()
 
-counter.output_total()
\ No newline at end of file
+    start_time = time.time()
+    metrics = scan_years(get_all_years() if args.all else args.years, args.workers)
+    if instrumentation.enabled:
+        print(metrics.get_summary(time.time() - start_time))
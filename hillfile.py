@@ -0,0 +1,267 @@
+"""
+Compiled hill list.
+The DoBIH csv is compiled once into a compact binary file, which is memory mapped rather
+than parsed, so opening it is near instant and worker processes share one copy in the page cache.
+File holds hills sorted by grid cell - coordinate, height and flag arrays - a bucket table of
+the first hill in each occupied cell, and a string table for names, grid refs and regions.
+Compiled file records the size, modification time and hash of the csv it came from, and is
+rebuilt automatically when the csv changes. If the csv is touched but not changed, only the
+recorded size and time are updated, so it isn't hashed again every time it's opened.
+
+Usage: python hillfile.py [DoBIH csv] - compile now rather than on first use
+@author: lawrence
+"""
+
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import numpy
+from common import atomic_write, get_file_hash
+
+MAGIC = b'HILLDB1\0'
+# Hill index grid size, approx 1km lat
+CELL_SIZE = 0.01
+# Offset added to cells so they're positive when packed into a key
+CELL_OFFSET = 1 << 20
+# Flags
+MUNRO = 1
+MUNRO_TOP = 2
+
+
+def get_compiled_filename(csv_filename):
+    return os.path.splitext(csv_filename)[0] + '.hilldb'
+
+
+def get_keys(lat_cells, lon_cells):
+    """Single sortable key for each cell, latitude then longitude"""
+    return (numpy.asarray(lat_cells, dtype=numpy.int64) + CELL_OFFSET) * (2 * CELL_OFFSET) + \
+        (numpy.asarray(lon_cells, dtype=numpy.int64) + CELL_OFFSET)
+
+
+def get_source(csv_filename, file_hash):
+    """Header record of csv compiled from"""
+    csv_stat = os.stat(csv_filename)
+    return {'size': csv_stat.st_size, 'mtime_ns': csv_stat.st_mtime_ns, 'sha256': file_hash}
+
+
+def write_compiled(compiled_filename, header, blocks):
+    """Write header then array data blocks.
+    Written to a temp file and renamed, so processes opening it never see it part written.
+    """
+    header_bytes = json.dumps(header).encode('utf-8')
+    # Arrays are aligned to 8 bytes
+    header_bytes += b' ' * (-(len(MAGIC) + 4 + len(header_bytes)) % 8)
+    with atomic_write(compiled_filename) as temp_filename, open(temp_filename, 'wb') as file:
+        file.write(MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+        for block in blocks:
+            file.write(block)
+
+
+def is_integer(text):
+    try:
+        int(text)
+        return True
+    except ValueError:
+        return False
+
+
+def compile_hill_list(csv_filename, compiled_filename=None, cell_size=CELL_SIZE):
+    """Compile hill list csv, returns compiled filename"""
+    if compiled_filename is None:
+        compiled_filename = get_compiled_filename(csv_filename)
+    source = get_source(csv_filename, get_file_hash(csv_filename))
+    latitudes = []
+    longitudes = []
+    metres = []
+    flags = []
+    names = []
+    gridrefs = []
+    regions = []
+    # Heights are whole numbers as long as they all are, same as when read with pandas
+    metres_integer = True
+    with open(csv_filename, 'r', encoding='utf-8', newline='') as file:
+        for row in csv.DictReader(file):
+            try:
+                latitude = float(row['Latitude'])
+                longitude = float(row['Longitude'])
+            except (TypeError, ValueError):
+                continue
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+            metres_integer = metres_integer and is_integer(row['Metres'])
+            metres.append(float(row['Metres']))
+            flags.append((MUNRO if row['M'] == '1' else 0) | (MUNRO_TOP if row['MT'] == '1' else 0))
+            names.append(row['Name'])
+            gridrefs.append(row['GridrefXY'])
+            regions.append(row['Region'])
+
+    latitudes = numpy.array(latitudes, dtype=numpy.float64)
+    longitudes = numpy.array(longitudes, dtype=numpy.float64)
+    keys = get_keys(numpy.floor(latitudes / cell_size), numpy.floor(longitudes / cell_size))
+    order = numpy.argsort(keys, kind='stable')
+    keys = keys[order]
+    bucket_keys, bucket_starts = numpy.unique(keys, return_index=True)
+
+    # Strings stored once each, hills have an offset into the table for each field
+    strings = {}
+    string_parts = []
+    string_length = 0
+
+    def get_string_offsets(values):
+        nonlocal string_length
+        offsets = numpy.zeros(len(values), dtype=numpy.uint32)
+        for i, value in enumerate(values):
+            encoded = value.encode('utf-8')
+            if encoded not in strings:
+                strings[encoded] = string_length
+                string_parts.append(struct.pack('<I', len(encoded)) + encoded)
+                string_length += 4 + len(encoded)
+            offsets[i] = strings[encoded]
+        return offsets[order]
+
+    arrays = {'latitudes': latitudes[order],
+              'longitudes': longitudes[order],
+              'metres': numpy.array(metres, dtype=numpy.float64)[order],
+              'flags': numpy.array(flags, dtype=numpy.uint8)[order],
+              'bucket_keys': bucket_keys.astype(numpy.int64),
+              'bucket_starts': numpy.append(bucket_starts, len(keys)).astype(numpy.uint32)}
+    for field, values in (('names', names), ('gridrefs', gridrefs), ('regions', regions)):
+        arrays[field] = get_string_offsets(values)
+    arrays['strings'] = numpy.frombuffer(b''.join(string_parts), dtype=numpy.uint8)
+
+    header = {'count': len(latitudes),
+              'cell_size': cell_size,
+              'metres_integer': metres_integer,
+              'source': source,
+              'arrays': {}}
+    # Arrays follow header, each aligned to 8 bytes
+    offset = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = [offset, array.dtype.str, len(array)]
+        offset += (array.nbytes + 7) // 8 * 8
+    write_compiled(compiled_filename, header,
+                   (array.tobytes() + b'\0' * (-array.nbytes % 8) for array in arrays.values()))
+    return compiled_filename
+
+
+class HillFile:
+    """Memory mapped compiled hill list. Hills are referred to by index."""
+    def __init__(self, compiled_filename):
+        self.filename = compiled_filename
+        with open(compiled_filename, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a compiled hill list' % compiled_filename)
+        header_length = struct.unpack_from('<I', self.map, len(MAGIC))[0]
+        data_offset = len(MAGIC) + 4 + header_length
+        self.data_offset = data_offset
+        self.header = json.loads(self.map[len(MAGIC) + 4:data_offset].decode('utf-8'))
+        self.cell_size = self.header['cell_size']
+        self.metres_integer = self.header['metres_integer']
+        arrays = {}
+        for name, (offset, dtype, length) in self.header['arrays'].items():
+            arrays[name] = numpy.frombuffer(self.map, dtype=dtype, count=length, offset=data_offset + offset)
+        self.latitudes = arrays['latitudes']
+        self.longitudes = arrays['longitudes']
+        self.metres = arrays['metres']
+        self.flags = arrays['flags']
+        self.bucket_keys = arrays['bucket_keys']
+        self.bucket_starts = arrays['bucket_starts']
+        self.names = arrays['names']
+        self.gridrefs = arrays['gridrefs']
+        self.regions = arrays['regions']
+        self.strings = arrays['strings']
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def is_same_time(self, csv_filename):
+        """True if csv size and modification time are as recorded when compiled"""
+        source = self.header['source']
+        csv_stat = os.stat(csv_filename)
+        return source['size'] == csv_stat.st_size and source['mtime_ns'] == csv_stat.st_mtime_ns
+
+    def is_current(self, csv_filename):
+        """True if compiled from csv as it is now. Only hashes csv if size or time have changed."""
+        return self.is_same_time(csv_filename) or self.header['source']['sha256'] == get_file_hash(csv_filename)
+
+    def update_source(self, csv_filename):
+        """Record csv's current size and time, keeping the compiled data. Closes this, returns reopened file."""
+        header = dict(self.header, source=get_source(csv_filename, self.header['source']['sha256']))
+        data = self.map[self.data_offset:]
+        # Closed first, a mapped file can't be replaced on Windows
+        self.close()
+        write_compiled(self.filename, header, [data])
+        return HillFile(self.filename)
+
+    def get_string(self, offset):
+        length = struct.unpack_from('<I', self.strings, offset)[0]
+        return self.strings[offset + 4:offset + 4 + length].tobytes().decode('utf-8')
+
+    def get_cell(self, latitude, longitude):
+        return int(numpy.floor(latitude / self.cell_size)), int(numpy.floor(longitude / self.cell_size))
+
+    def query(self, min_lat, max_lat, min_long, max_long):
+        """Indexes of hills within box"""
+        min_cell = self.get_cell(min_lat, min_long)
+        max_cell = self.get_cell(max_lat, max_long)
+        # Cells for each latitude are together, so a row of cells is one range of hills
+        rows = numpy.arange(min_cell[0], max_cell[0] + 1)
+        first = numpy.searchsorted(self.bucket_keys, get_keys(rows, min_cell[1]), side='left')
+        last = numpy.searchsorted(self.bucket_keys, get_keys(rows, max_cell[1]), side='right')
+        ranges = [numpy.arange(self.bucket_starts[start], self.bucket_starts[end])
+                  for start, end in zip(first.tolist(), last.tolist()) if end > start]
+        if len(ranges) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        indexes = numpy.concatenate(ranges)
+        latitudes = self.latitudes[indexes]
+        longitudes = self.longitudes[indexes]
+        return indexes[(min_lat < latitudes) & (latitudes < max_lat) & (min_long < longitudes) & (longitudes < max_long)]
+
+    def get_hill(self, index):
+        """Hill as a dict, with the csv columns hilldb uses"""
+        flags = int(self.flags[index])
+        metres = float(self.metres[index])
+        return {'Name': self.get_string(int(self.names[index])),
+                'Latitude': float(self.latitudes[index]),
+                'Longitude': float(self.longitudes[index]),
+                'Metres': int(metres) if self.metres_integer else metres,
+                'M': 1 if flags & MUNRO else 0,
+                'MT': 1 if flags & MUNRO_TOP else 0,
+                'GridrefXY': self.get_string(int(self.gridrefs[index])),
+                'Region': self.get_string(int(self.regions[index]))}
+
+    def close(self):
+        self.latitudes = self.longitudes = self.metres = self.flags = None
+        self.bucket_keys = self.bucket_starts = None
+        self.names = self.gridrefs = self.regions = self.strings = None
+        self.map.close()
+
+
+def load(csv_filename):
+    """Open compiled hill list for csv, compiling it first if it's missing or out of date"""
+    compiled_filename = get_compiled_filename(csv_filename)
+    if os.path.isfile(compiled_filename):
+        try:
+            hill_file = HillFile(compiled_filename)
+            if hill_file.is_same_time(csv_filename):
+                return hill_file
+            if hill_file.is_current(csv_filename):
+                # Touched but not changed
+                return hill_file.update_source(csv_filename)
+            hill_file.close()
+        except (ValueError, KeyError, struct.error):
+            # Not a compiled file we can read, so just replace it
+            pass
+    compile_hill_list(csv_filename, compiled_filename)
+    return HillFile(compiled_filename)
+
+
+if __name__ == "__main__":
+    import config
+    source_filename = sys.argv[1] if len(sys.argv) > 1 else config.local_path + "HillList\\DoBIH_v17_3.csv"
+    output_filename = compile_hill_list(source_filename)
+    print('%d hills compiled to %s' % (len(HillFile(output_filename)), output_filename))
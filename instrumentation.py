@@ -0,0 +1,133 @@
+"""
+Lightweight timers and counters, to see where time goes in a run.
+Each process records into the module metrics for the activity it is working on, take() hands
+them over (eg back from a worker) and starts afresh, and they are added up for the run.
+When config.instrumentation is off timer() and count() do nothing.
+
+Usage:
+    with instrumentation.timer('parse'):
+        ...
+    instrumentation.count('points', len(track))
+@author: lawrence
+"""
+
+import time
+import config
+
+enabled = config.instrumentation
+
+
+class Timer:
+    """Context manager adding elapsed time to a Metrics timing"""
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class NullTimer:
+    """Does nothing, used when instrumentation is off"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+null_timer = NullTimer()
+
+
+class Metrics:
+    """Timings (count of calls and total seconds) and counters, by name"""
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+
+    @classmethod
+    def from_dict(cls, data):
+        """From to_dict output"""
+        metrics = cls()
+        metrics.add(data)
+        return metrics
+
+    def timer(self, name):
+        if not enabled:
+            return null_timer
+        return Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        timing = self.timings.get(name)
+        if timing is None:
+            self.timings[name] = [calls, seconds]
+        else:
+            timing[0] += calls
+            timing[1] += seconds
+
+    def count(self, name, amount=1):
+        if enabled:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def add(self, other):
+        """Add in other metrics, either Metrics or as returned by to_dict (eg from a worker)"""
+        if isinstance(other, Metrics):
+            other = other.to_dict()
+        for name, (calls, seconds) in other['timings'].items():
+            self.add_time(name, seconds, calls)
+        for name, amount in other['counts'].items():
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def to_dict(self):
+        """Plain dict, can be passed between processes and written as json"""
+        return {'timings': {name: list(timing) for name, timing in self.timings.items()},
+                'counts': dict(self.counts)}
+
+    def get_summary(self, elapsed=None):
+        """Table of timings and counters, with percentage of elapsed time if given"""
+        lines = ['%-16s %8s %10s %10s %6s' % ('Stage', 'Calls', 'Total(s)', 'Mean(ms)', '%')]
+        for name, (calls, seconds) in sorted(self.timings.items(), key=lambda item: -item[1][1]):
+            lines.append('%-16s %8d %10.3f %10.2f %6s' % (name,
+                                                          calls,
+                                                          seconds,
+                                                          seconds / calls * 1000 if calls > 0 else 0,
+                                                          '%.1f' % (seconds / elapsed * 100) if elapsed else '-'))
+        if len(self.counts) > 0:
+            lines.append('%-16s %8s' % ('Counter', 'Value'))
+            for name in sorted(self.counts):
+                lines.append('%-16s %8d' % (name, self.counts[name]))
+        return '\n'.join(lines)
+
+
+# Metrics for this process, since last taken
+metrics = Metrics()
+
+
+def timer(name):
+    """Time a block of code"""
+    if not enabled:
+        return null_timer
+    return Timer(metrics, name)
+
+
+def count(name, amount=1):
+    """Add to a counter"""
+    if enabled:
+        metrics.counts[name] = metrics.counts.get(name, 0) + amount
+
+
+def take():
+    """Return metrics recorded so far, and start recording afresh"""
+    global metrics
+    taken = metrics
+    metrics = Metrics()
+    return taken
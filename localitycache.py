@@ -0,0 +1,124 @@
+"""
+Persistent cache of reverse geocode results.
+Locations are quantised to a grid of cell_size degrees and the locality for each
+cell is saved in an sqlite database, so repeat lookups for the same places
+(home, usual car parks etc) don't need to go to Open Street Map.
+Database is only created when first used, and can be shared by several processes.
+Transactions are kept short, and never held while the geocoder is called.
+@author: lawrence
+"""
+
+import sqlite3
+import time
+
+# Defaults - approx 100m cell, results kept for 90 days, up to 10000 cells
+CELL_SIZE = 0.001
+TTL = 90 * 24 * 60 * 60
+MAX_ENTRIES = 10000
+
+
+class LocalityCache:
+    """Cache of locality by quantised co-ordinates.
+    Call get() or get_many() with a geocoder function, which is only called on a miss.
+    """
+    def __init__(self, filename, cell_size=CELL_SIZE, ttl=TTL, max_entries=MAX_ENTRIES):
+        """Database isn't opened until first lookup"""
+        self.filename = filename
+        self.cell_size = cell_size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'."""
+        self.close()
+
+    def _connect(self):
+        """Open database, creating table if required"""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS locality ('
+                                    'cell_size REAL, lat_cell INTEGER, lon_cell INTEGER, '
+                                    'locality TEXT, created REAL, last_used REAL, '
+                                    'PRIMARY KEY (cell_size, lat_cell, lon_cell))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS locality_last_used ON locality (last_used)')
+            self.connection.commit()
+        return self.connection
+
+    def get_cell(self, latitude, longitude):
+        """Quantise co-ordinates to nearest cell centre"""
+        return round(latitude / self.cell_size), round(longitude / self.cell_size)
+
+    def get(self, latitude, longitude, geocoder):
+        """Return locality for co-ordinates, from cache if possible.
+        :param geocoder: function taking (latitude, longitude) and returning locality, called on a miss
+        """
+        return self.get_many([(latitude, longitude)], lambda coordinates: [geocoder(*coordinates[0])])[0]
+
+    def get_many(self, coordinates, geocoder):
+        """Return localities for list of (latitude, longitude), from cache where possible.
+        Misses are looked up together, once for each cell.
+        :param geocoder: function taking list of (latitude, longitude) and returning list of localities,
+        called with all misses. None for a failed lookup, which isn't cached.
+        """
+        connection = self._connect()
+        now = time.time()
+        localities = [None] * len(coordinates)
+        # Indexes of coordinates in each cell not in cache
+        missing = {}
+        for i, (latitude, longitude) in enumerate(coordinates):
+            lat_cell, lon_cell = self.get_cell(latitude, longitude)
+            if (lat_cell, lon_cell) in missing:
+                self.hits += 1
+                missing[(lat_cell, lon_cell)].append(i)
+                continue
+            row = connection.execute('SELECT locality, created FROM locality '
+                                     'WHERE cell_size = ? AND lat_cell = ? AND lon_cell = ?',
+                                     (self.cell_size, lat_cell, lon_cell)).fetchone()
+            if row is not None and now - row[1] < self.ttl:
+                self.hits += 1
+                connection.execute('UPDATE locality SET last_used = ? '
+                                   'WHERE cell_size = ? AND lat_cell = ? AND lon_cell = ?',
+                                   (now, self.cell_size, lat_cell, lon_cell))
+                localities[i] = row[0]
+            else:
+                # Not there or expired, so look it up
+                self.misses += 1
+                missing[(lat_cell, lon_cell)] = [i]
+        # Release write lock taken by updating last used before the (slow) lookups
+        connection.commit()
+
+        if len(missing) > 0:
+            cells = list(missing)
+            results = geocoder([coordinates[missing[cell][0]] for cell in cells])
+            with connection:
+                for (lat_cell, lon_cell), locality in zip(cells, results):
+                    for i in missing[(lat_cell, lon_cell)]:
+                        localities[i] = locality
+                    if locality is not None:
+                        connection.execute('INSERT OR REPLACE INTO locality VALUES (?, ?, ?, ?, ?, ?)',
+                                           (self.cell_size, lat_cell, lon_cell, locality, now, now))
+                self.evict()
+        return localities
+
+    def evict(self):
+        """Remove expired entries, then least recently used if over size limit"""
+        connection = self._connect()
+        connection.execute('DELETE FROM locality WHERE created <= ?', (time.time() - self.ttl,))
+        count = connection.execute('SELECT COUNT(*) FROM locality').fetchone()[0]
+        if count > self.max_entries:
+            connection.execute('DELETE FROM locality WHERE rowid IN '
+                               '(SELECT rowid FROM locality ORDER BY last_used LIMIT ?)',
+                               (count - self.max_entries,))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
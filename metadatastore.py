@@ -0,0 +1,272 @@
+"""
+Activity metadata store.
+sqlite database with a typed row for each activity - start time, type, distance, duration,
+locality and bounding box - indexed on time and type, with an R*Tree index on bounding box,
+so questions like "all cycles in 2023 near X" are index lookups rather than reading the whole
+metadata csv.
+Writes are batched, several activities to a transaction. The metadata csv can be exported
+on demand, with an ISO 8601 start time and no commas within fields.
+Database is only created when first used. When created, rows from the existing metadata
+csv (either format) are imported (without bounding box).
+Output paths are recorded in the activity index (see activityindex), not here.
+
+Usage: python metadatastore.py export [filename]
+@author: lawrence
+"""
+
+import sqlite3
+import csv
+import math
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from collections import namedtuple
+from common import METERS_PER_DEGREE, atomic_write
+
+# Activities written in a single transaction
+BATCH_SIZE = 100
+csv_columns = ['Start', 'Activity', 'Garmin ID', 'Distance', 'Duration', 'Location']
+
+# Row from store - start_time epoch seconds, duration seconds, bounds (min lat, max lat, min lon, max lon) or None
+Activity = namedtuple('Activity', ['activity_id', 'start_time', 'activity_type', 'distance', 'duration', 'locality',
+                                   'bounds'])
+# Columns read and written, named as stores created before output paths moved to the activity index have that too
+column_names = ['activity_id', 'start_time', 'activity_type', 'distance', 'duration', 'locality',
+                'min_latitude', 'max_latitude', 'min_longitude', 'max_longitude']
+
+
+def format_duration(seconds):
+    """H:MM:SS, hours can be more than 24"""
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def parse_duration(text):
+    """Seconds from str(timedelta), eg '1:02:03' or '1 day, 1:02:03'"""
+    match = re.match(r'\s*(?:(-?\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d+)?)', text)
+    if match is None:
+        return 0.0
+    days = int(match.group(1) or 0)
+    return days * 86400 + int(match.group(2)) * 3600 + int(match.group(3)) * 60 + float(match.group(4))
+
+
+class MetadataStore:
+    """Metadata for every activity, keyed by activity id.
+    Records written are held until flush(), or BATCH_SIZE have been written.
+    """
+    def __init__(self, filename, metadata_csv_filename=None):
+        """
+        :param metadata_csv_filename: existing metadata csv to import when store is created
+        """
+        self.filename = filename
+        self.metadata_csv_filename = metadata_csv_filename
+        self.connection = None
+        self.has_rtree = False
+        self.pending = []
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'."""
+        self.close()
+
+    def _connect(self):
+        """Open database, creating tables and importing metadata csv if it's new"""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            exists = self.connection.execute("SELECT name FROM sqlite_master "
+                                             "WHERE type = 'table' AND name = 'metadata'").fetchone()
+            if exists is None:
+                self.connection.execute('CREATE TABLE metadata ('
+                                        'activity_id TEXT PRIMARY KEY, start_time REAL, activity_type TEXT, '
+                                        'distance REAL, duration REAL, locality TEXT, '
+                                        'min_latitude REAL, max_latitude REAL, min_longitude REAL, max_longitude REAL)')
+                self.connection.execute('CREATE INDEX metadata_start_time ON metadata (start_time)')
+                self.connection.execute('CREATE INDEX metadata_type ON metadata (activity_type, start_time)')
+            try:
+                # Spatial index, by rowid of metadata
+                self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS metadata_bounds USING rtree('
+                                        'id, min_latitude, max_latitude, min_longitude, max_longitude)')
+                self.has_rtree = True
+            except sqlite3.OperationalError:
+                # sqlite built without R*Tree, bounding box columns are indexed instead
+                self.connection.execute('CREATE INDEX IF NOT EXISTS metadata_bounds_index '
+                                        'ON metadata (min_latitude, min_longitude)')
+            if exists is None and self.metadata_csv_filename is not None and \
+                    os.path.isfile(self.metadata_csv_filename):
+                self.import_metadata_csv(self.metadata_csv_filename)
+            self.connection.commit()
+        return self.connection
+
+    def write_record(self, record):
+        """Add activity, replacing any existing row for the same id. Saved when batch is flushed.
+        :type record: MetadataRecord
+        """
+        self.pending.append(record)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Save pending activities in a single transaction"""
+        if len(self.pending) == 0:
+            return
+        connection = self._connect()
+        with connection:
+            for record in self.pending:
+                self._save(connection,
+                           str(record.activity_id),
+                           record.start_time,
+                           record.activity_type,
+                           record.distance,
+                           record.duration.total_seconds(),
+                           record.locality,
+                           record.bounds)
+        self.pending = []
+
+    def _save(self, connection, activity_id, start_time, activity_type, distance, duration, locality, bounds):
+        """Insert or replace row, and its spatial index entry"""
+        if self.has_rtree:
+            connection.execute('DELETE FROM metadata_bounds WHERE id IN '
+                               '(SELECT rowid FROM metadata WHERE activity_id = ?)', (activity_id,))
+        if bounds is None:
+            bounds = (None, None, None, None)
+        cursor = connection.execute('INSERT OR REPLACE INTO metadata (%s) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                                    % ', '.join(column_names),
+                                    (activity_id, start_time, activity_type, float(distance), duration, locality,
+                                     bounds[0], bounds[1], bounds[2], bounds[3]))
+        if self.has_rtree and bounds[0] is not None:
+            connection.execute('INSERT INTO metadata_bounds VALUES (?, ?, ?, ?, ?)',
+                               (cursor.lastrowid, bounds[0], bounds[1], bounds[2], bounds[3]))
+
+    def get(self, activity_id):
+        """Activity for id, None if not in store"""
+        self.flush()
+        row = self._connect().execute('SELECT %s FROM metadata WHERE activity_id = ?' % ', '.join(column_names),
+                                      (str(activity_id),)).fetchone()
+        return None if row is None else self._get_activity(row)
+
+    @staticmethod
+    def _get_activity(row):
+        bounds = None if row[6] is None else tuple(row[6:10])
+        return Activity(row[0], row[1], row[2], row[3], row[4], row[5], bounds)
+
+    def query(self, activity_type=None, start_time=None, end_time=None, near=None):
+        """Activities matching all conditions given, in start time order.
+        :param start_time: epoch seconds, activities starting at or after
+        :param end_time: epoch seconds, activities starting before
+        :param near: (latitude, longitude, meters) - activities whose bounding box comes within meters of point
+        :rtype: list of Activity
+        """
+        self.flush()
+        conditions = []
+        parameters = []
+        if activity_type is not None:
+            conditions.append('metadata.activity_type = ?')
+            parameters.append(activity_type)
+        if start_time is not None:
+            conditions.append('metadata.start_time >= ?')
+            parameters.append(start_time)
+        if end_time is not None:
+            conditions.append('metadata.start_time < ?')
+            parameters.append(end_time)
+        tables = 'metadata'
+        if near is not None:
+            latitude, longitude, meters = near
+            latitude_margin = meters / METERS_PER_DEGREE
+            longitude_margin = meters / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+            if self.has_rtree:
+                tables = 'metadata JOIN metadata_bounds ON metadata_bounds.id = metadata.rowid'
+                prefix = 'metadata_bounds.'
+            else:
+                prefix = 'metadata.'
+            conditions.append('%smin_latitude <= ? AND %smax_latitude >= ? AND '
+                              '%smin_longitude <= ? AND %smax_longitude >= ?' % (prefix, prefix, prefix, prefix))
+            parameters.extend([latitude + latitude_margin, latitude - latitude_margin,
+                               longitude + longitude_margin, longitude - longitude_margin])
+        sql = 'SELECT %s FROM %s' % (', '.join('metadata.' + column for column in column_names), tables)
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY metadata.start_time'
+        return [self._get_activity(row) for row in self._connect().execute(sql, parameters)]
+
+    def export_csv(self, filename):
+        """Write every activity to csv in start time order.
+        Start is ISO 8601 local time with UTC offset, duration H:MM:SS.
+        Written to a temp file and renamed. Returns number of activities written.
+        """
+        activities = self.query()
+        with atomic_write(filename) as temp_filename, \
+                open(temp_filename, 'w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(csv_columns)
+            for activity in activities:
+                writer.writerow([datetime.fromtimestamp(activity.start_time).astimezone().isoformat(timespec='seconds'),
+                                 activity.activity_type,
+                                 'activity_%s' % activity.activity_id,
+                                 '%d' % activity.distance,
+                                 format_duration(activity.duration),
+                                 activity.locality])
+        return len(activities)
+
+    def import_metadata_csv(self, filename):
+        """Import activities from metadata csv"""
+        connection = self._connect()
+        for activity in read_metadata_csv(filename):
+            self._save(connection, activity.activity_id, activity.start_time, activity.activity_type,
+                       activity.distance, activity.duration, activity.locality, None)
+        connection.commit()
+
+    def close(self):
+        """Save anything pending and close"""
+        self.flush()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def read_metadata_csv(filename):
+    """Activities (without bounds) from metadata csv, either as exported or as filtergpx used to write it.
+    The old format has date and time separated by ', ', so they are the first two fields and the id
+    is the fourth, and durations of a day or more have a comma too.
+    Rows that can't be read are skipped.
+    """
+    with open(filename, 'r', encoding='utf-8', newline='') as file:
+        header = file.readline()
+        if header.startswith(csv_columns[0] + ','):
+            for fields in csv.reader(file):
+                if len(fields) < len(csv_columns) or not fields[2].startswith('activity_'):
+                    continue
+                try:
+                    start_time = datetime.fromisoformat(fields[0]).timestamp()
+                    distance = float(fields[3])
+                except ValueError:
+                    continue
+                yield Activity(fields[2][len('activity_'):], start_time, fields[1], distance,
+                               parse_duration(fields[4]), fields[5], None)
+            return
+        for line in file:
+            fields = line.rstrip('\r\n').split(',')
+            if len(fields) < 7 or not fields[3].startswith('activity_'):
+                continue
+            try:
+                start_time = time.mktime(time.strptime(fields[0] + ',' + fields[1], '%Y-%m-%d, %H:%M'))
+                distance = float(fields[4])
+            except ValueError:
+                continue
+            yield Activity(fields[3][len('activity_'):], start_time, fields[2], distance,
+                           parse_duration(','.join(fields[5:-1])), fields[-1], None)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'export':
+        print('Usage: python metadatastore.py export [filename]')
+        sys.exit(1)
+    import filtergpx
+    store = filtergpx.get_activity_metadata().store
+    export_filename = sys.argv[2] if len(sys.argv) > 2 else store.metadata_csv_filename
+    print('%d activities exported to %s' % (store.export_csv(export_filename), export_filename))
@@ -1,27 +1,205 @@
 """Process local files gpx files
 Processes all gpx files in a directory.
 Uses files name as an id.
+With config.import_workers > 1 files are processed in parallel by a pool of processes.
+Workers return metadata, which is written here in filename order so the metadata store has a single writer.
+Timings and counters for each file are logged as json lines, and summarised at the end.
+With --watch, keeps running and processes files as they arrive (see folderwatcher).
 """
 
 import filtergpx
 import os
+import sys
+import time
 import config
+import instrumentation
+from activityindex import SOURCE_LOCAL
+from common import get_file_hash
+from folderwatcher import FolderWatcher
+from concurrent.futures import ProcessPoolExecutor
 
 
 root_path = config.local_path
 raw_path = root_path + "Import\\Raw"
 import_path = root_path + "Import\\FilesIn"
 
-files_processed = 0
-# Iterate over every gpx file in dir
-for entry in os.scandir(import_path):
-    if (entry.path.endswith(".gpx")):
-        with open(entry.path, 'r') as input_file:
-            filtergpx.process_gpx(os.path.basename(entry.path).replace('.gpx', ''), input_file.read())
-#        print("%s processed" % entry.path)
-        files_processed += 1
-        # Move file now it's done
-        os.rename(entry.path, raw_path + "\\" + os.path.basename(entry.path))
 
-print('%d files processed' % files_processed)
+def get_activity_id(path):
+    return os.path.basename(path).replace('.gpx', '')
 
+
+def get_content_hash(path):
+    with instrumentation.timer('hash'):
+        return get_file_hash(path)
+
+
+def process_file(path, content_hash):
+    """Process a single file, can run in a worker process.
+    :rtype: filtergpx.ProcessResult
+    """
+    records = filtergpx.MetadataRecords()
+    locality_cache = filtergpx.get_locality_cache()
+    hits = locality_cache.hits
+    misses = locality_cache.misses
+    # Only this file's metrics are returned
+    instrumentation.take()
+    with open(path, 'r') as input_file:
+        output_paths = filtergpx.process_gpx(get_activity_id(path), input_file, records)
+
+    return filtergpx.ProcessResult(records.records, output_paths, content_hash,
+                                   locality_cache.hits - hits, locality_cache.misses - misses,
+                                   instrumentation.take().to_dict(), records.heatmap_updates)
+
+
+def move_to_raw(path):
+    os.rename(path, raw_path + "\\" + os.path.basename(path))
+
+
+def process_files(paths, workers, status, run_metrics, executor=None):
+    """Process files, in parallel if workers > 1.
+    Results are handled in the order of paths whichever order they complete in.
+    Files already processed with the same content by the current version are just moved.
+    :type status: filtergpx.State
+    :type run_metrics: instrumentation.Metrics
+    :param executor: pool of worker processes to use, one is created (and shut down) if not given and workers > 1
+    :type executor: ProcessPoolExecutor
+    """
+    files_skipped = 0
+    new_paths = []
+    content_hashes = []
+    for path in paths:
+        content_hash = get_content_hash(path)
+        if filtergpx.get_activity_index().is_current(SOURCE_LOCAL, get_activity_id(path),
+                                                     filtergpx.PROCESSING_VERSION, content_hash):
+            move_to_raw(path)
+            files_skipped += 1
+        else:
+            new_paths.append(path)
+            content_hashes.append(content_hash)
+    if files_skipped > 0:
+        print('%d files already processed' % files_skipped)
+    instrumentation.count('files_skipped', files_skipped)
+    # Hashing done here, rather than per file
+    run_metrics.add(instrumentation.take())
+    paths = new_paths
+
+    pool = executor
+    if pool is None and workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    if pool is not None:
+        futures = [pool.submit(process_file, path, content_hash)
+                   for path, content_hash in zip(paths, content_hashes)]
+    else:
+        futures = None
+
+    files_processed = 0
+    cache_hits = 0
+    cache_misses = 0
+    try:
+        for i, path in enumerate(paths):
+            try:
+                if futures is not None:
+                    result = futures[i].result()
+                else:
+                    result = process_file(path, content_hashes[i])
+            except Exception as err:  # pylint: disable=broad-except
+                # Leave file where it is so it can be tried again
+                print('Error processing %s: %s' % (path, err))
+                continue
+            # Metadata is saved a batch at a time
+            for record in result.records:
+                filtergpx.get_activity_metadata().write_record(record)
+            for update in result.heatmap_updates:
+                filtergpx.get_heatmap().add(SOURCE_LOCAL, *update)
+            filtergpx.get_activity_index().record(SOURCE_LOCAL, get_activity_id(path), result.content_hash,
+                                                  result.output_paths, filtergpx.PROCESSING_VERSION)
+            cache_hits += result.cache_hits
+            cache_misses += result.cache_misses
+            filtergpx.record_activity_metrics(status, SOURCE_LOCAL, get_activity_id(path),
+                                              instrumentation.Metrics.from_dict(result.metrics), run_metrics)
+#            print("%s processed" % path)
+            files_processed += 1
+            # Move file now it's done and outputs are written
+            move_to_raw(path)
+    finally:
+        # Rest of the metadata, even if interrupted
+        filtergpx.get_activity_metadata().flush()
+        if pool is not None and executor is None:
+            pool.shutdown()
+
+    print('Locality cache: %d hits, %d misses' % (cache_hits, cache_misses))
+
+    return files_processed
+
+
+def watch(workers, status, run_metrics):
+    """Process gpx files as soon as they are fully written to the import folder, until interrupted.
+    Everything stays loaded (and worker processes running) between files, so each file only costs
+    its processing. Queue depth and processing rate are reported every config.watch_report_seconds.
+    Returns number of files processed.
+    :type status: filtergpx.State
+    :type run_metrics: instrumentation.Metrics
+    """
+    files_processed = 0
+    report_files = 0
+    report_time = time.time()
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    with FolderWatcher(import_path, '.gpx', config.watch_settle_seconds, config.watch_poll_seconds,
+                       poll_settle=config.watch_poll_settle_seconds) as watcher:
+        print('Watching %s (%s), Ctrl-C to stop' % (import_path, 'polling' if watcher.inotify is None else 'inotify'))
+        try:
+            while True:
+                paths = watcher.wait(max(report_time + config.watch_report_seconds - time.time(), 0))
+                if len(paths) > 0:
+                    batch_start = time.time()
+                    processed = process_files(paths, workers, status, run_metrics, executor)
+                    files_processed += processed
+                    report_files += processed
+                    print('%d files processed in %.2fs, %d queued' % (processed, time.time() - batch_start,
+                                                                       watcher.get_queue_depth()))
+                now = time.time()
+                if now - report_time >= config.watch_report_seconds:
+                    rate = report_files / (now - report_time)
+                    print('Queue depth %d, %.2f files/s, %d files processed' % (watcher.get_queue_depth(), rate,
+                                                                                 files_processed))
+                    if instrumentation.enabled:
+                        status.Record('watch', {'queue_depth': watcher.get_queue_depth(), 'files_per_second': rate,
+                                                'files': files_processed})
+                    report_files = 0
+                    report_time = now
+        except KeyboardInterrupt:
+            print('Stopped watching')
+        finally:
+            if executor is not None:
+                executor.shutdown()
+    return files_processed
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    status = filtergpx.State()
+    run_metrics = instrumentation.Metrics()
+    if '--watch' in sys.argv[1:]:
+        files_processed = watch(config.import_workers, status, run_metrics)
+        elapsed = time.time() - start_time
+        print('%d files processed' % files_processed)
+    else:
+        # Every gpx file in dir, sorted so metadata is always written in the same order
+        gpx_files = sorted(entry.path for entry in os.scandir(import_path) if entry.path.endswith(".gpx"))
+        bytes_in = sum(os.path.getsize(path) for path in gpx_files)
+
+        files_processed = process_files(gpx_files, config.import_workers, status, run_metrics)
+
+        elapsed = time.time() - start_time
+        print('%d files processed' % files_processed)
+        if elapsed > 0:
+            print('%.1fs with %d workers, %.2f files/s, %.2f MB/s' % (elapsed,
+                                                                      config.import_workers,
+                                                                      files_processed / elapsed,
+                                                                      bytes_in / elapsed / 1e6))
+    if instrumentation.enabled:
+        status.Record('run', {'elapsed': elapsed, 'files': files_processed, 'workers': config.import_workers,
+                              **run_metrics.to_dict()})
+        print(run_metrics.get_summary(elapsed))
+    filtergpx.get_activity_metadata().store.close()
+    status.Close()
@@ -0,0 +1,101 @@
+"""
+Rate limiters for requests to the same service.
+TokenBucket is shared by threads, SharedRateLimiter by every process using the same file.
+@author: lawrence
+"""
+
+import sqlite3
+import threading
+import time
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to capacity.
+    Call acquire() before each request, it blocks until the request is allowed.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.monotonic()
+        # Set by pause() when the service tells us to back off
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait for a token"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop all requests for a while, eg after a too many requests response"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class SharedRateLimiter:
+    """Allows rate requests per second between all processes (and their threads) using filename.
+    Time the next request is allowed is kept in an sqlite database. acquire() reserves the next
+    slot in a short transaction then waits for it, so requests are evenly spaced, without bursts.
+    Same interface as TokenBucket. Database is only created when first used.
+    """
+    def __init__(self, filename, rate):
+        self.filename = filename
+        self.interval = 1 / rate
+        self.connection = None
+        # Connection is shared by threads
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        """To allow use of 'with'."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """"To allow use of 'with'."""
+        self.close()
+
+    def _connect(self):
+        """Open database, creating table if required"""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS rate_limit (id INTEGER PRIMARY KEY, next_allowed REAL)')
+            self.connection.commit()
+        return self.connection
+
+    def _update(self, get_next_allowed):
+        """Set next allowed time to get_next_allowed(now, current next allowed), returns (now, current)"""
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                # Write lock taken before reading, so no other process can reserve the same slot
+                connection.execute('BEGIN IMMEDIATE')
+                now = time.time()
+                row = connection.execute('SELECT next_allowed FROM rate_limit WHERE id = 0').fetchone()
+                next_allowed = now if row is None else row[0]
+                connection.execute('INSERT OR REPLACE INTO rate_limit VALUES (0, ?)',
+                                   (get_next_allowed(now, next_allowed),))
+        return now, next_allowed
+
+    def acquire(self):
+        """Wait for the next free slot"""
+        now, next_allowed = self._update(lambda now, next_allowed: max(now, next_allowed) + self.interval)
+        if next_allowed > now:
+            time.sleep(next_allowed - now)
+
+    def pause(self, seconds):
+        """Stop all requests, from every process, for a while"""
+        self._update(lambda now, next_allowed: max(next_allowed, now + seconds))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
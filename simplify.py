@@ -0,0 +1,104 @@
+"""
+Error bounded track simplification (Douglas-Peucker).
+Points are projected to local planar meters, then the track is split at its worst point
+until every dropped point is within max_error of the simplified line, or there are
+target_points. Segments are kept in a heap, worst first, rather than recursing, so it
+works on tracks of any length and can stop at a point count.
+@author: lawrence
+"""
+
+import heapq
+import math
+import numpy
+
+# Mean earth radius (meters), plenty accurate for deviations over an activity
+EARTH_RADIUS = 6371008.8
+
+
+def project(latitudes, longitudes):
+    """Local x, y in meters - equirectangular about the track's mean latitude"""
+    latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+    longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+    scale = math.cos(math.radians(numpy.mean(latitudes))) if len(latitudes) > 0 else 1.0
+    return numpy.radians(longitudes) * EARTH_RADIUS * scale, numpy.radians(latitudes) * EARTH_RADIUS
+
+
+def get_segment_distances(x, y, start_x, start_y, end_x, end_y):
+    """Distance of points from line segments, all arguments arrays (or scalars) that broadcast"""
+    dx = end_x - start_x
+    dy = end_y - start_y
+    px = x - start_x
+    py = y - start_y
+    length_sq = dx * dx + dy * dy
+    # Segment may be a single point, if track comes back to where it was
+    safe_length_sq = numpy.where(length_sq == 0, 1.0, length_sq)
+    t = numpy.where(length_sq == 0, 0.0, numpy.clip((px * dx + py * dy) / safe_length_sq, 0.0, 1.0))
+    return numpy.hypot(px - t * dx, py - t * dy)
+
+
+def simplify(x, y, max_error=0.0, target_points=0):
+    """Douglas-Peucker simplification of planar track.
+    Stops when no dropped point is more than max_error from the simplified line or,
+    if target_points > 0, there are that many points.
+    Returns (sorted indices of points kept, largest distance of a dropped point from the line)
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    count = len(x)
+    if count <= 2:
+        return numpy.arange(count), 0.0
+
+    keep = numpy.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    points_kept = 2
+    # (-deviation, start, end, index of worst point) for each segment with points between ends
+    heap = []
+
+    def add_segment(start, end):
+        if end - start > 1:
+            # Scalar ends, so cheaper than get_segment_distances - this is called for every point kept
+            start_x = x[start]
+            start_y = y[start]
+            dx = x[end] - start_x
+            dy = y[end] - start_y
+            px = x[start + 1:end] - start_x
+            py = y[start + 1:end] - start_y
+            length_sq = dx * dx + dy * dy
+            if length_sq > 0:
+                t = (px * dx + py * dy) / length_sq
+                numpy.clip(t, 0.0, 1.0, out=t)
+                px -= t * dx
+                py -= t * dy
+            distances_sq = px * px + py * py
+            worst = int(distances_sq.argmax())
+            heapq.heappush(heap, (-math.sqrt(distances_sq[worst]), start, end, start + 1 + worst))
+
+    add_segment(0, count - 1)
+    while len(heap) > 0:
+        if -heap[0][0] <= max_error or (0 < target_points <= points_kept):
+            break
+        _, start, end, split = heapq.heappop(heap)
+        keep[split] = True
+        points_kept += 1
+        add_segment(start, split)
+        add_segment(split, end)
+
+    max_deviation = -heap[0][0] if len(heap) > 0 else 0.0
+    return numpy.flatnonzero(keep), max_deviation
+
+
+def get_max_deviation(x, y, indices):
+    """Largest distance of any point from the line through the points at indices.
+    Only points between the first and last index are checked.
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    indices = numpy.asarray(indices, dtype=numpy.int64)
+    if len(indices) < 2:
+        return 0.0
+    points = numpy.arange(indices[0], indices[-1] + 1)
+    # Segment each point falls in, last index belongs to last segment
+    segments = numpy.minimum(numpy.searchsorted(indices, points, side='right') - 1, len(indices) - 2)
+    starts = indices[segments]
+    ends = indices[segments + 1]
+    return float(get_segment_distances(x[points], y[points], x[starts], y[starts], x[ends], y[ends]).max())
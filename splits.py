@@ -0,0 +1,79 @@
+"""
+Split times for any number of split distances, from a track's cumulative distances.
+Boundaries for every distance are found together, by binary search of the cumulative
+distance, with the time interpolated between the points either side - so each split is
+exactly the split distance rather than ending at the first point past it.
+Used by filtergpx and gpxtocsv.
+@author: lawrence
+"""
+
+from datetime import timedelta
+import os
+import time
+import numpy
+from csvsink import CSVSink
+from common import get_pace
+csv_header = 'Date,Time,Split Time,Split Distance,Total Time,Total Distance,Pace,Pace(m:s)\n'
+csv_format_string = '%s,%s,%.0f,%s,%.0f,%.2f,%02d:%02d\n'
+column_names = ['Time', 'Split Time', 'Split Distance', 'Total Time', 'Total Distance', 'Pace']
+
+
+def calculate_splits(times, total_distances, split_distances):
+    """Splits for each of split_distances (meters), in one pass over the track.
+    times are epoch seconds, total_distances cumulative meters from the first point.
+    Returns a table for each distance - dict of arrays, keyed by column_names. Times are
+    epoch seconds and durations seconds, both interpolated so not whole seconds.
+    Points with no time (nan) are skipped, their distance still counts towards the next point.
+    """
+    times = numpy.asarray(times, dtype=numpy.float64)
+    total_distances = numpy.asarray(total_distances, dtype=numpy.float64)
+    timed = ~numpy.isnan(times)
+    if not timed.all():
+        times = times[timed]
+        total_distances = total_distances[timed]
+    if len(times) < 2 or len(split_distances) == 0:
+        return [{name: numpy.zeros(0) for name in column_names} for _ in split_distances]
+    boundaries = [numpy.arange(1, int(total_distances[-1] // split_distance) + 1) * float(split_distance)
+                  for split_distance in split_distances]
+
+    # First point at or past each boundary, and the one before it
+    all_boundaries = numpy.concatenate(boundaries)
+    after = numpy.clip(numpy.searchsorted(total_distances, all_boundaries, side='left'), 1, len(times) - 1)
+    before = after - 1
+    span = total_distances[after] - total_distances[before]
+    fraction = numpy.where(span > 0, (all_boundaries - total_distances[before]) / numpy.where(span > 0, span, 1.0), 1.0)
+    all_times = times[before] + fraction * (times[after] - times[before])
+
+    tables = []
+    start = 0
+    for split_distance, distance_boundaries in zip(split_distances, boundaries):
+        boundary_times = all_times[start:start + len(distance_boundaries)]
+        start += len(distance_boundaries)
+        split_times = numpy.diff(boundary_times, prepend=times[0])
+        tables.append({'Time': boundary_times,
+                       'Split Time': split_times,
+                       'Split Distance': numpy.full(len(distance_boundaries), float(split_distance)),
+                       'Total Time': boundary_times - times[0],
+                       'Total Distance': distance_boundaries,
+                       'Pace': get_pace(split_times, split_distance)})
+    return tables
+
+
+def write_csv(filename, table, time_format='%Y-%m-%d, %H:%M:%S', utc=False):
+    """Write split table to csv (via temp file, so it appears complete). Returns number of splits written.
+    Times and durations are shown to the nearest second, pace output as decimal minutes and MM:SS.
+    """
+    convert_time = time.gmtime if utc else time.localtime
+    with CSVSink(os.path.dirname(os.path.abspath(filename)), csv_header) as csv_sink:
+        for split_time, split_seconds, split_distance, total_seconds, total_distance, pace in \
+                zip(*(table[name].tolist() for name in column_names)):
+            csv_sink.write(csv_format_string % (time.strftime(time_format, convert_time(round(split_time))),
+                                                timedelta(seconds=round(split_seconds)),
+                                                split_distance,
+                                                timedelta(seconds=round(total_seconds)),
+                                                total_distance,
+                                                pace,
+                                                int(pace),
+                                                (pace % 1 * 60)))
+        csv_sink.commit(filename)
+        return csv_sink.lines_written
@@ -0,0 +1,96 @@
+"""
+Deterministic synthetic gpx tracks and hill lists, for benchmarking.
+Same parameters always give the same file.
+@author: lawrence
+"""
+
+import math
+import numpy
+from gpxstream import iter_chunks
+from common import METERS_PER_DEGREE
+
+# Points generated and written at a time, so large tracks don't need much memory
+BLOCK_SIZE = 10000
+
+gpx_header = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<gpx version="1.1" creator="syntheticgpx" xmlns="http://www.topografix.com/GPX/1/1">\n'
+              '<trk><name>Synthetic</name><trkseg>\n')
+gpx_footer = '</trkseg></trk></gpx>\n'
+gpx_point_format_string = '<trkpt lat="%.7f" lon="%.7f"><ele>%.1f</ele><time>%s</time></trkpt>\n'
+hill_csv_header = 'Number,Name,Latitude,Longitude,Metres,M,MT,GridrefXY,Region\n'
+
+
+def generate_track(points, interval=1, speed=3.0, stationary_every=0, stationary_length=0, seed=0,
+                   start=(56.8, -5.0), start_time=1682928000):
+    """Yield blocks of (latitudes, longitudes, elevations, times) arrays.
+    Wanders with a slowly changing heading at around speed m/s, one point every interval seconds.
+    If stationary_every > 0, stops for stationary_length points every stationary_every points,
+    with a little GPS jitter.
+    """
+    rng = numpy.random.RandomState(seed)
+    latitude, longitude = start
+    elevation = 300.0
+    heading = 0.0
+    index = 0
+    while index < points:
+        count = min(BLOCK_SIZE, points - index)
+        point_index = numpy.arange(index, index + count)
+        headings = heading + numpy.cumsum(rng.normal(0, 0.1, count))
+        steps = numpy.abs(rng.normal(speed * interval, speed * interval * 0.2, count))
+        if stationary_every > 0:
+            stopped = (point_index % stationary_every) < stationary_length
+            steps[stopped] = rng.normal(0, 1.0, stopped.sum())
+        north = steps * numpy.cos(headings)
+        east = steps * numpy.sin(headings)
+        latitudes = latitude + numpy.cumsum(north) / METERS_PER_DEGREE
+        longitudes = longitude + numpy.cumsum(east) / (METERS_PER_DEGREE * math.cos(math.radians(latitude)))
+        elevations = elevation + numpy.cumsum(rng.normal(0, 0.5, count))
+        times = start_time + point_index * interval
+        yield latitudes, longitudes, elevations, times
+
+        latitude, longitude = latitudes[-1], longitudes[-1]
+        elevation = elevations[-1]
+        heading = headings[-1]
+        index += count
+
+
+def write_gpx(filename, points, **kwargs):
+    """Write synthetic track to gpx file, parameters as generate_track"""
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write(gpx_header)
+        for latitudes, longitudes, elevations, times in generate_track(points, **kwargs):
+            time_strings = numpy.datetime_as_string(times.astype('datetime64[s]'), unit='s')
+            file.write(''.join(gpx_point_format_string % (latitudes[i], longitudes[i], elevations[i], time_strings[i] + 'Z')
+                               for i in range(len(latitudes))))
+        file.write(gpx_footer)
+
+
+def write_hill_list(filename, gpx_filenames, near_track=50, others=20000, seed=0):
+    """Write hill list in DoBIH csv format.
+    For each track, near_track hills are placed within a few meters of random points on it,
+    plus others scattered over Scotland.
+    """
+    rng = numpy.random.RandomState(seed)
+    hill_latitudes = [rng.uniform(55.0, 58.6, others)]
+    hill_longitudes = [rng.uniform(-7.5, -2.0, others)]
+    for gpx_filename in gpx_filenames:
+        chunks = list(iter_chunks(gpx_filename))
+        latitudes = numpy.concatenate([chunk[0] for chunk in chunks])
+        longitudes = numpy.concatenate([chunk[1] for chunk in chunks])
+        chosen = rng.randint(0, len(latitudes), near_track)
+        hill_latitudes.append(latitudes[chosen] + rng.normal(0, 0.00005, near_track))
+        hill_longitudes.append(longitudes[chosen] + rng.normal(0, 0.00005, near_track))
+    hill_latitudes = numpy.concatenate(hill_latitudes)
+    hill_longitudes = numpy.concatenate(hill_longitudes)
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write(hill_csv_header)
+        for i in range(len(hill_latitudes)):
+            file.write('%d,Hill %d,%.6f,%.6f,%d,%d,%d,NN%06d,Region %d\n' % (i + 1,
+                                                                              i + 1,
+                                                                              hill_latitudes[i],
+                                                                              hill_longitudes[i],
+                                                                              900 + i % 400,
+                                                                              i % 3 == 0,
+                                                                              i % 3 == 1,
+                                                                              i,
+                                                                              i % 20))
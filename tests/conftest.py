@@ -0,0 +1,8 @@
+"""
+Modules are at the top level of the repo, so make them importable from the tests.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
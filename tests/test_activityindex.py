@@ -0,0 +1,60 @@
+"""
+ActivityIndex, and choosing which Garmin activities to process from it.
+"""
+
+import os
+import pytest
+
+import filtergpx
+from activityindex import ActivityIndex, SOURCE_GARMIN, SOURCE_LOCAL
+
+
+def test_record_and_get(tmp_path):
+    with ActivityIndex(str(tmp_path / 'index.sqlite')) as index:
+        assert index.get(SOURCE_GARMIN, 1) is None
+        index.record(SOURCE_GARMIN, 1, 'abc', ['a.gpx'], 1)
+        assert index.is_current(SOURCE_GARMIN, 1, 1)
+        assert index.is_current(SOURCE_GARMIN, 1, 1, 'abc')
+        assert not index.is_current(SOURCE_GARMIN, 1, 1, 'def')
+        assert not index.is_current(SOURCE_GARMIN, 1, 2)
+        assert not index.is_current(SOURCE_LOCAL, 1, 1)
+        assert index.get(SOURCE_GARMIN, '1')['output_paths'] == ['a.gpx']
+
+
+def test_import_metadata_csv(tmp_path):
+    csv_filename = str(tmp_path / 'ProcessGPX.csv')
+    with open(csv_filename, 'w') as file:
+        file.write('Date,Time,Activity,Garmin ID,Distance,Duration,Location\n'
+                   '2021-01-09, 10:15,Run,activity_123,5012,0:33:19,Town\n'
+                   '2021-01-10, 08:00,Walk,activity_walk1,3000,1 day, 2:03:04,Village\n')
+    with ActivityIndex(str(tmp_path / 'index.sqlite'), csv_filename) as index:
+        assert index.is_current(SOURCE_GARMIN, 123, 1)
+        assert index.is_current(SOURCE_LOCAL, 'walk1', 1)
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(filtergpx, 'get_output_path', lambda activity='', year='': str(tmp_path) + os.sep)
+    monkeypatch.setattr(filtergpx, 'activity_index', ActivityIndex(str(tmp_path / 'index.sqlite')))
+    yield filtergpx.activity_index
+    filtergpx.activity_index.close()
+
+
+def test_outdated_activities_processed(index, monkeypatch):
+    monkeypatch.setattr(filtergpx, 'PROCESSING_VERSION', 2)
+    index.record(SOURCE_GARMIN, 1, None, [], 1)
+    index.record(SOURCE_GARMIN, 2, None, [], 2)
+    index.record(SOURCE_GARMIN, 3, None, [], 1)
+    index.record(SOURCE_LOCAL, 'walk', None, [], 1)
+    recent = [{'activityId': 4}, {'activityId': 3}, {'activityId': 2}]
+    # New, then outdated among recent, then outdated older ones
+    assert filtergpx.get_activity_ids(recent) == [4, 3, 1]
+
+
+def test_import_exported_csv(tmp_path):
+    csv_filename = str(tmp_path / 'ProcessGPX.csv')
+    with open(csv_filename, 'w') as file:
+        file.write('Start,Activity,Garmin ID,Distance,Duration,Location\n'
+                   '2021-01-09T10:15:00+00:00,Run,activity_123,5012,0:33:19,Town\n')
+    with ActivityIndex(str(tmp_path / 'index.sqlite'), csv_filename) as index:
+        assert index.is_current(SOURCE_GARMIN, 123, 1)
@@ -0,0 +1,50 @@
+"""
+Columnar metadata dataset - batches, and activities replaced when reprocessed - and split times.
+"""
+
+import os
+from datetime import timedelta
+import numpy
+import pytest
+
+pytest.importorskip('pyarrow')
+
+import columnar
+from filtergpx import MetadataRecord
+
+
+def get_record(activity_id, activity_type, start_time=1682928000.0):
+    return MetadataRecord(start_time, activity_type, activity_id, 5000.0, timedelta(minutes=25), 'Town')
+
+
+@pytest.mark.parametrize('file_format', [columnar.PARQUET, columnar.ARROW])
+def test_metadata_replaced_when_reprocessed(tmp_path, file_format):
+    root_path = str(tmp_path) + os.sep
+    filenames = columnar.write_metadata(root_path, [get_record(1, 'Run'), get_record(2, 'Run'),
+                                                    get_record(3, 'Cycle')], file_format)
+    # One file per partition
+    assert len(filenames) == 2
+    # 1 changes type, 2 is replaced, 3 is in a partition that isn't otherwise touched
+    columnar.write_metadata(root_path, [get_record(1, 'Hike'), get_record(2, 'Run'), get_record(2, 'Run')],
+                            file_format)
+    table = columnar.read_metadata(root_path, file_format)
+    assert sorted(zip(table['Activity ID'].to_pylist(), table['activity'].to_pylist())) == \
+        [('1', 'Hike'), ('2', 'Run'), ('3', 'Cycle')]
+    columnar.write_metadata(root_path, [get_record(2, 'Hike')], file_format)
+    # Partition left empty is removed
+    assert not os.path.exists(columnar.get_metadata_path(root_path, 'Run', '2023') +
+                              columnar.METADATA_NAME + columnar.get_extension(file_format))
+    assert columnar.read_metadata(root_path, file_format, 'Hike')['Activity ID'].to_pylist() == ['1', '2']
+
+
+def test_split_without_time_is_null(tmp_path):
+    filename = columnar.write_splits(str(tmp_path / 'split'),
+                                     {'Time': numpy.array([1682928083.4, numpy.nan]),
+                                      'Split Time': numpy.array([83.4, numpy.nan]),
+                                      'Split Distance': numpy.array([250.0, 250.0]),
+                                      'Total Time': numpy.array([83.4, numpy.nan]),
+                                      'Total Distance': numpy.array([250.0, 500.0]),
+                                      'Pace': numpy.array([8.9, numpy.nan])},
+                                     columnar.PARQUET)
+    times = columnar.read_table(filename, columnar.PARQUET)['Time'].to_pylist()
+    assert times[0].timestamp() == 1682928083 and times[1] is None
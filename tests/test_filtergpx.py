@@ -0,0 +1,76 @@
+"""
+Processing of whole tracks, with points that have no time or the same time as the one before.
+"""
+
+import csv
+import glob
+import math
+import os
+import pytest
+
+import filtergpx
+import syntheticgpx
+
+
+@pytest.fixture
+def output_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(filtergpx, 'get_output_path', lambda activity='', year='': str(tmp_path) + os.sep)
+    monkeypatch.setattr(filtergpx, 'get_localities', lambda coordinates: ['Town'] * len(coordinates))
+    return tmp_path
+
+
+def edit_points(filename, indices, edit):
+    """Replace line of each point in indices with edit(line, line of point before)"""
+    with open(filename) as file:
+        lines = file.readlines()
+    offset = syntheticgpx.gpx_header.count('\n')
+    for index in indices:
+        lines[offset + index] = edit(lines[offset + index], lines[offset + index - 1])
+    with open(filename, 'w') as file:
+        file.writelines(lines)
+
+
+def get_time(line):
+    return line[line.index('<time>'):line.index('</time>') + len('</time>')]
+
+
+def remove_time(line, previous_line):
+    return line.replace(get_time(line), '')
+
+
+def repeat_time(line, previous_line):
+    return line.replace(get_time(line), get_time(previous_line))
+
+
+def read_csv(filename):
+    with open(filename) as file:
+        return list(csv.DictReader(file))
+
+
+def test_run_with_point_without_time(output_path):
+    gpx_filename = str(output_path / 'run.gpx')
+    syntheticgpx.write_gpx(gpx_filename, 1000, interval=1, speed=3.0)
+    edit_points(gpx_filename, range(400, 600), remove_time)
+    records = filtergpx.MetadataRecords()
+    filtergpx.process_gpx('run', gpx_filename, records)
+    assert records.records[0].activity_type == 'Run'
+    rows = read_csv(glob.glob(str(output_path / 'Run_*_split.csv'))[0])
+    # About 3km at 3 m/s, 250m splits, each around 83 seconds
+    assert len(rows) >= 10
+    split_seconds = [sum(int(part) * 60 ** i for i, part in enumerate(reversed(row['Split Time'].split(':'))))
+                     for row in rows]
+    assert all(60 <= seconds <= 110 for seconds in split_seconds)
+
+
+@pytest.mark.filterwarnings('error')
+def test_cycle_with_repeated_time(output_path):
+    gpx_filename = str(output_path / 'cycle.gpx')
+    syntheticgpx.write_gpx(gpx_filename, 1000, interval=1, speed=6.0)
+    edit_points(gpx_filename, [500, 501], repeat_time)
+    records = filtergpx.MetadataRecords()
+    filtergpx.process_gpx('cycle', gpx_filename, records)
+    assert records.records[0].activity_type == 'Cycle'
+    rows = read_csv(glob.glob(str(output_path / 'Cycle_*_points.csv'))[0])
+    # Speed of point before is kept
+    speeds = [float(row['Speed(m/s)']) for row in rows]
+    assert speeds[499] == speeds[500] == speeds[498] and all(math.isfinite(speed) for speed in speeds)
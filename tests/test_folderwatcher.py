@@ -0,0 +1,65 @@
+"""
+FolderWatcher polling, and with inotify where inotify_simple is installed.
+"""
+
+import os
+import time
+import pytest
+from folderwatcher import FolderWatcher
+
+
+def write_file(path, text='<gpx/>'):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def test_polling_waits_for_settle(tmp_path):
+    write_file(str(tmp_path / 'a.gpx'))
+    write_file(str(tmp_path / '.hidden.gpx'))
+    write_file(str(tmp_path / 'b.txt'))
+    with FolderWatcher(str(tmp_path), '.gpx', poll_settle=0.2, poll_interval=0.05, use_inotify=False) as watcher:
+        assert watcher.get_ready() == []
+        start = time.monotonic()
+        assert watcher.wait(2) == [str(tmp_path / 'a.gpx')]
+        assert time.monotonic() - start >= 0.15
+        # Only returned again once changed
+        assert watcher.wait(0.3) == []
+        write_file(str(tmp_path / 'a.gpx'), '<gpx></gpx>')
+        assert watcher.wait(2) == [str(tmp_path / 'a.gpx')]
+
+
+def test_polling_ready_within_a_second(tmp_path):
+    with FolderWatcher(str(tmp_path), '.gpx', use_inotify=False) as watcher:
+        start = time.monotonic()
+        write_file(str(tmp_path / 'a.gpx'))
+        assert watcher.wait(2) == [str(tmp_path / 'a.gpx')]
+        assert time.monotonic() - start < 1
+
+
+def test_polling_forgets_removed_files(tmp_path):
+    write_file(str(tmp_path / 'a.gpx'))
+    write_file(str(tmp_path / 'b.gpx'))
+    with FolderWatcher(str(tmp_path), '.gpx', poll_settle=0.1, poll_interval=0.05, use_inotify=False) as watcher:
+        assert watcher.wait(2) == [str(tmp_path / 'a.gpx'), str(tmp_path / 'b.gpx')]
+        write_file(str(tmp_path / 'c.gpx'))
+        os.remove(str(tmp_path / 'a.gpx'))
+        os.remove(str(tmp_path / 'c.gpx'))
+        watcher.scan()
+        assert (watcher.returned.keys(), watcher.pending.keys()) == ({str(tmp_path / 'b.gpx')}, set())
+
+
+def test_inotify_ready_when_closed(tmp_path):
+    pytest.importorskip('inotify_simple')
+    with FolderWatcher(str(tmp_path), '.gpx', settle=10) as watcher:
+        assert watcher.inotify is not None
+        path = str(tmp_path / 'a.gpx')
+        with open(path, 'w') as file:
+            file.write('<gpx>')
+            file.flush()
+            # Not ready while still open
+            assert watcher.wait(0.2) == []
+            file.write('</gpx>')
+        assert watcher.wait(2) == [path]
+        os.rename(path, str(tmp_path / 'b.gpx'))
+        assert watcher.wait(2) == [str(tmp_path / 'b.gpx')]
+        assert list(watcher.returned) == [str(tmp_path / 'b.gpx')]
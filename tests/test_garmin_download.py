@@ -0,0 +1,130 @@
+"""
+Garmin download pipeline against a fake client that simulates latency and too many requests errors.
+Processing is replaced with a stand in, run in threads, so only the pipeline is tested.
+garminconnect is replaced by a stub module, so it doesn't need to be installed.
+"""
+
+import os
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import pytest
+
+import config
+import filtergpx
+import instrumentation
+from activityindex import SOURCE_GARMIN
+from ratelimit import TokenBucket
+
+
+class GarminConnectTooManyRequestsError(Exception):
+    """Stands in for garminconnect's error"""
+
+
+@pytest.fixture(autouse=True)
+def garminconnect(monkeypatch):
+    """Stub garminconnect module, with the errors filtergpx imports from it"""
+    stub = types.ModuleType('garminconnect')
+    stub.GarminConnectTooManyRequestsError = GarminConnectTooManyRequestsError
+    monkeypatch.setitem(sys.modules, 'garminconnect', stub)
+    return stub
+
+
+class FakeGarmin:
+    """Download returns fake data after latency seconds, first failures[activity_id] calls raise too many requests"""
+    class ActivityDownloadFormat:
+        ORIGINAL = 'original'
+
+    def __init__(self, latency=0.02, failures=None):
+        self.latency = latency
+        self.failures = dict(failures or {})
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def download_activity(self, activity_id, dl_fmt):
+        assert dl_fmt == self.ActivityDownloadFormat.ORIGINAL
+        with self.lock:
+            self.calls.append(activity_id)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            with self.lock:
+                if self.failures.get(activity_id, 0) > 0:
+                    self.failures[activity_id] -= 1
+                    raise GarminConnectTooManyRequestsError('429 Too Many Requests')
+            return b'fit data %d' % activity_id
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def fake_convert_and_process(activity_id, fit_data, sub_path):
+    """Stands in for filtergpx.convert_and_process"""
+    record = filtergpx.MetadataRecord(1700000000.0 + activity_id, 'Run', str(activity_id), 5000.0,
+                                      timedelta(minutes=25), 'Town')
+    return filtergpx.ProcessResult([record], [], fit_data.decode(), 0, 0, {'timings': {}, 'counts': {}}, ())
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(config, 'garmin_backoff_seconds', 0.001)
+    monkeypatch.setattr(config, 'garmin_retries', 3)
+
+
+@pytest.fixture
+def output_path(tmp_path, monkeypatch):
+    """Everything written under tmp_path, with fresh metadata store and index"""
+    os.makedirs(str(tmp_path / 'Import'))
+    monkeypatch.setattr(filtergpx, 'get_output_path', lambda activity='', year='': str(tmp_path) + os.sep)
+    for name in ('activity_metadata', 'activity_index', 'locality_cache', 'heatmap_store'):
+        monkeypatch.setattr(filtergpx, name, None)
+    yield tmp_path
+    filtergpx.get_activity_metadata().store.close()
+    filtergpx.get_activity_index().close()
+
+
+def test_retries_after_too_many_requests(fast_backoff):
+    client = FakeGarmin(failures={1: 3})
+    metrics = instrumentation.Metrics()
+    data = filtergpx.download_activity(client, 1, TokenBucket(1000), metrics)
+    assert data == b'fit data 1'
+    assert client.calls == [1, 1, 1, 1]
+    if instrumentation.enabled:
+        assert metrics.counts['download_retries'] == 3
+
+
+def test_gives_up_after_retries(fast_backoff):
+    client = FakeGarmin(failures={1: 10})
+    with pytest.raises(GarminConnectTooManyRequestsError):
+        filtergpx.download_activity(client, 1, TokenBucket(1000), instrumentation.Metrics())
+    assert len(client.calls) == config.garmin_retries + 1
+
+
+def test_pipeline(fast_backoff, output_path, monkeypatch):
+    monkeypatch.setattr(filtergpx, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr(filtergpx, 'convert_and_process', fake_convert_and_process)
+    monkeypatch.setattr(config, 'garmin_requests_per_second', 1000)
+    # 5 always fails, the others are slow or need retries so they finish out of order
+    client = FakeGarmin(failures={2: 2, 5: 10, 7: 1})
+    activity_ids = list(range(1, 9))
+    run_metrics = instrumentation.Metrics()
+    with filtergpx.State() as status:
+        saved = filtergpx.download_and_process_activities(client, activity_ids, str(output_path) + os.sep,
+                                                          status, run_metrics)
+    assert saved == 7
+    assert 1 < client.max_active <= config.garmin_download_workers
+    if instrumentation.enabled:
+        assert run_metrics.counts['download_retries'] == 2 + 1 + config.garmin_retries + 1
+    store = filtergpx.get_activity_metadata().store
+    assert [activity.activity_id for activity in store.query()] == ['1', '2', '3', '4', '6', '7', '8']
+    index = filtergpx.get_activity_index()
+    assert index.get(SOURCE_GARMIN, 5) is None
+    assert index.get(SOURCE_GARMIN, 7)['content_hash'] == 'fit data 7'
+    with open(status.logfile_name) as logfile:
+        assert 'Download of activity 5 failed' in logfile.read()
@@ -0,0 +1,88 @@
+"""
+Geocoder against a local HTTP server, which can be told to say too many requests.
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pytest
+import geocoder
+from geocoder import Geocoder
+
+
+class NominatimHandler(BaseHTTPRequestHandler):
+    """Reverse geocode responses, first server.failures requests get 429"""
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        with self.server.lock:
+            self.server.request_times.append(time.time())
+            fail = self.server.failures > 0
+            self.server.failures -= 1
+        if fail:
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({'display_name': 'Street, Place %s,%s, Country' % (query['lat'][0], query['lon'][0])})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), NominatimHandler)
+    http_server.lock = threading.Lock()
+    http_server.request_times = []
+    http_server.failures = 0
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def get_url(http_server):
+    return 'http://127.0.0.1:%d/reverse' % http_server.server_address[1]
+
+
+def test_lookup_many(server):
+    with Geocoder(get_url(server), requests_per_second=100) as client:
+        assert client.lookup_many([(56.0, -3.0), (56.1, -3.1), (56.2, -3.2)]) == \
+            ['Street, Place 56.000000,-3.000000, Country',
+             'Street, Place 56.100000,-3.100000, Country',
+             'Street, Place 56.200000,-3.200000, Country']
+
+
+def test_retries_wait_for_rate_limit(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(geocoder, 'BACKOFF_SECONDS', 0)
+    server.failures = 2
+    with Geocoder(get_url(server), requests_per_second=10, retries=2,
+                  rate_limit_filename=str(tmp_path / 'rate.sqlite')) as client:
+        assert client.lookup(56.0, -3.0) == 'Street, Place 56.000000,-3.000000, Country'
+    assert len(server.request_times) == 3
+    # Retries are rate limited too
+    gaps = [later - earlier for earlier, later in zip(server.request_times, server.request_times[1:])]
+    assert min(gaps) >= 0.09
+
+
+def test_gives_up_after_retries(server, monkeypatch):
+    monkeypatch.setattr(geocoder, 'BACKOFF_SECONDS', 0)
+    server.failures = 10
+    with Geocoder(get_url(server), requests_per_second=100, retries=2) as client:
+        assert client.lookup(56.0, -3.0) is None
+    assert len(server.request_times) == 3
+
+
+def test_connection_failure(monkeypatch):
+    monkeypatch.setattr(geocoder, 'BACKOFF_SECONDS', 0)
+    with Geocoder('http://127.0.0.1:1/reverse', requests_per_second=100, timeout=(1, 1), retries=1) as client:
+        assert client.lookup(56.0, -3.0) is None
@@ -0,0 +1,65 @@
+"""
+gpxwriter output read back with gpxpy and gpxstream.
+"""
+
+import gzip
+from datetime import datetime, timezone
+import gpxpy
+import numpy
+import gpxwriter
+from track import Track
+
+NAN = numpy.nan
+
+
+def get_track():
+    """Points with whole and fractional second times, and missing elevation and time"""
+    return Track([56.1, 56.10001, 56.10002, 1e-05],
+                 [-3.2, -3.20001, -3.20002, -3.20003],
+                 [120.5, NAN, 121.0, 122.0],
+                 [1700000000.0, 1700000001.25, NAN, 1700000003.0])
+
+
+def test_gpxpy_parses_output(tmp_path):
+    filename = gpxwriter.write_gpx(str(tmp_path / 'track'), get_track())
+    with open(filename, encoding='utf-8') as file:
+        points = gpxpy.parse(file).tracks[0].segments[0].points
+    assert [(point.latitude, point.longitude) for point in points] == \
+        [(56.1, -3.2), (56.10001, -3.20001), (56.10002, -3.20002), (1e-05, -3.20003)]
+    assert [point.elevation for point in points] == [120.5, None, 121.0, 122.0]
+    assert [point.time for point in points] == [datetime(2023, 11, 14, 22, 13, 20, tzinfo=timezone.utc),
+                                                datetime(2023, 11, 14, 22, 13, 21, 250000, tzinfo=timezone.utc),
+                                                None,
+                                                datetime(2023, 11, 14, 22, 13, 23, tzinfo=timezone.utc)]
+
+
+def test_times_formatted_as_gpxpy(tmp_path):
+    filename = gpxwriter.write_gpx(str(tmp_path / 'track'), get_track())
+    with open(filename, encoding='utf-8') as file:
+        gpx = gpxpy.parse(file)
+    with open(filename, encoding='utf-8') as file:
+        written = file.read()
+    for point in gpx.tracks[0].segments[0].points:
+        if point.time is not None:
+            assert '<time>%s</time>' % gpxpy.gpxfield.format_time(point.time) in written
+    assert written.count('<time>') == 3
+    assert '1e-05' not in written
+
+
+def test_compressed_read_back(tmp_path):
+    track = get_track()
+    filename = gpxwriter.write_gpx(str(tmp_path / 'track'), track, indices=numpy.array([0, 1, 3]), compress=True)
+    assert filename.endswith('.gpx.gz')
+    with gzip.open(filename, 'rt', encoding='utf-8') as file:
+        assert len(gpxpy.parse(file).tracks[0].segments[0].points) == 3
+    read_track = Track.from_gpx(filename)
+    assert read_track.latitudes.tolist() == track.latitudes[[0, 1, 3]].tolist()
+    assert read_track.times.tolist() == [1700000000.0, 1700000001.25, 1700000003.0]
+    assert numpy.isnan(read_track.elevations[1])
+
+
+def test_missing_time_read_back(tmp_path):
+    read_track = Track.from_gpx(gpxwriter.write_gpx(str(tmp_path / 'track'), get_track()))
+    assert numpy.isnan(read_track.times[2])
+    assert read_track.get_time(2) is None
+    assert read_track.get_point(1).time == datetime(2023, 11, 14, 22, 13, 21, 250000, tzinfo=timezone.utc)
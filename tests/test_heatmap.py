@@ -0,0 +1,89 @@
+"""
+Heatmap counts - each activity counted once, replaced when added again, and the same key
+from add_existing as from processing.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy
+import gpxwriter
+import heatmap
+from activityindex import ActivityIndex, SOURCE_GARMIN, SOURCE_LOCAL
+from track import Track
+
+ZOOM = 12
+
+
+def get_track(latitude):
+    """Short track heading east"""
+    longitudes = numpy.linspace(-3.2, -3.1, 20)
+    return Track(numpy.full(20, latitude), longitudes, numpy.full(20, numpy.nan),
+                 1700000000.0 + numpy.arange(20))
+
+
+def get_total(store, activity_type):
+    return sum(int(store.read_tile(activity_type, x, y).sum())
+               for x, y in store.get_tiles(activity_type, 0, 0, 2 ** ZOOM, 2 ** ZOOM))
+
+
+def get_pixels(track):
+    return heatmap.get_pixels(track.latitudes, track.longitudes, ZOOM)
+
+
+def test_added_once(tmp_path):
+    pixels = get_pixels(get_track(56.0))
+    with heatmap.Heatmap(str(tmp_path / 'Heatmap'), ZOOM) as store:
+        assert store.add(SOURCE_GARMIN, 1, 'Run', pixels) > 0
+        assert store.add(SOURCE_GARMIN, 1, 'Run', pixels) == 0
+        # Same id from another source is another activity
+        store.add(SOURCE_LOCAL, 1, 'Run', pixels)
+        assert get_total(store, 'Run') == 2 * len(pixels)
+        assert store.contains(SOURCE_GARMIN, '1') and not store.contains(SOURCE_GARMIN, '2')
+
+
+def test_reprocessed_activity_replaced(tmp_path):
+    old_pixels = get_pixels(get_track(56.0))
+    new_pixels = get_pixels(get_track(56.1))
+    with heatmap.Heatmap(str(tmp_path / 'Heatmap'), ZOOM) as store:
+        store.add(SOURCE_GARMIN, 1, 'Run', old_pixels)
+        store.add(SOURCE_GARMIN, 1, 'Cycle', new_pixels)
+        assert get_total(store, 'Run') == 0
+        assert get_total(store, 'Cycle') == len(new_pixels)
+
+
+def test_add_existing_same_key_as_pipeline(tmp_path):
+    activities_path = tmp_path / 'Activities'
+    os.makedirs(str(activities_path / 'Run' / '2023'))
+    indexed = gpxwriter.write_gpx(str(activities_path / 'Run' / '2023' / 'indexed'), get_track(56.0))
+    unindexed = gpxwriter.write_gpx(str(activities_path / 'Run' / '2023' / 'unindexed'), get_track(56.1),
+                                    compress=True)
+    with ActivityIndex(str(tmp_path / 'index.sqlite')) as index, \
+            heatmap.Heatmap(str(tmp_path / 'Heatmap'), ZOOM) as store:
+        index.record(SOURCE_GARMIN, 7, 'hash', [indexed], 1)
+        assert heatmap.add_existing(store, str(activities_path), index) == 2
+        assert heatmap.add_existing(store, str(activities_path), index) == 0
+        assert store.contains(SOURCE_GARMIN, '7')
+        assert store.contains(heatmap.SOURCE_FILE, os.path.abspath(unindexed))
+        total = get_total(store, 'Run')
+        # Reprocessing either replaces what add_existing added
+        store.add(SOURCE_GARMIN, 7, 'Run', get_pixels(get_track(56.0)), indexed)
+        store.add(SOURCE_LOCAL, 'unindexed', 'Run', get_pixels(get_track(56.1)), unindexed)
+        assert get_total(store, 'Run') == total
+        assert not store.contains(heatmap.SOURCE_FILE, os.path.abspath(unindexed))
+
+
+def add_activities(path, first_id, count):
+    """Run in another process"""
+    pixels = get_pixels(get_track(56.0))
+    with heatmap.Heatmap(path, ZOOM) as store:
+        for activity_id in range(first_id, first_id + count):
+            store.add(SOURCE_GARMIN, activity_id, 'Run', pixels)
+
+
+def test_processes_adding_together(tmp_path):
+    path = str(tmp_path / 'Heatmap')
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(add_activities, path, first_id, 10) for first_id in range(0, 40, 10)]:
+            future.result()
+    with heatmap.Heatmap(path, ZOOM) as store:
+        assert get_total(store, 'Run') == 40 * len(get_pixels(get_track(56.0)))
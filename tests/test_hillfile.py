@@ -0,0 +1,57 @@
+"""
+Compiled hill list - lookups, and recompiling only when the csv changes.
+"""
+
+import os
+import hillfile
+
+HILL_CSV = ('Number,Name,Latitude,Longitude,Metres,M,MT,GridrefXY,Region\n'
+            '1,Ben Nevis,56.7969,-5.0036,1345,1,0,NN166712,04A\n'
+            '2,Carn Mor Dearg,56.8048,-4.9872,1220,1,0,NN177722,04A\n'
+            '3,Carn Dearg SW Top,56.7926,-5.0169,1020,0,1,NN155707,04A\n'
+            '4,Schiehallion,56.6668,-4.1008,1083,1,0,NN713547,02A\n')
+
+
+def write_csv(tmp_path, text=HILL_CSV):
+    filename = str(tmp_path / 'hills.csv')
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write(text)
+    return filename
+
+
+def test_query(tmp_path):
+    hills = hillfile.load(write_csv(tmp_path))
+    assert len(hills) == 4
+    names = sorted(hills.get_hill(index)['Name'] for index in hills.query(56.79, 56.81, -5.02, -4.98))
+    assert names == ['Ben Nevis', 'Carn Dearg SW Top', 'Carn Mor Dearg']
+    hill = hills.get_hill(hills.query(56.66, 56.67, -4.11, -4.10)[0])
+    assert hill == {'Name': 'Schiehallion', 'Latitude': 56.6668, 'Longitude': -4.1008, 'Metres': 1083,
+                    'M': 1, 'MT': 0, 'GridrefXY': 'NN713547', 'Region': '02A'}
+    hills.close()
+
+
+def test_touched_csv_not_hashed_again(tmp_path, monkeypatch):
+    csv_filename = write_csv(tmp_path)
+    hillfile.load(csv_filename).close()
+    stat = os.stat(csv_filename)
+    os.utime(csv_filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    hashed = []
+    compiled = []
+    get_file_hash = hillfile.get_file_hash
+    monkeypatch.setattr(hillfile, 'get_file_hash', lambda filename: hashed.append(filename) or get_file_hash(filename))
+    monkeypatch.setattr(hillfile, 'compile_hill_list', lambda *args: compiled.append(args))
+    # Hashed once, found unchanged, and the new time recorded
+    for _ in range(3):
+        hills = hillfile.load(csv_filename)
+        assert len(hills) == 4
+        hills.close()
+    assert (hashed, compiled) == ([csv_filename], [])
+
+
+def test_changed_csv_recompiled(tmp_path):
+    csv_filename = write_csv(tmp_path)
+    hillfile.load(csv_filename).close()
+    write_csv(tmp_path, HILL_CSV + '5,Ben Lomond,56.1903,-4.6330,974,1,0,NN367028,01C\n')
+    hills = hillfile.load(csv_filename)
+    assert len(hills) == 5
+    hills.close()
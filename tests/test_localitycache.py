@@ -0,0 +1,97 @@
+"""
+LocalityCache against a stub geocoder.
+"""
+
+import sqlite3
+import localitycache
+from localitycache import LocalityCache
+
+
+class StubGeocoder:
+    """Geocoder for get_many, records every lookup. Returns None for latitudes in fail."""
+    def __init__(self, fail=()):
+        self.lookups = []
+        self.fail = fail
+
+    def __call__(self, coordinates):
+        self.lookups.extend(coordinates)
+        return [None if latitude in self.fail else 'Place %.3f,%.3f' % (latitude, longitude)
+                for latitude, longitude in coordinates]
+
+
+def test_hits_and_misses(tmp_path):
+    geocoder = StubGeocoder()
+    with LocalityCache(str(tmp_path / 'cache.sqlite')) as cache:
+        first = cache.get_many([(56.0, -3.0), (56.1, -3.1)], geocoder)
+        # Same cell as first point, and a repeat within one call
+        second = cache.get_many([(56.0002, -3.0002), (56.2, -3.2), (56.2, -3.2)], geocoder)
+    assert first == ['Place 56.000,-3.000', 'Place 56.100,-3.100']
+    assert second == ['Place 56.000,-3.000', 'Place 56.200,-3.200', 'Place 56.200,-3.200']
+    assert geocoder.lookups == [(56.0, -3.0), (56.1, -3.1), (56.2, -3.2)]
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_persists_between_instances(tmp_path):
+    filename = str(tmp_path / 'cache.sqlite')
+    with LocalityCache(filename) as cache:
+        cache.get(56.0, -3.0, lambda latitude, longitude: 'Home')
+    with LocalityCache(filename) as cache:
+        assert cache.get(56.0, -3.0, lambda latitude, longitude: 'Elsewhere') == 'Home'
+        assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_failed_lookup_not_cached(tmp_path):
+    geocoder = StubGeocoder(fail=(56.0,))
+    with LocalityCache(str(tmp_path / 'cache.sqlite')) as cache:
+        assert cache.get_many([(56.0, -3.0)], geocoder) == [None]
+        geocoder.fail = ()
+        assert cache.get_many([(56.0, -3.0)], geocoder) == ['Place 56.000,-3.000']
+    assert len(geocoder.lookups) == 2
+
+
+def test_expired_entries_looked_up_again(tmp_path, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(localitycache.time, 'time', lambda: now[0])
+    geocoder = StubGeocoder()
+    with LocalityCache(str(tmp_path / 'cache.sqlite'), ttl=60) as cache:
+        cache.get_many([(56.0, -3.0)], geocoder)
+        now[0] += 30
+        cache.get_many([(56.0, -3.0)], geocoder)
+        now[0] += 60
+        cache.get_many([(56.0, -3.0)], geocoder)
+    assert len(geocoder.lookups) == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_least_recently_used_evicted(tmp_path, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(localitycache.time, 'time', lambda: now[0])
+    geocoder = StubGeocoder()
+    with LocalityCache(str(tmp_path / 'cache.sqlite'), max_entries=2) as cache:
+        for latitude in (56.0, 56.1):
+            cache.get_many([(latitude, -3.0)], geocoder)
+            now[0] += 1
+        # Use the first again, so the second is least recently used when a third is added
+        cache.get_many([(56.0, -3.0)], geocoder)
+        now[0] += 1
+        cache.get_many([(56.2, -3.0)], geocoder)
+        assert cache._connect().execute('SELECT COUNT(*) FROM locality').fetchone()[0] == 2
+        geocoder.lookups = []
+        cache.get_many([(56.0, -3.0), (56.2, -3.0), (56.1, -3.0)], geocoder)
+    assert geocoder.lookups == [(56.1, -3.0)]
+
+
+def test_not_locked_during_lookup(tmp_path):
+    filename = str(tmp_path / 'cache.sqlite')
+    with LocalityCache(filename) as cache:
+        cache.get_many([(56.0, -3.0)], StubGeocoder())
+
+        def geocoder(coordinates):
+            # Another process can write while the lookup is running
+            other = sqlite3.connect(filename, timeout=0)
+            other.execute('BEGIN IMMEDIATE')
+            other.rollback()
+            other.close()
+            return ['Place'] * len(coordinates)
+        # A hit, which updates last used, then a miss
+        assert cache.get_many([(56.0, -3.0), (56.1, -3.1)], geocoder) == ['Place 56.000,-3.000', 'Place']
@@ -0,0 +1,63 @@
+"""
+MetadataStore writes, queries and csv import and export.
+"""
+
+from datetime import timedelta
+import filtergpx
+from metadatastore import MetadataStore, read_metadata_csv
+
+
+def get_record(activity_id, start_time, activity_type='Run', bounds=(56.0, 56.1, -3.1, -3.0)):
+    return filtergpx.MetadataRecord(start_time, activity_type, activity_id, 5012.4, timedelta(days=1, seconds=7384),
+                                    'Town, Place', bounds)
+
+
+def test_writes_batched(tmp_path, monkeypatch):
+    monkeypatch.setattr('metadatastore.BATCH_SIZE', 3)
+    filename = str(tmp_path / 'metadata.sqlite')
+    with MetadataStore(filename) as store:
+        for i in range(4):
+            store.write_record(get_record(str(i), 1600000000.0 + i))
+        # Batch of 3 saved, the 4th not yet
+        with MetadataStore(filename) as reader:
+            assert [activity.activity_id for activity in reader.query()] == ['0', '1', '2']
+    with MetadataStore(filename) as reader:
+        assert len(reader.query()) == 4
+
+
+def test_query(tmp_path):
+    with MetadataStore(str(tmp_path / 'metadata.sqlite')) as store:
+        store.write_record(get_record('1', 1600000000.0))
+        store.write_record(get_record('2', 1700000000.0, 'Cycle'))
+        store.write_record(get_record('3', 1700000100.0, 'Cycle', (50.0, 50.1, 0.0, 0.1)))
+        assert [activity.activity_id for activity in store.query('Cycle')] == ['2', '3']
+        assert [activity.activity_id for activity in store.query(start_time=1650000000.0)] == ['2', '3']
+        assert [activity.activity_id for activity in store.query(near=(56.05, -3.2, 10000))] == ['1', '2']
+        assert store.get('3').bounds == (50.0, 50.1, 0.0, 0.1)
+
+
+def test_export_and_import(tmp_path):
+    csv_filename = str(tmp_path / 'ProcessGPX.csv')
+    with MetadataStore(str(tmp_path / 'metadata.sqlite')) as store:
+        store.write_record(get_record('1', 1600000000.0))
+        assert store.export_csv(csv_filename) == 1
+    with open(csv_filename) as file:
+        lines = file.read().splitlines()
+    assert lines[0] == 'Start,Activity,Garmin ID,Distance,Duration,Location'
+    # ISO start, nothing with a comma except the quoted location
+    assert lines[1].endswith(',Run,activity_1,5012,26:03:04,"Town, Place"')
+    with MetadataStore(str(tmp_path / 'imported.sqlite'), csv_filename) as store:
+        activity = store.get('1')
+        assert (activity.start_time, activity.duration, activity.locality) == (1600000000.0, 93784.0, 'Town, Place')
+
+
+def test_read_old_csv(tmp_path):
+    csv_filename = str(tmp_path / 'ProcessGPX.csv')
+    with open(csv_filename, 'w') as file:
+        file.write('Date,Time,Activity,Garmin ID,Distance,Duration,Location\n'
+                   '2021-01-09, 10:15,Run,activity_123,5012,0:33:19,Town\n'
+                   '2021-01-10, 08:00,Cycle,activity_124,85000,1 day, 2:03:04,Village\n'
+                   'not a row\n')
+    activities = list(read_metadata_csv(csv_filename))
+    assert [(activity.activity_id, activity.activity_type, activity.duration, activity.locality)
+            for activity in activities] == [('123', 'Run', 1999.0, 'Town'), ('124', 'Cycle', 93784.0, 'Village')]
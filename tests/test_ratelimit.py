@@ -0,0 +1,52 @@
+"""
+Rate limiters, SharedRateLimiter across separate processes.
+"""
+
+import os
+import subprocess
+import sys
+import time
+from ratelimit import SharedRateLimiter, TokenBucket
+
+ACQUIRE_CODE = '''
+import sys, time
+from ratelimit import SharedRateLimiter
+limiter = SharedRateLimiter(sys.argv[1], float(sys.argv[2]))
+for _ in range(int(sys.argv[3])):
+    limiter.acquire()
+    print(time.time())
+'''
+
+
+def test_token_bucket():
+    limiter = TokenBucket(20)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.19
+
+
+def test_shared_between_processes(tmp_path):
+    filename = str(tmp_path / 'rate.sqlite')
+    rate = 20
+    repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    processes = [subprocess.Popen([sys.executable, '-c', ACQUIRE_CODE, filename, str(rate), '5'],
+                                  stdout=subprocess.PIPE, text=True, cwd=repo_path) for _ in range(3)]
+    times = sorted(float(line) for process in processes for line in process.communicate()[0].split())
+    assert all(process.returncode == 0 for process in processes)
+    assert len(times) == 15
+    # Evenly spaced however the requests were split between processes, allowing for sleep wake up
+    assert times[-1] - times[0] >= 14 / rate - 0.01
+    # A process woken late shortens the gap to the next, without sharing they'd acquire together
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert min(gaps) >= 0.5 / rate
+
+
+def test_pause_shared(tmp_path):
+    filename = str(tmp_path / 'rate.sqlite')
+    with SharedRateLimiter(filename, 1000) as first, SharedRateLimiter(filename, 1000) as second:
+        first.acquire()
+        first.pause(0.2)
+        start = time.time()
+        second.acquire()
+        assert time.time() - start >= 0.18
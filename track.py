@@ -0,0 +1,60 @@
+"""
+Compact track representation.
+Points are held in contiguous float64 arrays - latitude, longitude, elevation and
+epoch seconds for time, nan where elevation or time is missing - rather than an object per point.
+Times keep any fraction of a second.
+@author: lawrence
+"""
+
+from datetime import datetime, timezone
+import numpy
+from gpxstream import GPXPoint, iter_chunks
+
+
+class Track:
+    """Track points in arrays, all the same length"""
+    def __init__(self, latitudes, longitudes, elevations, times):
+        self.latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+        self.longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+        self.elevations = numpy.asarray(elevations, dtype=numpy.float64)
+        self.times = numpy.asarray(times, dtype=numpy.float64)
+
+    @classmethod
+    def from_gpx(cls, source):
+        """Read track from gpx, streamed so only the arrays are ever held.
+        Source can be a filename, an open file or gpx xml.
+        """
+        chunks = list(iter_chunks(source))
+        if len(chunks) == 0:
+            return cls([], [], [], [])
+        return cls(*(numpy.concatenate([chunk[i] for chunk in chunks]) for i in range(4)))
+
+    @classmethod
+    def from_fit(cls, source):
+        """Read track from FIT data, source can be a filename, an open binary file or bytes"""
+        # Only needed for Garmin downloads
+        from fitstream import read_fit
+        return cls(*read_fit(source))
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    @property
+    def nbytes(self):
+        """Memory used by point data"""
+        return self.latitudes.nbytes + self.longitudes.nbytes + self.elevations.nbytes + self.times.nbytes
+
+    def get_time(self, index):
+        """Time of point as a datetime, None if it has no time"""
+        point_time = self.times[index]
+        if numpy.isnan(point_time):
+            return None
+        return datetime.fromtimestamp(float(point_time), timezone.utc)
+
+    def get_point(self, index):
+        """Single point, with same attributes as a gpxpy track point"""
+        elevation = self.elevations[index]
+        return GPXPoint(float(self.latitudes[index]),
+                        float(self.longitudes[index]),
+                        None if numpy.isnan(elevation) else float(elevation),
+                        self.get_time(index))
@@ -0,0 +1,135 @@
+"""
+Batch distance calculation for whole tracks.
+Vectorised Vincenty inverse solution on the WGS-84 ellipsoid, so a track's
+distances are calculated in one numpy pass instead of a geopy call per point.
+
+Tolerance: results agree with geopy.distance.distance (Karney geodesic) to
+within 1mm for any pair of points that are not near-antipodal, which is
+always the case for consecutive points or points on the same activity.
+
+Farthest point from start is found using straight line (chord) distances through
+the ellipsoid, which are cheap, only points that could be farthest get a geodesic.
+@author: lawrence
+"""
+
+import numpy
+
+# WGS-84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+WGS84_E_SQ = WGS84_F * (2 - WGS84_F)
+# Smallest radius of curvature of the ellipsoid (meridian at the equator), no geodesic bends more than this
+MIN_RADIUS = WGS84_A * (1 - WGS84_E_SQ)
+# Allowance for rounding when comparing chord bounds (meters)
+CHORD_MARGIN = 0.001
+# Vincenty iteration limits
+MAX_ITERATIONS = 200
+CONVERGENCE = 1e-12
+
+
+def geodesic_distance(lat1, lon1, lat2, lon2):
+    """Distance in meters between arrays (or scalars) of points.
+    Inputs in degrees, arrays must broadcast together.
+    """
+    lat1 = numpy.radians(numpy.asarray(lat1, dtype=numpy.float64))
+    lat2 = numpy.radians(numpy.asarray(lat2, dtype=numpy.float64))
+    lon_diff = numpy.radians(numpy.asarray(lon2, dtype=numpy.float64) - numpy.asarray(lon1, dtype=numpy.float64))
+    lat1, lat2, lon_diff = numpy.broadcast_arrays(lat1, lat2, lon_diff)
+
+    # Reduced latitudes
+    u1 = numpy.arctan((1 - WGS84_F) * numpy.tan(lat1))
+    u2 = numpy.arctan((1 - WGS84_F) * numpy.tan(lat2))
+    sin_u1, cos_u1 = numpy.sin(u1), numpy.cos(u1)
+    sin_u2, cos_u2 = numpy.sin(u2), numpy.cos(u2)
+
+    lam = lon_diff.copy()
+    sin_sigma = numpy.zeros_like(lam)
+    cos_sigma = numpy.ones_like(lam)
+    sigma = numpy.zeros_like(lam)
+    cos_sq_alpha = numpy.ones_like(lam)
+    cos_2sigma_m = numpy.zeros_like(lam)
+
+    for _ in range(MAX_ITERATIONS):
+        sin_lam, cos_lam = numpy.sin(lam), numpy.cos(lam)
+        sin_sigma = numpy.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = numpy.arctan2(sin_sigma, cos_sigma)
+        # Coincident points have sin_sigma of 0, avoid dividing by it
+        safe_sin_sigma = numpy.where(sin_sigma == 0, 1.0, sin_sigma)
+        sin_alpha = cos_u1 * cos_u2 * sin_lam / safe_sin_sigma
+        cos_sq_alpha = 1 - sin_alpha ** 2
+        # Equatorial lines have cos_sq_alpha of 0
+        safe_cos_sq_alpha = numpy.where(cos_sq_alpha == 0, 1.0, cos_sq_alpha)
+        cos_2sigma_m = numpy.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / safe_cos_sq_alpha)
+        c = WGS84_F / 16 * cos_sq_alpha * (4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+        lam_prev = lam
+        lam = lon_diff + (1 - c) * WGS84_F * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+        active = numpy.abs(lam - lam_prev) > CONVERGENCE
+        if not active.any():
+            break
+
+    u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+        b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+
+    return WGS84_B * a * (sigma - delta_sigma)
+
+
+def calculate_incremental_distances(latitudes, longitudes, previous=None):
+    """Distance from point i-1 to point i for a whole track, 0 for the first point.
+    For a track processed in chunks, pass the last point of the previous chunk as (latitude, longitude).
+    """
+    latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+    longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+    incremental = numpy.zeros(len(latitudes))
+    if len(latitudes) == 0:
+        return incremental
+
+    if previous is not None:
+        incremental[0] = geodesic_distance(previous[0], previous[1], latitudes[0], longitudes[0])
+    if len(latitudes) > 1:
+        incremental[1:] = geodesic_distance(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+
+    return incremental
+
+
+def get_ecef(latitudes, longitudes):
+    """Earth centred x, y, z (meters) of points on the ellipsoid surface"""
+    lat = numpy.radians(numpy.asarray(latitudes, dtype=numpy.float64))
+    lon = numpy.radians(numpy.asarray(longitudes, dtype=numpy.float64))
+    sin_lat = numpy.sin(lat)
+    cos_lat = numpy.cos(lat)
+    # Prime vertical radius of curvature
+    n = WGS84_A / numpy.sqrt(1 - WGS84_E_SQ * sin_lat ** 2)
+    return n * cos_lat * numpy.cos(lon), n * cos_lat * numpy.sin(lon), n * (1 - WGS84_E_SQ) * sin_lat
+
+
+def find_farthest_point(latitudes, longitudes, start=None):
+    """Index of point farthest from start (first point if not given), and its geodesic distance.
+    Same result as argmax of geodesic distances to every point, including which point wins a tie.
+    A geodesic is never shorter than the chord, and as it can't bend more than MIN_RADIUS
+    is at most 2r.asin(chord/2r). So only points whose upper bound reaches the longest chord
+    can be farthest, and only those get a geodesic distance.
+    """
+    latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+    longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+    if len(latitudes) == 0:
+        return None, 0.0
+    if start is None:
+        start = (latitudes[0], longitudes[0])
+
+    x, y, z = get_ecef(latitudes, longitudes)
+    start_x, start_y, start_z = get_ecef(start[0], start[1])
+    chords = numpy.sqrt((x - start_x) ** 2 + (y - start_y) ** 2 + (z - start_z) ** 2)
+    upper_bounds = 2 * MIN_RADIUS * numpy.arcsin(numpy.minimum(chords / (2 * MIN_RADIUS), 1.0))
+    candidates = numpy.flatnonzero(upper_bounds + CHORD_MARGIN >= chords.max())
+
+    distances = geodesic_distance(start[0], start[1], latitudes[candidates], longitudes[candidates])
+    farthest = int(numpy.argmax(distances))
+    return int(candidates[farthest]), float(distances[farthest])
+